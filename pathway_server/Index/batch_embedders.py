@@ -0,0 +1,257 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+import voyageai
+from FlagEmbedding import BGEM3FlagModel
+from pathway.xpacks.llm import embedders
+
+from config import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_WAIT_MS,
+    EMBEDDING_STATS_LOG_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects texts submitted concurrently (from any thread or event loop) and
+    embeds them together on a dedicated worker thread.
+
+    A batch is sent as soon as it holds `max_batch_size` texts, or `max_wait_ms`
+    after its first text arrived, whichever comes first. Blocking calls (HTTP
+    requests, CPU inference) therefore never run on the Pathway event loop.
+
+    Args:
+        embed_batch (Callable[[list[str]], list[np.ndarray]]): Embeds a list of texts
+        max_batch_size (int): Maximum number of texts per batch
+        max_wait_ms (float): Maximum time the first text of a batch waits for others
+        name (str): Name used in the logs and stats
+    """
+
+    def __init__(
+        self,
+        embed_batch,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS,
+        name: str = "embedder",
+    ):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+
+        self._queue: queue.Queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._texts = 0
+        self._largest_batch = 0
+        self._busy_time = 0.0
+        self._started_at = time.monotonic()
+
+        self._worker = threading.Thread(
+            target=self._run, name=f"{name}-batcher", daemon=True
+        )
+        self._worker.start()
+
+    def submit(self, text: str) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((text, future))
+        return future
+
+    async def embed(self, text: str) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # skip callers that gave up (e.g. cancelled by a timeout)
+            batch = [(text, f) for text, f in batch if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            start = time.monotonic()
+            try:
+                embeddings = self.embed_batch([text for text, _ in batch])
+            except Exception as e:
+                print(f"Embedding error ({self.name}): {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self._record(len(batch), time.monotonic() - start)
+
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def _record(self, batch_size: int, duration: float):
+        with self._stats_lock:
+            self._batches += 1
+            self._texts += batch_size
+            self._largest_batch = max(self._largest_batch, batch_size)
+            self._busy_time += duration
+            batches = self._batches
+        if EMBEDDING_STATS_LOG_INTERVAL and batches % EMBEDDING_STATS_LOG_INTERVAL == 0:
+            logger.info("%s batching stats: %s", self.name, self.stats())
+
+    def stats(self) -> dict:
+        """Batch-size and throughput counters, to tune the batch size and wait."""
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._started_at
+            return {
+                "batches": self._batches,
+                "texts": self._texts,
+                "avg_batch_size": self._texts / self._batches if self._batches else 0.0,
+                "max_batch_size_seen": self._largest_batch,
+                "pending": self._queue.qsize(),
+                # texts per second of embedding work / of wall clock time
+                "busy_throughput": self._texts / self._busy_time if self._busy_time else 0.0,
+                "throughput": self._texts / elapsed if elapsed else 0.0,
+            }
+
+
+_voyage_client = None
+_bgem3_models: dict[str, BGEM3FlagModel] = {}
+_shared_lock = threading.Lock()
+
+
+def get_voyage_client() -> voyageai.Client:
+    """Returns the process wide Voyage AI client."""
+    global _voyage_client
+    with _shared_lock:
+        if _voyage_client is None:
+            _voyage_client = voyageai.Client(api_key=os.getenv("VOYAGE_API_KEY"))
+        return _voyage_client
+
+
+def get_bgem3_model(model_name: str) -> BGEM3FlagModel:
+    """Loads the BGE-M3 model once per process."""
+    with _shared_lock:
+        if model_name not in _bgem3_models:
+            _bgem3_models[model_name] = BGEM3FlagModel(
+                model_name,
+                use_fp16=torch.cuda.is_available()  # Use FP16 if CUDA available
+            )
+        return _bgem3_models[model_name]
+
+
+class VoyageEmbedder(embedders.OpenAIEmbedder):
+    """
+    Pathway wrapper for Voyage AI Embedding services.
+
+    Concurrent calls are micro-batched into a single `embed` request of a shared
+    client.
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.batcher = MicroBatcher(
+            self._embed_batch, max_batch_size, max_wait_ms, name="voyage"
+        )
+
+    def _embed_batch(self, texts: list[str]) -> list[np.ndarray]:
+        ret = get_voyage_client().embed(texts, model="voyage-3", input_type="document")
+        return [np.array(embedding) for embedding in ret.embeddings]
+
+    async def __wrapped__(self, input, **kwargs) -> np.ndarray:
+        """Embed the documents
+
+        Args:
+            - input: mandatory, the string to embed.
+            - **kwargs: optional parameters, if unset defaults from the constructor
+              will be taken.
+        """
+        return await self.batcher.embed(input or ".")
+
+    def batch_stats(self) -> dict:
+        return self.batcher.stats()
+
+
+class Bge_m3_embedder(embedders.OpenAIEmbedder):
+    """
+    Custom Pathway embedder for BGE-M3 model.
+
+    Concurrent calls are micro-batched and encoded together on a dedicated
+    inference thread, so the Pathway event loop is never blocked by the model.
+    """
+
+    def __init__(
+        self,
+        model_name='BAAI/bge-m3',
+        *args,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS,
+        **kwargs,
+    ):
+        """
+        Initialize the BGE-M3 embedder.
+
+        Args:
+            model_name (str): Hugging Face model identifier
+            max_batch_size (int): Maximum number of texts encoded together
+            max_wait_ms (float): Maximum time a text waits for its batch to fill up
+            *args: Additional positional arguments for OpenAIEmbedder
+            **kwargs: Additional keyword arguments for OpenAIEmbedder
+        """
+        super().__init__(*args, **kwargs)
+
+        self.bgem3_model = get_bgem3_model(model_name)
+        self.batcher = MicroBatcher(
+            self._embed_batch, max_batch_size, max_wait_ms, name="bge-m3"
+        )
+
+    def _embed_batch(self, texts: list[str]) -> list[np.ndarray]:
+        embeddings_dict = self.bgem3_model.encode(
+            texts,
+            batch_size=len(texts),
+            return_dense=True,
+        )
+        return [
+            np.array(embedding, dtype=np.float32)
+            for embedding in embeddings_dict['dense_vecs']
+        ]
+
+    async def __wrapped__(self, input, **kwargs) -> np.ndarray:
+        """
+        Embed input text.
+
+        Args:
+            input (str): Text to embed
+            **kwargs: Additional embedding parameters
+
+        Returns:
+            np.ndarray: Embedding vector
+        """
+        # Handle empty or whitespace inputs
+        if not input or input.isspace():
+            input = "."
+        return await self.batcher.embed(input)
+
+    def batch_stats(self) -> dict:
+        return self.batcher.stats()
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+from config import CONTEXTUALIZATION_RATE_LIMITS
+
+
+class AsyncRateLimiter:
+    """
+    Spaces out the requests sent to one provider so that at most
+    `requests_per_minute` of them are started in any minute.
+
+    Slots are reserved under a thread lock, so a single limiter can be shared by
+    several event loops (every parsed document runs its own loop).
+    """
+
+    def __init__(self, requests_per_minute: int | None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+_rate_limiters: dict[str, AsyncRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str) -> AsyncRateLimiter:
+    """
+    Returns the process wide rate limiter of the given provider, configured from
+    `CONTEXTUALIZATION_RATE_LIMITS` (providers not listed there are not limited).
+    """
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            _rate_limiters[provider] = AsyncRateLimiter(
+                CONTEXTUALIZATION_RATE_LIMITS.get(provider)
+            )
+        return _rate_limiters[provider]
+
+
+def run_coroutine_sync(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code, e.g. from the
+    `__wrapped__` of a Pathway UDF. If the calling thread already runs an event
+    loop, the coroutine is run on a fresh loop in a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def runner():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
@@ -0,0 +1,313 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import pathway as pw
+from aiohttp import web
+from pathway.xpacks.llm import embedders
+
+from config import (
+    INGEST_STATS_BACKUPS,
+    INGEST_STATS_MAX_BYTES,
+    INGEST_STATS_PATH,
+    INGEST_STATS_RECENT_DOCUMENTS,
+)
+
+
+def _document_key(metadata) -> tuple:
+    # a version of an input file, in the metadata of the file and of its chunks
+    if isinstance(metadata, pw.Json):
+        metadata = metadata.value
+    metadata = metadata or {}
+    return metadata.get("path"), metadata.get("modified_at")
+
+
+def _stage_summary(stage: dict) -> dict:
+    return {
+        **stage,
+        "avg_s": stage["total_s"] / stage["count"] if stage["count"] else 0.0,
+    }
+
+
+class DocumentTrace:
+    """
+    Timings and counters of the ingestion of one document. Stages can be timed
+    from several threads at once (e.g. concurrent contextualization of chunks).
+    """
+
+    def __init__(self, stats: "IngestStats"):
+        self._stats = stats
+        self._lock = threading.Lock()
+        self.info: dict = {}
+        self.stages: dict[str, dict] = {}
+        self.counters: collections.Counter = collections.Counter()
+        self.started_at = time.time()
+        self.parsed_at: float | None = None
+        self.error: str | None = None
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self.stages.setdefault(
+                stage, {"count": 0, "total_s": 0.0, "max_s": 0.0}
+            )
+            entry["count"] += 1
+            entry["total_s"] += seconds
+            entry["max_s"] = max(entry["max_s"], seconds)
+        self._stats.record(stage, seconds)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def count(self, counter: str, n: int = 1):
+        with self._lock:
+            self.counters[counter] += n
+        self._stats.count(counter, n)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                **self.info,
+                "started_at": self.started_at,
+                "parse_s": (self.parsed_at or time.time()) - self.started_at,
+                "error": self.error,
+                "stages": {
+                    name: _stage_summary(stage) for name, stage in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+
+class IngestStats:
+    """
+    Per-stage timings and counters of the ingestion of the documents of a
+    server: PDF parse, static metadata, contextualization, table key-values, image
+    crop, embedding and index insert, plus LLM retries, fallbacks to raw text and
+    the queue of files waiting to be parsed.
+
+    Every ingested document is appended to a rolling JSONL file at `path` (rotated
+    at `max_bytes`, keeping `backups` old files), and `snapshot()` is served at
+    `/v1/ingest_stats` by `serve_ingest_stats`.
+
+    Args:
+        path (str): JSONL file of the per-document records
+        max_bytes (int): Size at which the JSONL file is rotated
+        backups (int): Number of rotated files kept (`path.1`, `path.2`, ...)
+        recent_documents (int): Number of documents kept for `snapshot()`
+    """
+
+    def __init__(
+        self,
+        path: str = INGEST_STATS_PATH,
+        max_bytes: int = INGEST_STATS_MAX_BYTES,
+        backups: int = INGEST_STATS_BACKUPS,
+        recent_documents: int = INGEST_STATS_RECENT_DOCUMENTS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict] = {}
+        self._counters: collections.Counter = collections.Counter()
+        self._queued: set = set()
+        self._parsed: set = set()
+        self._in_progress: list[DocumentTrace] = []
+        self._awaiting_index: list[DocumentTrace] = []
+        self._recent: collections.deque = collections.deque(maxlen=recent_documents)
+        self._embedders: dict[str, embedders.BaseEmbedder] = {}
+        self._index_tracked = False
+        self.started_at = time.time()
+
+    def record(self, stage: str, seconds: float, n: int = 1):
+        with self._lock:
+            entry = self._stages.setdefault(
+                stage, {"count": 0, "total_s": 0.0, "max_s": 0.0}
+            )
+            entry["count"] += n
+            entry["total_s"] += seconds
+            entry["max_s"] = max(entry["max_s"], seconds)
+
+    def count(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] += n
+
+    @contextlib.contextmanager
+    def document(self):
+        """
+        Traces the parsing of a document. Once parsed, the record is written out,
+        or, if the index is tracked (see `track_index`), once its chunks are
+        embedded and indexed.
+        """
+        trace = DocumentTrace(self)
+        with self._lock:
+            self._in_progress.append(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            trace.parsed_at = time.time()
+            self.count("documents_failed" if trace.error else "documents_parsed")
+            with self._lock:
+                self._in_progress.remove(trace)
+                waits = self._index_tracked and trace.error is None
+                if waits:
+                    self._awaiting_index.append(trace)
+            if not waits:
+                self._finish(trace)
+
+    def _finish(self, trace: DocumentTrace):
+        record = trace.to_dict()
+        with self._lock:
+            self._recent.append(record)
+        self._write(record)
+
+    def _write(self, record: dict):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            try:
+                if (
+                    os.path.exists(self.path)
+                    and os.path.getsize(self.path) + len(line) > self.max_bytes
+                ):
+                    self._rotate()
+                with open(self.path, "a") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Error writing the ingest stats to {self.path}: {e}")
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def track_queued(self, docs: pw.Table) -> pw.Table:
+        """
+        Notes the files of an input table as they arrive, before they reach the
+        parser. With `track_index`, the ones whose chunks did not come out of the
+        parser yet are reported as pending.
+        """
+
+        # not deterministic, so that Pathway does not call it again on deletions
+        @pw.udf(deterministic=False)
+        def note_queued(metadata: pw.Json) -> pw.Json:
+            with self._lock:
+                self._queued.add(_document_key(metadata))
+            return metadata
+
+        return docs.with_columns(_metadata=note_queued(pw.this._metadata))
+
+    def track_index(self, document_store):
+        """
+        Counts the chunks reaching the index of `document_store`, and closes the
+        records of the parsed documents with the time their chunks took to be
+        embedded and indexed ("embedding_and_index"). As Pathway indexes whole
+        batches, this is measured per batch of documents.
+
+        A file stops being pending once chunks of it come out of the parser of
+        `document_store`. This also counts parser `DiskCache` hits, which never
+        reach the parser itself.
+        """
+
+        clock = time.time
+
+        def on_parsed(key, row, time, is_addition):
+            if is_addition:
+                document = _document_key(row["metadata"])
+                with self._lock:
+                    self._parsed.add(document)
+
+        def on_change(key, row, time, is_addition):
+            self.count("chunks_indexed" if is_addition else "chunks_removed")
+
+        def on_time_end(time):
+            with self._lock:
+                traces, self._awaiting_index = self._awaiting_index, []
+            for trace in traces:
+                trace.record("embedding_and_index", clock() - trace.parsed_at)
+                self._finish(trace)
+
+        with self._lock:
+            self._index_tracked = True
+        pw.io.subscribe(document_store.parsed_docs, on_change=on_parsed)
+        pw.io.subscribe(
+            document_store.chunked_docs, on_change=on_change, on_time_end=on_time_end
+        )
+
+    def add_embedder(self, name: str, embedder):
+        """Reports the batching stats of `embedder`, if it has any."""
+        self._embedders[name] = embedder
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            in_progress = list(self._in_progress)
+            awaiting_index = len(self._awaiting_index)
+            stages = {name: _stage_summary(s) for name, s in self._stages.items()}
+            counters = dict(self._counters)
+            recent = list(self._recent)
+            queued = len(self._queued)
+            pending = len(self._queued - self._parsed) - len(in_progress)
+        return {
+            "uptime_s": time.time() - self.started_at,
+            "queue": {
+                "queued": queued,
+                "pending": max(pending, 0),
+                "in_progress": len(in_progress),
+                "awaiting_index": awaiting_index,
+            },
+            "stages": stages,
+            "counters": counters,
+            "embedders": {
+                name: embedder.batch_stats()
+                for name, embedder in self._embedders.items()
+                if hasattr(embedder, "batch_stats")
+            },
+            "in_progress": [trace.to_dict() for trace in in_progress],
+            "recent_documents": recent,
+        }
+
+
+class TimedOpenAIEmbedder(embedders.OpenAIEmbedder):
+    """
+    `OpenAIEmbedder` recording the time of every request (cache misses only) as
+    the "embedding" stage of `stats`.
+    """
+
+    def __init__(self, *args, stats: IngestStats, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    async def __wrapped__(self, input, **kwargs):
+        start = time.monotonic()
+        try:
+            return await super().__wrapped__(input, **kwargs)
+        finally:
+            self.stats.record("embedding", time.monotonic() - start)
+
+
+def serve_ingest_stats(server, stats: IngestStats, route: str = "/v1/ingest_stats"):
+    """
+    Serves `stats.snapshot()` on `route` of a `DocumentStoreServer`, next to
+    `/v1/statistics`.
+    """
+
+    async def handle_ingest_stats(request: web.Request) -> web.Response:
+        return web.json_response(
+            stats.snapshot(), dumps=lambda value: json.dumps(value, default=str)
+        )
+
+    server.webserver._add_endpoint_to_app("GET", route, handle_ingest_stats)
+    server.webserver._add_endpoint_to_app("POST", route, handle_ingest_stats)
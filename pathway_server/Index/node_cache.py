@@ -0,0 +1,68 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+from config import NODE_CACHE_PATH
+
+
+def node_hash(node, *context) -> str:
+    """
+    Fingerprint of a parsed node: its text, variant and bounding boxes, plus any
+    extra `context` the cached result depends on (e.g. the document type).
+    """
+    h = hashlib.sha256()
+    h.update(node.text.encode("utf-8"))
+    h.update(str(sorted(node.variant)).encode("utf-8"))
+    for bbox in node.bbox:
+        h.update(
+            f"{bbox.page}:{bbox.x0:.1f},{bbox.y0:.1f},{bbox.x1:.1f},{bbox.y1:.1f}".encode()
+        )
+    for value in context:
+        h.update(b"\x00" + str(value).encode("utf-8"))
+    return h.hexdigest()
+
+
+class NodeCache:
+    """
+    Persistent cache of the per-node ingestion results (contextualization, table
+    key-values, image hash), so that re-ingesting a modified or re-downloaded
+    filing only sends its new or changed nodes to the LLM. Chunks that come out
+    with the same text also hit the `DiskCache` of the embedder.
+
+    Backed by SQLite in WAL mode, so several indexer processes can share it.
+
+    Args:
+        path (str): SQLite database file
+    """
+
+    def __init__(self, path: str = NODE_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (hash TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM nodes WHERE hash = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO nodes (hash, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+            self._conn.commit()
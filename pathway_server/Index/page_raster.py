@@ -0,0 +1,135 @@
+import io
+from collections import OrderedDict
+
+from PIL import Image
+
+from blob_store import BlobStore
+from config import PAGE_RASTER_DPI, PAGE_RASTER_CACHE_PAGES
+
+
+class PageRasterCache:
+    """
+    Per-document cache of rendered pages.
+
+    The document is converted to PyMuPDF once and every page is rasterized at most
+    once (at `dpi`), node images are cropped from the cached page. Only the
+    `max_pages` most recently used pages are kept in memory.
+
+    Args:
+        doc (openparse.Pdf): The PDF document
+        dpi (int): Resolution at which the pages are rendered
+        max_pages (int): Number of rendered pages kept in memory
+    """
+
+    def __init__(self, doc, dpi: int = PAGE_RASTER_DPI, max_pages: int = PAGE_RASTER_CACHE_PAGES):
+        self.doc = doc
+        self.dpi = dpi
+        # bboxes are in PDF points (1/72 inch)
+        self.scale = dpi / 72
+        self.max_pages = max_pages
+        self._pdoc = None
+        self._pages: OrderedDict[int, Image.Image] = OrderedDict()
+
+    def page_image(self, page_num: int) -> Image.Image:
+        """Returns the rendered page, rasterizing it on first use."""
+        if page_num in self._pages:
+            self._pages.move_to_end(page_num)
+            return self._pages[page_num]
+
+        if self._pdoc is None:
+            self._pdoc = self.doc.to_pymupdf_doc()
+        pix = self._pdoc[page_num].get_pixmap(dpi=self.dpi)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+        self._pages[page_num] = img
+        if len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return img
+
+    def crop(self, bbox) -> Image.Image:
+        """Crops the region of `bbox` from its rendered page."""
+        img = self.page_image(bbox.page)
+        return img.crop(
+            (
+                int(bbox.x0 * self.scale),
+                int(bbox.y0 * self.scale),
+                int(bbox.x1 * self.scale),
+                int(bbox.y1 * self.scale),
+            )
+        )
+
+    def close(self):
+        """Releases the rendered pages and the PyMuPDF document."""
+        self._pages.clear()
+        if self._pdoc is not None:
+            self._pdoc.close()
+            self._pdoc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _to_png(img: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def extract_page_png(rasters: PageRasterCache, node):
+    """
+    Extract the full page image containing the specified node from the PDF.
+
+    Args:
+        rasters (PageRasterCache): The rendered pages of the PDF document
+        node (Node): The node used to identify the page
+
+    Returns:
+        bytes: PNG encoded full page image, or None if extraction fails
+    """
+    try:
+        # Check if node has bbox and elements
+        if not node.elements or not node.elements[0].bbox:
+            return None
+
+        return _to_png(rasters.page_image(node.elements[0].bbox.page))
+
+    except Exception as e:
+        print(f"Error extracting page image: {e}")
+        return None
+
+
+def extract_node_png(rasters: PageRasterCache, node):
+    """
+    Extract the image for a specific node using its bounding box from the PDF.
+
+    Args:
+        rasters (PageRasterCache): The rendered pages of the PDF document
+        node (Node): The node to extract the image for
+
+    Returns:
+        bytes: PNG encoded image of the node, or None if extraction fails
+    """
+    try:
+        # Check if node has bbox and elements
+        if not node.elements or not node.elements[0].bbox:
+            return None
+
+        return _to_png(rasters.crop(node.elements[0].bbox))
+
+    except Exception as e:
+        print(f"Error extracting node image: {e}")
+        return None
+
+
+def store_node_image(rasters: PageRasterCache, node, blob_store: BlobStore):
+    """
+    Stores the image of a node in the blob store.
+
+    Returns:
+        str: SHA-256 hash of the PNG image, or None if extraction fails
+    """
+    png = extract_node_png(rasters, node)
+    return blob_store.put(png) if png is not None else None
@@ -4,11 +4,14 @@ from pydantic import BaseModel, Field
 from typing import Literal
 from database import *
 from config import *
+from metadata_cache import MetadataCache, STATIC
 import os
 from langchain.chat_models import ChatOpenAI
 
 client = instructor.from_anthropic(anthropic.Anthropic())
 db = FinancialDatabase()
+# shared by all the indexer processes, hits skip the LLM call
+metadata_cache = MetadataCache()
 llm = ChatOpenAI(model="gpt-4o")
 
 class ListofKeyValues(BaseModel):
@@ -73,10 +76,17 @@ DOCUMENT_CONTEXT_PROMPT = """
 """
 
 
-def extract_static_metatdata(nodes: list):
+def extract_static_metatdata(nodes: list, fingerprint: str | None = None):
     """
     Extracts static metadata from the document.
+
+    If `fingerprint` (see `metadata_cache.document_fingerprint`) is given, the
+    metadata is read from / written to the shared metadata cache.
     """
+    cached = metadata_cache.get(fingerprint, STATIC)
+    if cached is not None and cached["company_name"] is not None:
+        return cached["type"], cached["company_name"], cached["year"], cached["quarter"]
+
     nodes_first_10_pages = []
     for node in nodes:
         if len(node.bbox) > 0 and node.bbox[0].page < 10:
@@ -136,12 +146,26 @@ def extract_static_metatdata(nodes: list):
     else:
         quarter = None
 
+    # a miss of the company may be fixed by a later run, it is not cached
+    if company_name is not None:
+        metadata_cache.put(
+            fingerprint,
+            STATIC,
+            {"type": type, "company_name": company_name, "year": year, "quarter": quarter},
+        )
     return type, company_name, year, quarter
 
-def extract_static_metadata_using_openai(nodes: list):
+def extract_static_metadata_using_openai(nodes: list, fingerprint: str | None = None):
     """
     Extracts static metadata from the document.
+
+    If `fingerprint` (see `metadata_cache.document_fingerprint`) is given, the
+    metadata is read from / written to the shared metadata cache.
     """
+    cached = metadata_cache.get(fingerprint, STATIC)
+    if cached is not None and cached["company_name"] is not None:
+        return cached["type"], cached["company_name"], cached["year"], cached["quarter"]
+
     nodes_first_10_pages = []
     for node in nodes:
         if len(node.bbox) > 0 and node.bbox[0].page < 10:
@@ -176,4 +200,11 @@ def extract_static_metadata_using_openai(nodes: list):
     else:
         quarter = None
 
+    # a miss of the company may be fixed by a later run, it is not cached
+    if company_name is not None:
+        metadata_cache.put(
+            fingerprint,
+            STATIC,
+            {"type": type, "company_name": company_name, "year": year, "quarter": quarter},
+        )
     return type, company_name, year, quarter
\ No newline at end of file
@@ -2,165 +2,36 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
 import logging
+import time
 from io import BytesIO
 import pathway as pw
 from pathway.udfs import DiskCache, ExponentialBackoffRetryStrategy
-from pathway.xpacks.llm import embedders, llms
+from pathway.xpacks.llm import llms
 from pathway.xpacks.llm.parsers import OpenParse
-from pathway.xpacks.llm.vector_store import VectorStoreServer
+from pathway.stdlib.indexing import BruteForceKnnFactory
+from pathway.xpacks.llm.document_store import DocumentStore
+from pathway.xpacks.llm.servers import DocumentStoreServer
 import openparse
 from pypdf import PdfReader
 from .static_metadata import *
 from .dynamic_metadata import *
-import voyageai
-import numpy as np
-import base64
-import io
-from PIL import Image
-from FlagEmbedding import BGEM3FlagModel
-import torch
+from .concurrency import get_rate_limiter, run_coroutine_sync
+from .page_raster import PageRasterCache, store_node_image
+from .batch_embedders import VoyageEmbedder, Bge_m3_embedder
+from .node_cache import NodeCache, node_hash
+from .ingest_stats import IngestStats, TimedOpenAIEmbedder, serve_ingest_stats
+from blob_store import BlobStore, serve_blobs
+from metadata_cache import document_fingerprint
 
 db = FinancialDatabase()
 db.reset_database()
+blob_store = BlobStore()
+node_cache = NodeCache()
+ingest_stats = IngestStats()
 
-class VoyageEmbedder(embedders.OpenAIEmbedder):
-    """Pathway wrapper for Voyage AI Embedding services."""
-    
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    async def __wrapped__(self, input, **kwargs) -> np.ndarray:
-        """Embed the documents
-
-        Args:
-            - input: mandatory, the string to embed.
-            - **kwargs: optional parameters, if unset defaults from the constructor
-              will be taken.
-        """
-        kwargs = {**self.kwargs, **kwargs}
-        vo = voyageai.Client(api_key=os.getenv("VOYAGE_API_KEY"))   
-        ret = vo.embed([input or "."], model="voyage-3", input_type="document")
-        return np.array(ret.embeddings[0])
-
-class Bge_m3_embedder(embedders.OpenAIEmbedder):
-    """
-    Custom Pathway embedder for BGE-M3 model with flexible embedding handling.
-    
-    Key Considerations:
-    - Ensures compatibility with Pathway's vector store
-    - Handles various input scenarios
-    - Provides flexible embedding output
-    """
-    
-    def __init__(self, 
-                 model_name='BAAI/bge-m3', 
-                 *args, 
-                 **kwargs):
-        """
-        Initialize the BGE-M3 embedder.
-        
-        Args:
-            model_name (str): Hugging Face model identifier
-            *args: Additional positional arguments for OpenAIEmbedder
-            **kwargs: Additional keyword arguments for OpenAIEmbedder
-        """
-        super().__init__(*args, **kwargs)
-        
-        # Load BGE-M3 model
-        self.bgem3_model = BGEM3FlagModel(
-            model_name,
-            use_fp16=torch.cuda.is_available()  # Use FP16 if CUDA available
-        )
-
-    async def __wrapped__(self, input, **kwargs) -> np.ndarray:
-        """
-        Embed input text with flexible handling.
-        
-        Args:
-            input (str): Text to embed
-            **kwargs: Additional embedding parameters
-        
-        Returns:
-            np.ndarray: Embedding vector
-        """
-        # Handle empty or whitespace inputs
-        if not input or input.isspace():
-            input = "."
-        
-        try:
-            # Encode input with dense vector return
-            embeddings_dict = self.bgem3_model.encode(
-                [input], 
-                return_dense=True
-            )
-            
-            # Extract dense vector and ensure correct type
-            embedding = embeddings_dict['dense_vecs'][0]
-            
-            # Convert to float32 numpy array
-            embedding_array = np.array(embedding, dtype=np.float32)
-            
-            return embedding_array
-        
-        except Exception as e:
-            print(f"Embedding error: {e}")
-            # Return None or raise the exception based on your error handling preference
-            raise
   
-def extract_node_image(doc, node):
-    """
-    Extract the image for a specific node using its bounding box from the PDF.
-    
-    Args:
-        doc (openparse.Pdf): The PDF document
-        node (Node): The node to extract the image for
-    
-    Returns:
-        str: Base64 encoded image of the node, or None if extraction fails
-    """
-    try:
-        # Convert to PyMuPDF document if not already done
-        pdoc = doc.to_pymupdf_doc()
-        
-        # Check if node has bbox and elements
-        if not node.elements or not node.elements[0].bbox:
-            return None
-        
-        # Get the page number from the first element's bbox
-        page_num = node.elements[0].bbox.page
-        
-        # Extract the full page
-        page = pdoc[page_num]
-        
-        # Get the bounding box coordinates
-        bbox = node.elements[0].bbox
-        
-        # Render full page as pixmap
-        pix = page.get_pixmap()
-        
-        # Convert to PIL Image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # Crop the image based on bbox
-        # Note: PyMuPDF and PIL might have slightly different coordinate systems
-        # Adjust coordinates if needed
-        cropped_img = img.crop((
-            int(bbox.x0), 
-            int(bbox.y0), 
-            int(bbox.x1), 
-            int(bbox.y1)
-        ))
-        
-        # Convert to base64
-        buffered = io.BytesIO()
-        cropped_img.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    except Exception as e:
-        print(f"Error extracting node image: {e}")
-        return None
-
 Whole_chunk = """You are a values extractor and describer
 You are given an image of a page from a 10-K document. You need to find out Table name, row name, column name, and the value of each and every cell in the each table(s)(if present) in the image and describe each and every value in the KeyValueSchema format.
 
@@ -211,25 +82,200 @@ If no table is present in the given image then return None object only. and if t
 """
 
 
+def make_chunk_metadata(
+    node,
+    type,
+    company_name,
+    year,
+    quarter,
+    topic,
+    item_10K,
+    is_table_value,
+    table,
+    image_hash,
+):
+    """
+    Builds the metadata attached to every chunk emitted by `CustomOpenParse`.
+    """
+    return {
+        "type": type,
+        "company_name": company_name,
+        "year": year,
+        "quarter": quarter,
+        "topic": topic,
+        "item_10K": item_10K,
+        "is_table_value": is_table_value,
+        "table": table,
+        "image_hash": image_hash,
+        "page_no": node.bbox[0].page if len(node.bbox) > 0 else -1,
+    }
+
+
+def node_image_hash(rasters, node, document):
+    """
+    Blob hash of the node image, rendered only for new or changed nodes.
+    `document` identifies the filing, e.g. (company, year, quarter).
+    """
+    key = node_hash(node, "image", *document)
+    cached = node_cache.get(key)
+    if cached is not None and blob_store.exists(cached["image_hash"]):
+        return cached["image_hash"]
+
+    image_hash = store_node_image(rasters, node, blob_store)
+    if image_hash is not None:
+        node_cache.put(key, {"image_hash": image_hash})
+    return image_hash
+
+
+_RESPONSE_SCHEMAS = {
+    schema.__name__: schema
+    for schema in (
+        TableValuesSchema,
+        FinanceDynamicMetadataSchema,
+        OtherDynamicMetadataSchema,
+    )
+}
+
+
+def dump_response(response) -> dict:
+    return {"schema": type(response).__name__, "data": response.model_dump()}
+
+
+def load_response(cached: dict):
+    return _RESPONSE_SCHEMAS[cached["schema"]].model_validate(cached["data"])
+
+
 class CustomOpenParse(OpenParse):
     """
     Custom OpenParse class with modified __wrapped__ behavior.
+
+    The succinct context of the chunks of a document is generated concurrently by
+    at most `max_workers` workers, with the requests to each provider rate limited
+    as per `CONTEXTUALIZATION_RATE_LIMITS`. Chunks are reassembled in document order.
+
+    Results are cached per node (text + bbox) in the `NodeCache`, so when a filing
+    is modified or downloaded again only its new or changed nodes are sent to the
+    LLM.
+
+    The time spent in each stage and the LLM retries and fallbacks of every
+    document are recorded in `ingest_stats`.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, max_workers: int = CONTEXTUALIZATION_WORKERS, **kwargs):
         super().__init__(*args, **kwargs)
+        self.max_workers = max_workers
+
+    async def _contextualize_nodes(self, doc, nodes, type, document, set_of_topics, trace):
+        """
+        Generates the succinct context of every node, returning the responses in
+        the order of `nodes`. A node whose retries run out gets `None`.
+
+        The context depends on the whole document, so the cache key of a node
+        includes `document`, the identity of its filing (company, year, quarter):
+        the same boilerplate chunk in another filing is not a hit.
+        """
+        semaphore = asyncio.Semaphore(self.max_workers)
+        rate_limiter = get_rate_limiter("anthropic")
+        is_finance = type == "10-K" or type == "10-Q" or type == "Finance"
+
+        async def contextualize(index, node):
+            # the chunk just before a table is passed along to situate the table
+            prev_node = nodes[index - 1] if index > 0 else None
+            is_table = is_finance and "table" in node.variant
+            key = node_hash(
+                node,
+                "context",
+                type,
+                *document,
+                prev_node.text if is_table and prev_node is not None else "",
+            )
+            cached = node_cache.get(key)
+            if cached is not None:
+                trace.count("node_cache_hits")
+                response = load_response(cached)
+                set_of_topics.add(response.topic)
+                return response
+
+            stage = "table_key_values" if is_table else "contextualization"
+            async with semaphore:
+                for retries in range(MAX_RETRIES_ANTHROPIC):
+                    await rate_limiter.acquire()
+                    start = time.monotonic()
+                    try:
+                        if is_table:
+                            response = await asyncio.to_thread(
+                                situate_context_finance_table,
+                                doc=doc,
+                                chunk=node.text,
+                                prev_chunk=prev_node,
+                                typetext="table",
+                                type=type,
+                            )
+                        elif is_finance:
+                            response = await asyncio.to_thread(
+                                situate_context_finance,
+                                doc=doc,
+                                chunk=node.text,
+                                typetext="text",
+                                type=type,
+                            )
+                        else:
+                            response = await asyncio.to_thread(
+                                situate_context_others,
+                                doc=doc,
+                                chunk=node.text,
+                                set_of_topics=set(set_of_topics),
+                            )
+                        response = response[0]
+                        trace.record(stage, time.monotonic() - start)
+                        set_of_topics.add(response.topic)
+                        node_cache.put(key, dump_response(response))
+                        return response
+                    except Exception as e:
+                        trace.record(stage, time.monotonic() - start)
+                        trace.count("llm_retries")
+                        if is_table:
+                            print(f"Error in extracting table values: {e}")
+                        else:
+                            print(f"Error in generating succinct context values: {e}")
+                        print(f"Retrying for the {retries+1} time.")
+                print(
+                    "Max retries reached. Skipping this chunk for succinct context generation."
+                )
+                return None
+
+        return await asyncio.gather(
+            *(contextualize(index, node) for index, node in enumerate(nodes))
+        )
 
     def __wrapped__(self, contents: bytes) -> list[tuple[str, dict]]:
+        with ingest_stats.document() as trace:
+            return self._parse(contents, trace)
 
-        reader = PdfReader(stream=BytesIO(contents))
-        doc = openparse.Pdf(file=reader)
+    def _parse(self, contents: bytes, trace) -> list[tuple[str, dict]]:
 
-        # Original document parsing with custom modifications
-        parsed_content = self.doc_parser.parse(doc)
-        nodes = list(parsed_content.nodes)
+        with trace.stage("pdf_parse"):
+            reader = PdfReader(stream=BytesIO(contents))
+            doc = openparse.Pdf(file=reader)
+
+            # Original document parsing with custom modifications
+            parsed_content = self.doc_parser.parse(doc)
+            nodes = list(parsed_content.nodes)
+        trace.count("nodes", len(nodes))
 
         # Extract the static metadata from the document
-        type, company_name, year, quarter = extract_static_metatdata(nodes)
+        with trace.stage("static_metadata"):
+            fingerprint = document_fingerprint(reader)
+            type, company_name, year, quarter = extract_static_metatdata(
+                nodes, fingerprint=fingerprint
+            )
+        trace.info.update(
+            fingerprint=fingerprint,
+            type=type,
+            company_name=company_name,
+            year=year,
+            quarter=quarter,
+        )
 
         # list for storing all the chunks with their metadata
         docs = []
@@ -241,220 +287,82 @@ class CustomOpenParse(OpenParse):
         key_val_docs = []
 
         # Extract the dynamic metadata from the document
-        if type == "10-K" or type == "10-Q" or type == "Finance":
-            prev_node = None
-            for node in nodes:
-                if "table" in node.variant:
-                    for retries in range(MAX_RETRIES_ANTHROPIC):
-                        try:
-                            response = situate_context_finance_table(
-                                doc=doc,
-                                chunk=node.text,
-                                prev_chunk=prev_node,
-                                typetext="table",
-                                type=type,
-                            )
-                            response = response[0]
-                            set_of_topics.add(response.topic)
-                            key_vals = [
-                                (
-                                    make_succinct_context_for_value(
-                                        company_name, year, type
-                                    )
-                                    + " "
-                                    + key_value,
-                                    {
-                                        "type": type,
-                                        "company_name": company_name,
-                                        "year": year,
-                                        "quarter": quarter,
-                                        "topic": response.topic,
-                                        "item_10K": response.item_10K,
-                                        "is_table_value": "True",
-                                        "table": "True",
-                                        "image": extract_node_image(doc, node),
-                                        "page_no": (
-                                            node.bbox[0].page
-                                            if len(node.bbox) > 0
-                                            else -1
-                                        ),
-                                    },
-                                )
-                                for key_value in response.listofstr
-                            ]
-                            key_val_docs.extend(key_vals)
-                            docs.append(
-                                (
-                                    response.succint_context + " " + node.text,
-                                    {
-                                        "type": type,
-                                        "company_name": company_name,
-                                        "year": year,
-                                        "quarter": quarter,
-                                        "topic": response.topic,
-                                        "item_10K": response.item_10K,
-                                        "is_table_value": "False",
-                                        "table": "True",
-                                        "image": extract_node_image(doc, node),
-                                        "page_no": (
-                                            node.bbox[0].page
-                                            if len(node.bbox) > 0
-                                            else -1
-                                        ),
-                                    },
-                                )
-                            )
-                            break
-                        except Exception as e:
-                            print(f"Error in extracting table values: {e}")
-                            print(f"Retrying for the {retries+1} time.")
-                            if retries == MAX_RETRIES_ANTHROPIC - 1:
-                                print(
-                                    "Max retries reached. Skipping this chunk for Succinct context extraction."
-                                )
-                                docs.append(
-                                    (
-                                        node.text,
-                                        {
-                                            "type": type,
-                                            "company_name": company_name,
-                                            "year": year,
-                                            "quarter": quarter,
-                                            "topic": "Other",
-                                            "item_10K": "Other",
-                                            "is_table_value": "False",
-                                            "table": "True",
-                                            "image": extract_node_image(doc, node),
-                                            "page_no": (
-                                                node.bbox[0].page
-                                                if len(node.bbox) > 0
-                                                else -1
-                                            ),
-                                        },
-                                    )
-                                )
-                                break
-                            continue
-                else:
-                    for retries in range(MAX_RETRIES_ANTHROPIC):
-                        try:
-                            response = situate_context_finance(
-                                doc=doc, chunk=node.text, typetext="text", type=type
-                            )
-                            response = response[0]
-                            set_of_topics.add(response.topic)
-                            docs.append(
-                                (
-                                    response.succint_context + " " + node.text,
-                                    {
-                                        "type": type,
-                                        "company_name": company_name,
-                                        "year": year,
-                                        "quarter": quarter,
-                                        "topic": response.topic,
-                                        "item_10K": response.item_10K,
-                                        "is_table_value": "False",
-                                        "table": "False",
-                                        "image": extract_node_image(doc, node),
-                                        "page_no": (
-                                            node.bbox[0].page
-                                            if len(node.bbox) > 0
-                                            else -1
-                                        ),
-                                    },
-                                )
-                            )
-                            break
-                        except Exception as e:
-                            print(f"Error in generating succinct context values: {e}")
-                            print(f"Retrying for the {retries+1} time.")
-                            if retries == MAX_RETRIES_ANTHROPIC - 1:
-                                print(
-                                    "Max retries reached. Skipping this chunk for succinct context generation."
-                                )
-                                docs.append(
-                                    (
-                                        node.text,
-                                        {
-                                            "type": type,
-                                            "company_name": company_name,
-                                            "year": year,
-                                            "quarter": quarter,
-                                            "topic": "Other",
-                                            "item_10K": "Other",
-                                            "is_table_value": "False",
-                                            "table": "False",
-                                            "image": extract_node_image(doc, node),
-                                            "page_no": (
-                                                node.bbox[0].page
-                                                if len(node.bbox) > 0
-                                                else -1
-                                            ),
-                                        },
-                                    )
-                                )
-                                break
-                            continue
-                prev_node = node
-        else:
-            for node in nodes:
-                for retries in range(MAX_RETRIES_ANTHROPIC):
-                    try:
-                        response = situate_context_others(
-                            doc=doc, chunk=node.text, set_of_topics=set_of_topics
+        # re-downloads and amendments of a filing share its identity, and hit
+        document = (company_name, year, quarter)
+        responses = run_coroutine_sync(
+            self._contextualize_nodes(doc, nodes, type, document, set_of_topics, trace)
+        )
+
+        is_finance = type == "10-K" or type == "10-Q" or type == "Finance"
+        # every page is rendered once, node images are cropped from it and
+        # written once to the blob store, chunks only carry the image hash
+        with PageRasterCache(doc) as rasters:
+            for node, response in zip(nodes, responses):
+                is_table = is_finance and "table" in node.variant
+                table = "True" if is_table else "False"
+                with trace.stage("image_crop"):
+                    image_hash = node_image_hash(rasters, node, document)
+                if response is None:
+                    # fall back to the raw text of the chunk
+                    trace.count("raw_text_fallbacks")
+                    docs.append(
+                        (
+                            node.text,
+                            make_chunk_metadata(
+                                node,
+                                type,
+                                company_name,
+                                year,
+                                quarter,
+                                topic="Other",
+                                item_10K="Other" if is_finance else None,
+                                is_table_value="False",
+                                table=table,
+                                image_hash=image_hash,
+                            ),
                         )
-                        response = response[0]
-                        set_of_topics.add(response.topic)
-                        docs.append(
-                            (
-                                response.succint_context + " " + node.text,
-                                {
-                                    "type": type,
-                                    "company_name": company_name,
-                                    "year": year,
-                                    "quarter": quarter,
-                                    "topic": response.topic,
-                                    "item_10K": None,
-                                    "is_table_value": "False",
-                                    "table": "False",
-                                    "image": extract_node_image(doc, node),
-                                    "page_no": (
-                                        node.bbox[0].page if len(node.bbox) > 0 else -1
-                                    ),
-                                },
-                            )
+                    )
+                    continue
+
+                item_10K = response.item_10K if is_finance else None
+                if is_table:
+                    key_val_docs.extend(
+                        (
+                            make_succinct_context_for_value(company_name, year, type)
+                            + " "
+                            + key_value,
+                            make_chunk_metadata(
+                                node,
+                                type,
+                                company_name,
+                                year,
+                                quarter,
+                                topic=response.topic,
+                                item_10K=item_10K,
+                                is_table_value="True",
+                                table="True",
+                                image_hash=image_hash,
+                            ),
                         )
-                        break
-                    except Exception as e:
-                        print(f"Error in generating succinct context values: {e}")
-                        print(f"Retrying for the {retries+1} time.")
-                        if retries == MAX_RETRIES_ANTHROPIC - 1:
-                            print(
-                                "Max retries reached. Skipping this chunk for succinct context generation."
-                            )
-                            docs.append(
-                                (
-                                    node.text,
-                                    {
-                                        "type": type,
-                                        "company_name": company_name,
-                                        "year": year,
-                                        "quarter": quarter,
-                                        "topic": "Other",
-                                        "item_10K": None,
-                                        "is_table_value": "False",
-                                        "table": "False",
-                                        "image": extract_node_image(doc, node),
-                                        "page_no": (
-                                            node.bbox[0].page
-                                            if len(node.bbox) > 0
-                                            else -1
-                                        ),
-                                    },
-                                )
-                            )
-                            break
-                        continue
+                        for key_value in response.listofstr
+                    )
+                docs.append(
+                    (
+                        response.succint_context + " " + node.text,
+                        make_chunk_metadata(
+                            node,
+                            type,
+                            company_name,
+                            year,
+                            quarter,
+                            topic=response.topic,
+                            item_10K=item_10K,
+                            is_table_value="False",
+                            table=table,
+                            image_hash=image_hash,
+                        ),
+                    )
+                )
 
         # write to database, if error occurs then just move on
         report = {
@@ -475,6 +383,8 @@ class CustomOpenParse(OpenParse):
 
         # concat docs with key_val_docs
         docs.extend(key_val_docs)
+        trace.count("table_key_values", len(key_val_docs))
+        trace.count("chunks", len(docs))
 
         # COMMENT OUT TO SEE THE CHUNKS IN A SEPERATE JSON FILE
 
@@ -489,7 +399,6 @@ class CustomOpenParse(OpenParse):
 
         return docs
 
-
 # -------------------------------------------------
 
 folder = pw.io.fs.read(
@@ -498,7 +407,7 @@ folder = pw.io.fs.read(
     with_metadata=True,
 )
 # define the inputs (local folders & files, google drive, sharepoint, ...)
-sources = [folder]
+sources = [ingest_stats.track_queued(folder)]
 
 vision_llm = llms.OpenAIChat(
     model="gpt-4o-mini",
@@ -536,8 +445,9 @@ parser = CustomOpenParse(
     parse_images=False,
     cache_strategy=DiskCache(),
 )
-openai_embedder = embedders.OpenAIEmbedder(
-    cache_strategy=DiskCache()
+openai_embedder = TimedOpenAIEmbedder(
+    cache_strategy=DiskCache(),
+    stats=ingest_stats,
     )
 voyage_embedder = VoyageEmbedder(
     cache_strategy=DiskCache()
@@ -545,6 +455,8 @@ voyage_embedder = VoyageEmbedder(
 bgem3_embedder = Bge_m3_embedder(
     cache_strategy=DiskCache()
 )
+ingest_stats.add_embedder("voyage", voyage_embedder)
+ingest_stats.add_embedder("bge-m3", bgem3_embedder)
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -552,15 +464,28 @@ if __name__ == "__main__":
         format="%(asctime)s %(name)s %(levelname)s %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    doc_store = VectorStoreServer(
+    knn_index = BruteForceKnnFactory(
+        reserved_space=1000,
+        embedder=openai_embedder,  # (or voyage_embedder or bgem3_embedder) as per the requirement
+        metric=pw.engine.BruteForceKnnMetricKind.COS,
+    )
+    doc_store = DocumentStore(
         *sources,
-        embedder=openai_embedder, # (or voyage_embedder or bgem3_embedder) as per the requirement
+        retriever_factory=knn_index,
         splitter=None,  # OpenParse parser handles the chunking
         parser=parser,
     )
-    doc_store.run_server(
-        VECTOR_STORE_HOST,
-        5000,
+    ingest_stats.track_index(doc_store)
+    server = DocumentStoreServer(
+        host=VECTOR_STORE_HOST,
+        port=5000,
+        document_store=doc_store,
+    )
+    # chunk images are fetched lazily by their hash
+    serve_blobs(server, blob_store)
+    # per-stage ingestion timings, next to /v1/statistics
+    serve_ingest_stats(server, ingest_stats)
+    server.run(
         # threaded=True,
         with_cache=True,
         cache_backend=pw.persistence.Backend.filesystem("./Cache-keyval-str"),
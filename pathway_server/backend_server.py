@@ -10,6 +10,8 @@ import asyncio
 from server.database import engine
 from server import models
 from server.routes import chat_router, file_router, ws_router, space_router
+from llm import llm
+from retriever import retriever, cache_retriever
 
 from fastapi.websockets import WebSocket, WebSocketDisconnect
 
@@ -140,6 +142,26 @@ async def websocket_endpoint(websocket: WebSocket):
         graph_clients.remove(websocket)
 
 
+@app.get("/llm/providers")
+async def llm_providers():
+    """Health of the LLM providers and state of their circuit breakers."""
+    return llm.provider_stats()
+
+
+@app.get("/llm/cache")
+async def llm_cache():
+    """Hit rates of the cached LLM chains in this process."""
+    return llm.cache_stats()
+
+
+@app.get("/retriever/cache")
+async def retriever_cache():
+    """Hit rates of the retrieval result caches in this process."""
+    return {
+        "retriever": retriever.cache_stats(),
+        "cache_retriever": cache_retriever.cache_stats(),
+    }
+
 # Include routers
 app.include_router(chat_router)
 app.include_router(file_router)
@@ -0,0 +1,117 @@
+import functools
+
+import pathway as pw
+from pathway.internals import dtype as dt
+
+import config
+
+
+class RetrieveBatchQuerySchema(pw.Schema):
+    queries: pw.Json = pw.column_definition(
+        description="List of /v1/retrieve queries: {query, k, metadata_filter, ...}",
+        example=[
+            {"query": "Revenue of Apple in 2022", "k": 5},
+            {
+                "query": "Revenue of Apple in 2022",
+                "k": 2,
+                "metadata_filter": "table == `True`",
+            },
+        ],
+    )
+
+
+@pw.udf
+def _batch_items(queries: pw.Json) -> list[tuple[int, pw.Json]]:
+    items = queries.value if isinstance(queries.value, list) else []
+    return [
+        (
+            position,
+            pw.Json(
+                {
+                    **item,
+                    "query": str(item.get("query") or ""),
+                    "k": int(item.get("k") or config.NUM_DOCS_TO_RETRIEVE),
+                }
+            ),
+        )
+        for position, item in enumerate(items)
+        if isinstance(item, dict)
+    ]
+
+
+def _item_field(item: pw.Json, name: str, is_float: bool):
+    value = item.value.get(name)
+    if is_float and value is not None:
+        return float(value)
+    return value
+
+
+@pw.udf
+def _group_results(positions: tuple, results: tuple) -> pw.Json:
+    return pw.Json(
+        [result.value for _, result in sorted(zip(positions, results), key=lambda x: x[0])]
+    )
+
+
+def retrieve_batch_query(
+    document_store, batch_queries: pw.Table[RetrieveBatchQuerySchema]
+) -> pw.Table:
+    """
+    Answers a list of retrieval queries at once: the queries of all the requests
+    are flattened into one `retrieve_query` call, so the document store embeds
+    and searches them together, and the results are grouped back per request in
+    the order of its queries.
+
+    Every item accepts the fields of `document_store.RetrieveQuerySchema`.
+    """
+    items = batch_queries.select(
+        batch_id=pw.this.id, item=_batch_items(pw.this.queries)
+    ).flatten(pw.this.item)
+    items = items.select(
+        pw.this.batch_id, position=pw.this.item[0], item=pw.this.item[1]
+    )
+
+    columns = document_store.RetrieveQuerySchema.columns()
+    queries = items.select(
+        **{
+            name: pw.apply_with_type(
+                functools.partial(
+                    _item_field,
+                    name=name,
+                    is_float=dt.unoptionalize(column.dtype) == dt.FLOAT,
+                ),
+                column.dtype,
+                pw.this.item,
+            )
+            for name, column in columns.items()
+        }
+    )
+    results = document_store.retrieve_query(queries)
+
+    grouped = (
+        items.join(results, pw.left.id == pw.right.id)
+        .select(pw.left.batch_id, pw.left.position, pw.right.result)
+        .groupby(pw.this.batch_id, id=pw.this.batch_id)
+        .reduce(
+            result=_group_results(
+                pw.reducers.tuple(pw.this.position), pw.reducers.tuple(pw.this.result)
+            )
+        )
+    )
+    # requests without any valid query get an empty list
+    return batch_queries.join_left(grouped, pw.left.id == pw.right.id, id=pw.left.id).select(
+        result=pw.coalesce(pw.right.result, pw.Json([]))
+    )
+
+
+def serve_retrieve_batch(server, document_store, route: str = "/v1/retrieve_batch"):
+    """
+    Adds a `/v1/retrieve_batch` endpoint to a `DocumentStoreServer`. It takes
+    `{"queries": [{"query": .., "k": .., "metadata_filter": ..}, ...]}` and returns
+    one list of results per query, in order.
+    """
+    server.serve(
+        route,
+        RetrieveBatchQuerySchema,
+        functools.partial(retrieve_batch_query, document_store),
+    )
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from aiohttp import web
+
+import config
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class BlobStore:
+    """
+    Content-addressed on-disk store for binary blobs (chunk images).
+
+    Every blob is written once under its SHA-256 hash, so chunks sharing an image
+    (e.g. a table and all of its key-value chunks) share one file. The layout is
+    `<root>/<first two hex chars>/<hash>`.
+    """
+
+    def __init__(self, root: str = config.BLOB_STORE_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_hash: str) -> str:
+        if not _HASH_PATTERN.match(blob_hash):
+            raise ValueError(f"Invalid blob hash: {blob_hash}")
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def put(self, data: bytes) -> str:
+        """Stores `data` if not present yet and returns its hash."""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        if os.path.exists(path):
+            return blob_hash
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_hash
+
+    def get(self, blob_hash: str) -> bytes | None:
+        try:
+            with open(self.path(blob_hash), "rb") as f:
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def exists(self, blob_hash: str) -> bool:
+        try:
+            return os.path.exists(self.path(blob_hash))
+        except ValueError:
+            return False
+
+
+def serve_blobs(server, blob_store: BlobStore, route: str = "/v1/blob/{hash}"):
+    """
+    Adds a `GET /v1/blob/{hash}` endpoint to a `DocumentStoreServer`, returning
+    the raw blob. Blobs are immutable, so responses are cacheable forever.
+    """
+
+    async def handle_blob(request: web.Request) -> web.StreamResponse:
+        try:
+            path = blob_store.path(request.match_info["hash"])
+        except ValueError:
+            raise web.HTTPBadRequest(reason="Invalid blob hash")
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+
+        with open(path, "rb") as f:
+            is_png = f.read(len(_PNG_SIGNATURE)) == _PNG_SIGNATURE
+        return web.FileResponse(
+            path,
+            headers={
+                "Content-Type": "image/png" if is_png else "application/octet-stream",
+                "Cache-Control": "public, max-age=31536000, immutable",
+            },
+        )
+
+    server.webserver._add_endpoint_to_app("GET", route, handle_blob)
@@ -8,6 +8,16 @@ BASE_DATA_DIRECTORY = "MultiData/base_data"
 VECTOR_STORE_HOST = "127.0.0.1"
 VECTOR_STORE_PORT = 7000
 VECTOR_STORE_TIMEOUT = 30
+# Max open (keep-alive) connections of each vector store client
+VECTOR_STORE_POOL_SIZE = 32
+# In-process cache of the retrieval results of each vector store client, cleared
+# when the `/v1/statistics` of the server (checked at most every
+# RETRIEVAL_CACHE_VERSION_CHECK_S seconds) show that its index changed
+RETRIEVAL_CACHE_SIZE = 1024
+RETRIEVAL_CACHE_TTL_S = 300
+RETRIEVAL_CACHE_VERSION_CHECK_S = 5
+# Set to True to always query the server, e.g. in evaluation runs
+RETRIEVAL_CACHE_BYPASS = False
 
 FAST_VECTOR_STORE_HOST = "127.0.0.1"
 FAST_VECTOR_STORE_PORT = 7000
@@ -27,11 +37,115 @@ SLOW2_VECTOR_STORE_TIMEOUT = 10
 SLOW2_VECTOR_STORE_DATA_DIR = "MultiData/server2_data"
 SLOW2_VECTOR_STORE_CACHE_DIR = "MultiCache/server2_cache"
 
+# server_manager.py: links the new files of BASE_DATA_DIRECTORY to the servers as
+# soon as they stop changing for SERVER_MANAGER_DEBOUNCE_S seconds, and serves its
+# progress at http://SERVER_MANAGER_HOST:SERVER_MANAGER_PORT/status
+SERVER_MANAGER_HOST = "127.0.0.1"
+SERVER_MANAGER_PORT = 8090
+SERVER_MANAGER_DEBOUNCE_S = 1
+
 CACHE_STORE_HOST = "127.0.0.1"
 CACHE_STORE_PORT = 8010
 
 MULTI_SERVER_HOST = "127.0.0.1"
 MULTI_SERVER_PORT = 8080
+# The multi server proxy probes its replicas in the background every
+# MULTI_SERVER_HEALTH_INTERVAL_S seconds, and sends each request to the healthy
+# replica with the fewest requests in flight ("least_outstanding") or the lowest
+# latency EWMA weighted by its requests in flight ("ewma")
+MULTI_SERVER_HEALTH_INTERVAL_S = 2
+MULTI_SERVER_HEALTH_TIMEOUT_S = 2
+MULTI_SERVER_BALANCING = "least_outstanding"
+MULTI_SERVER_EWMA_ALPHA = 0.2
+# CustomPathwayVectorStoreClient (multiserver_retriever.py) queries all its healthy
+# servers at once, with health probed in the background. With hedging, it queries
+# the fastest server only, and a second one if the first takes longer than its
+# RETRIEVER_HEDGE_PERCENTILE latency over the last RETRIEVER_LATENCY_WINDOW queries
+RETRIEVER_HEALTH_INTERVAL_S = 5
+RETRIEVER_HEDGING = False
+RETRIEVER_HEDGE_PERCENTILE = 95
+RETRIEVER_HEDGE_MIN_SAMPLES = 20
+RETRIEVER_LATENCY_WINDOW = 200
+
+# Sharded deployment (run_sharded_server.py): the chunks are partitioned over
+# NUM_SHARDS document store servers, on ports SHARD_BASE_PORT + i, by a hash of
+# their company_name, and a router on the vector store port sends every query to
+# the shards its company filter can match
+NUM_SHARDS = 4
+SHARD_HOST = "127.0.0.1"
+SHARD_BASE_PORT = 7100
+SHARD_CACHE_DIR = "ShardCache"
+
+# Index of the document stores: "brute_force" (exact KNN), "usearch" (HNSW KNN),
+# "quantized" (exact KNN over quantized vectors, see quantized_index.py) or "hybrid"
+# (BM25 + KNN fused with reciprocal rank fusion). The main store always keeps a BM25
+# index next to its KNN one (see RETRIEVAL_MODE), so there it picks the KNN
+VECTOR_INDEX_TYPE = "usearch"
+FAST_VECTOR_INDEX_TYPE = "hybrid"
+CACHE_VECTOR_INDEX_TYPE = "brute_force"
+# KNN index used inside the hybrid index ("brute_force", "usearch" or "quantized")
+HYBRID_KNN_INDEX_TYPE = "usearch"
+VECTOR_INDEX_DIMENSIONS = 1536
+# Initial capacity of the KNN indices, they grow as needed
+VECTOR_INDEX_RESERVED_SPACE = 1000
+# HNSW parameters: max edges per node (M), and the candidate list sizes used
+# while adding (ef_construction) and searching (ef). Tune with experiments/ann_benchmark.py
+USEARCH_CONNECTIVITY = 16
+USEARCH_EXPANSION_ADD = 128
+USEARCH_EXPANSION_SEARCH = 64
+BM25_RAM_BUDGET = 5000 * 1024 * 1024
+# Storage of the "quantized" index: "fp16" or "int8" (per-vector scale). The best
+# QUANTIZED_RESCORE_FACTOR * k candidates are re-scored with the float32 vectors,
+# kept on disk under QUANTIZED_INDEX_DIR
+VECTOR_QUANTIZATION = "int8"
+QUANTIZED_RESCORE_FACTOR = 4
+QUANTIZED_INDEX_DIR = "QuantizedIndex"
+# Metadata fields of the chunks kept in an inverted index by the quantized
+# index, so the equality / contains / globmatch conjuncts of a metadata_filter
+# select the rows to score before any vector is read
+METADATA_INDEX_FIELDS = (
+    "company_name",
+    "year",
+    "type",
+    "table",
+    "is_table_value",
+    "topic",
+    "path",
+)
+
+# Default retrieval mode of the main document store: "knn", "bm25" or "hybrid"
+# (BM25 + KNN fused with weighted reciprocal rank fusion). Can be set per request
+RETRIEVAL_MODE = "hybrid"
+HYBRID_FUSION_WEIGHTS = {
+    "knn": 0.5,
+    "bm25": 0.5,
+}
+# Constant of the reciprocal rank fusion, weight / (k + rank)
+HYBRID_RRF_K = 60
+# Candidates fetched from each index per requested document before the fusion
+HYBRID_CANDIDATES_FACTOR = 3
+
+# Content-addressed store of the chunk images, shared by all the indexers
+BLOB_STORE_DIR = "BlobStore"
+# Per-node ingestion results (contextualization, image hash) reused when a filing is re-ingested
+NODE_CACHE_PATH = "node_cache.db"
+# Static metadata of the documents shared by all the indexers, keyed by a fingerprint
+# of the text of their first pages (pre-seed with `python metadata_cache.py data/`),
+# as many as `extract_static_metatdata` sends to the LLM
+METADATA_CACHE_PATH = "metadata_cache.db"
+METADATA_FINGERPRINT_PAGES = 10
+# Embeddings shared by all the servers (main, fast, multi server and cache store),
+# keyed by model and whitespace-normalized text, with the most recent
+# EMBEDDING_CACHE_HOT_SIZE of each process kept in memory
+EMBEDDING_CACHE_PATH = "embedding_cache.db"
+EMBEDDING_CACHE_HOT_SIZE = 4096
+# Model of the OpenAI embedders of the servers
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+# Snapshots of the parsed documents and their embeddings exported by the replicas
+# at GET /v1/snapshot; the multi server replicas start from WARM_START_SNAPSHOT
+# (fetched with `python snapshot.py <replica url> <path>`) when it is set
+SNAPSHOT_DIR = "Snapshots"
+WARM_START_SNAPSHOT = None
 
 # Depth of decomposer
 DECOMPOSER_DEPTH = 3
@@ -44,6 +158,34 @@ NUM_DOCS_TO_RETRIEVE_KV = 30
 # Number of retries for anthropic
 MAX_RETRIES_ANTHROPIC = 5
 
+# Number of chunks of a document contextualized concurrently during indexing
+CONTEXTUALIZATION_WORKERS = 8
+# Max requests per minute sent to each provider while contextualizing chunks (None = no limit)
+CONTEXTUALIZATION_RATE_LIMITS = {
+    "anthropic": 50,
+    "openai": 500,
+}
+
+# Resolution at which PDF pages are rendered for chunk images during indexing
+PAGE_RASTER_DPI = 72
+# Number of rendered pages of a document kept in memory while indexing it
+PAGE_RASTER_CACHE_PAGES = 16
+
+# Micro-batching of the Voyage / BGE-M3 embedders: max texts per batch and max
+# time (ms) a text waits for its batch to fill up
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_WAIT_MS = 10
+# Log the batching stats every N batches (0 = never)
+EMBEDDING_STATS_LOG_INTERVAL = 100
+
+# Per-document ingestion timings and counters of the indexers, served at
+# /v1/ingest_stats and appended to a JSONL file rotated at INGEST_STATS_MAX_BYTES
+INGEST_STATS_PATH = "logs/ingest_stats.jsonl"
+INGEST_STATS_MAX_BYTES = 10 * 1024 * 1024
+INGEST_STATS_BACKUPS = 5
+# Number of ingested documents listed by /v1/ingest_stats
+INGEST_STATS_RECENT_DOCUMENTS = 50
+
 # Number of previous messages to consider for conversational awareness
 NUM_PREV_MESSAGES = 5
 
@@ -83,7 +225,47 @@ MAX_RETRIES = 3
 # Max number of questions that the query clarifier should ask
 MAX_QUESTIONS_TO_ASK = 3
 
+# Routing of the LLM calls between the providers (llm/custom_llm.py).
+# "preferred" tries the selected provider first while its circuit is closed and
+# the others by health, "latency" orders them all by health: EWMA latency,
+# inflated by the error rate of the last LLM_ROUTER_WINDOW calls
+LLM_ROUTING = "preferred"
+LLM_ROUTER_EWMA_ALPHA = 0.2
+LLM_ROUTER_WINDOW = 50
+LLM_ROUTER_ERROR_PENALTY = 4
+# The circuit of a provider opens after LLM_CIRCUIT_FAILURES consecutive failures,
+# and lets a single probe call through after LLM_CIRCUIT_OPEN_S seconds
+LLM_CIRCUIT_FAILURES = 3
+LLM_CIRCUIT_OPEN_S = 30
+# Backoff before retrying a provider after an error that is not a 429 / 5xx
+# (those go to the next provider at once), doubled at every retry
+LLM_RETRY_BACKOFF_S = 0.5
+# Nodes whose LLM call is hedged: if the provider has not answered within the
+# budget (seconds), the request is also sent to the next healthy provider
+LLM_HEDGE_BUDGETS_S = {
+    "split_path_decider_1": 3.0,
+    "check_safety": 3.0,
+    "check_context": 3.0,
+}
+# Exact-match cache of the LLM responses of the chains enabled in LLM_CACHE_CHAINS
+# (see `LLM.cached`), shared by all the processes; entries expire after
+# LLM_CACHE_TTL_S and the least recently used are evicted past LLM_CACHE_MAX_MB
+LLM_CACHE_PATH = "llm_cache.db"
+LLM_CACHE_MAX_MB = 256
+LLM_CACHE_TTL_S = 7 * 24 * 3600
+LLM_CACHE_CHAINS = {
+    "metadata_extractor_qq": True,
+    "qq_classifier": True,
+    "query_path_decider": True,
+    "query_safety_checker": True,
+    "cache_answer": True,
+    "company_name_and_year_extractor": True,
+    "value_llm": True,
+}
+
 # Simulate Errors for fallback testing
+# For the LLM providers, True always fails and a number in (0, 1) fails that
+# fraction of the calls; the failures go through the provider router
 SIMULATE_ERRORS = {
     "openai": False,
     "anthropic": False,
@@ -126,6 +308,7 @@ WORKFLOW_SETTINGS = {
     "field_to_ignore_from_metadata_for_generation": [
         "created_at",
         "image",
+        "image_hash",
         "is_table_value",
         "item_10K",
         "modified_at",
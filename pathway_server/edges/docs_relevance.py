@@ -1,7 +1,23 @@
 import state, config, nodes
+from retriever import retrieval_mode_stats
 from utils import log_message
 
 
+def served_retrieval_mode(state: state.InternalRAGState) -> str | None:
+    """
+    Retrieval mode applied to the documents of the question, as stamped by a
+    `HybridDocumentStore`. None if they come from a store that ignores the mode.
+    """
+    documents = (state.get("documents") or []) + (
+        state.get("documents_after_metadata_filter") or []
+    )
+    for document in documents:
+        retrieval_mode = (document.metadata or {}).get("retrieval_mode")
+        if retrieval_mode:
+            return retrieval_mode
+    return None
+
+
 def assess_graded_documents(state: state.InternalRAGState):
     """
     Determines whether to generate an answer, or re-generate a question.
@@ -16,14 +32,26 @@ def assess_graded_documents(state: state.InternalRAGState):
         f"question_group{question_group_id}",
     )
 
+    # grade_documents has already counted the current grading
+    doc_grading_retries = state.get("doc_grading_retries", 0)
+    retrieval_mode = served_retrieval_mode(state)
+
     if len(filtered_documents) >= config.DOCS_RELEVANCE_THRESHOLD:
         # We have enough relevant documents
+        if retrieval_mode is not None:
+            retrieval_mode_stats.record(
+                retrieval_mode,
+                "first_try" if doc_grading_retries <= 1 else "after_rewrite",
+            )
+        log_message(
+            f"------RETRIEVAL STATS: {retrieval_mode_stats.summary()}------",
+            f"question_group{question_group_id}",
+        )
         return "enough_relevant_docs"
 
     # Enough documents are not relevant
     # We will re-generate a new query if we have not done so already (at least 3 times)
     # otherwise, we will call web search
-    doc_grading_retries = state.get("doc_grading_retries", 0)
     log_message(
         "-----doc_grading_retries: " + str(doc_grading_retries),
         f"question_group{question_group_id}",
@@ -33,10 +61,18 @@ def assess_graded_documents(state: state.InternalRAGState):
         log_message(
             "------CALLING WEB SEARCH------", f"question_group{question_group_id}"
         )
+        if retrieval_mode is not None:
+            retrieval_mode_stats.record(retrieval_mode, "too_many_retries")
+        log_message(
+            f"------RETRIEVAL STATS: {retrieval_mode_stats.summary()}------",
+            f"question_group{question_group_id}",
+        )
         return "too_many_retries"
     else:
         log_message(
             "------TRANSFORMING QUERY USING REWRITE AND HYDE------",
             f"question_group{question_group_id}",
         )
+        if retrieval_mode is not None:
+            retrieval_mode_stats.record(retrieval_mode, "rewrites")
         return "retry"
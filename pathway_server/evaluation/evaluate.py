@@ -17,6 +17,7 @@ def evaluate(
     metadata: Optional[Dict[str, str]] = None,
     limit: Optional[int] = None,
     dataset_reps: int = 1,
+    bypass_retrieval_cache: bool = True,
     **kwargs,
 ):
     if not workflow_name:
@@ -26,6 +27,9 @@ def evaluate(
     if not metadata:
         metadata = {}
 
+    # cached retrievals would skew the quality and latency measurements
+    config.RETRIEVAL_CACHE_BYPASS = bypass_retrieval_cache
+
     client = Client()
 
     return langsmith_evaluate(
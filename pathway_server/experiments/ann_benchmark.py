@@ -0,0 +1,212 @@
+"""
+Benchmark of the KNN indices selectable with `VECTOR_INDEX_TYPE`.
+
+Builds a brute force index, USearch HNSW indices (one per M/ef setting) and the
+fp16/int8 quantized indices over a fixed set of embeddings and reports, for each of them, recall@k against brute
+force, p50/p99 query latency, build time and memory.
+
+The embeddings are computed once from the PDFs under `data/` (page text split in
+chunks, embedded with the same OpenAI model as the document stores) and saved to
+`--embeddings`, so later runs compare the indices over exactly the same vectors.
+`--synthetic N` benchmarks N random unit vectors instead, to test corpus sizes we
+do not have on disk yet.
+
+The Pathway indices run the same USearch library, so the trends carry over to the
+servers. The hybrid index is not benchmarked separately: its KNN half is one of
+the indices below and BM25 results are not comparable to a KNN ground truth.
+
+Usage:
+    python -m experiments.ann_benchmark --data-dir data --k 5 --M 16 32 --ef 32 64 128
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from pypdf import PdfReader
+from usearch.index import Index
+
+import config
+from quantized_index import QUANTIZATIONS, QuantizedVectorStore
+
+
+def load_chunks(data_dir: str, chunk_size: int = 1000) -> list[str]:
+    chunks = []
+    for root, _, files in os.walk(data_dir):
+        for file in sorted(files):
+            if not file.lower().endswith(".pdf"):
+                continue
+            reader = PdfReader(os.path.join(root, file))
+            for page in reader.pages:
+                text = page.extract_text() or ""
+                for i in range(0, len(text), chunk_size):
+                    chunk = text[i : i + chunk_size].strip()
+                    if chunk:
+                        chunks.append(chunk)
+    return chunks
+
+
+def embed_chunks(chunks: list[str], batch_size: int = 256) -> np.ndarray:
+    from openai import OpenAI
+
+    client = OpenAI()
+    embeddings = []
+    for i in range(0, len(chunks), batch_size):
+        response = client.embeddings.create(
+            input=chunks[i : i + batch_size], model="text-embedding-ada-002"
+        )
+        embeddings.extend(item.embedding for item in response.data)
+    return np.array(embeddings, dtype=np.float32)
+
+
+def load_embeddings(args) -> np.ndarray:
+    if args.synthetic:
+        rng = np.random.default_rng(args.seed)
+        vectors = rng.standard_normal(
+            (args.synthetic, config.VECTOR_INDEX_DIMENSIONS), dtype=np.float32
+        )
+    elif os.path.exists(args.embeddings):
+        vectors = np.load(args.embeddings)
+    else:
+        chunks = load_chunks(args.data_dir)
+        print(f"Embedding {len(chunks)} chunks from {args.data_dir}")
+        vectors = embed_chunks(chunks)
+        np.save(args.embeddings, vectors)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def percentile_ms(latencies: list[float], q: float) -> float:
+    return float(np.percentile(latencies, q) * 1000)
+
+
+def bench_brute_force(corpus: np.ndarray, queries: np.ndarray, k: int):
+    start = time.perf_counter()
+    matrix = np.ascontiguousarray(corpus)
+    build_time = time.perf_counter() - start
+
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = matrix @ query
+        top = np.argpartition(-scores, k)[:k]
+        results.append(set(top[np.argsort(-scores[top])].tolist()))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies, build_time, matrix.nbytes
+
+
+def bench_usearch(corpus, queries, k: int, connectivity: int, expansion_search: int):
+    index = Index(
+        ndim=corpus.shape[1],
+        metric="cos",
+        dtype="f32",
+        connectivity=connectivity,
+        expansion_add=config.USEARCH_EXPANSION_ADD,
+        expansion_search=expansion_search,
+    )
+    start = time.perf_counter()
+    index.add(np.arange(len(corpus)), corpus)
+    build_time = time.perf_counter() - start
+
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        matches = index.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        results.append(set(int(key) for key in matches.keys))
+    return results, latencies, build_time, index.memory_usage
+
+
+def bench_quantized(corpus, queries, k: int, quantization: str):
+    store = QuantizedVectorStore(
+        corpus.shape[1], quantization=quantization, reserved_space=len(corpus)
+    )
+    start = time.perf_counter()
+    for i, vector in enumerate(corpus):
+        store.add(i, vector)
+    build_time = time.perf_counter() - start
+
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        matches = store.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        results.append(set(key for key, _ in matches))
+    return results, latencies, build_time, store.memory_stats()["quantized_bytes"]
+
+
+def recall(results, ground_truth, k: int) -> float:
+    return float(
+        np.mean([len(r & gt) / k for r, gt in zip(results, ground_truth)])
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--embeddings", default="ann_benchmark_embeddings.npy")
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=config.NUM_DOCS_TO_RETRIEVE)
+    parser.add_argument("--M", type=int, nargs="+", default=[config.USEARCH_CONNECTIVITY])
+    parser.add_argument("--ef", type=int, nargs="+", default=[config.USEARCH_EXPANSION_SEARCH])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = load_embeddings(args)
+    # held out vectors are the queries, so that no query is in the corpus
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    num_queries = min(args.queries, len(vectors) // 10)
+    queries = vectors[order[:num_queries]]
+    corpus = vectors[order[num_queries:]]
+    print(f"{len(corpus)} vectors, {num_queries} queries, k={args.k}\n")
+
+    rows = []
+    ground_truth, latencies, build_time, memory = bench_brute_force(corpus, queries, args.k)
+    rows.append(("brute_force", 1.0, latencies, build_time, memory))
+
+    for connectivity in args.M:
+        for expansion_search in args.ef:
+            results, latencies, build_time, memory = bench_usearch(
+                corpus, queries, args.k, connectivity, expansion_search
+            )
+            rows.append(
+                (
+                    f"usearch M={connectivity} ef={expansion_search}",
+                    recall(results, ground_truth, args.k),
+                    latencies,
+                    build_time,
+                    memory,
+                )
+            )
+
+    for quantization in QUANTIZATIONS:
+        results, latencies, build_time, memory = bench_quantized(
+            corpus, queries, args.k, quantization
+        )
+        rows.append(
+            (
+                f"quantized {quantization}",
+                recall(results, ground_truth, args.k),
+                latencies,
+                build_time,
+                memory,
+            )
+        )
+
+    print(
+        f"{'index':<28}{'recall@k':>10}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'build s':>10}{'memory MB':>12}"
+    )
+    for name, rec, latencies, build_time, memory in rows:
+        print(
+            f"{name:<28}{rec:>10.3f}{percentile_ms(latencies, 50):>10.3f}"
+            f"{percentile_ms(latencies, 99):>10.3f}{build_time:>10.2f}"
+            f"{memory / 1024 / 1024:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
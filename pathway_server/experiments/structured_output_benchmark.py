@@ -0,0 +1,65 @@
+"""
+Microbenchmark of the per-call overhead of the structured output of `LLM`.
+
+Compares, for each provider client of the `llm` instance, building
+`model.with_structured_output(schema)` at every call (what `LLM._runnable` did
+before the registry) with the memoized `structured_runnable`, for the schema of
+`grade_documents` (one call per retrieved document). Only the runnable is built,
+no request is sent; providers without an API key get a dummy one.
+
+Usage:
+    python -m experiments.structured_output_benchmark --calls 2000
+"""
+
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+
+load_dotenv()
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "MISTRAL_API_KEY"):
+    os.environ.setdefault(key, "benchmark")
+
+from llm import llm
+from llm.custom_llm import structured_runnable
+
+
+class DocumentGrade(BaseModel):
+    """Binary score and reason for relevance check on retrieved documents."""
+
+    binary_score: str = Field(
+        description="Documents are relevant to the question, 'yes' or 'no'."
+    )
+    reason: str = Field(
+        description="A brief reason explaining why the document is relevant or irrelevant."
+    )
+
+
+def per_call_us(build, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        build()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'provider':<10} {'before (us)':>12} {'after (us)':>12} {'speedup':>9}")
+    for name, model in zip(llm._model_names, llm._models):
+        if model is None:
+            print(f"{name:<10} not instantiated")
+            continue
+        before = per_call_us(lambda: model.with_structured_output(DocumentGrade), args.calls)
+        # the first call builds the runnable, as the first call of a chain does
+        structured_runnable(model, DocumentGrade)
+        after = per_call_us(lambda: structured_runnable(model, DocumentGrade), args.calls)
+        print(f"{name:<10} {before:>12.1f} {after:>12.2f} {before / after:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import json
+
+import pathway as pw
+from pathway.stdlib.indexing.data_index import _SCORE
+from pathway.xpacks.llm.document_store import DocumentStore
+
+import config
+from quantized_index import MemoryStatsDocumentStore
+
+RETRIEVAL_MODES = ("knn", "bm25", "hybrid")
+
+
+def _doc_key(text, metadata) -> str:
+    if isinstance(metadata, pw.Json):
+        metadata = metadata.value
+    return text + json.dumps(metadata, sort_keys=True, default=str)
+
+
+def _ranked(texts, metadatas, scores):
+    # best match first
+    return sorted(zip(texts, metadatas, scores), key=lambda x: -x[2])
+
+
+def _with_mode(metadata, retrieval_mode: str) -> dict:
+    # the mode applied, so the clients can tell it from the one they asked for
+    if isinstance(metadata, pw.Json):
+        metadata = metadata.value
+    return {**(metadata or {}), "retrieval_mode": retrieval_mode}
+
+
+@pw.udf
+def fuse_results(
+    retrieval_mode: str,
+    k: int,
+    knn_weight: float,
+    bm25_weight: float,
+    knn_texts,
+    knn_metadatas,
+    knn_scores,
+    bm25_texts,
+    bm25_metadatas,
+    bm25_scores,
+) -> pw.Json:
+    """
+    Merges the KNN and BM25 results of a query with weighted reciprocal rank
+    fusion: a document scores sum(weight / (HYBRID_RRF_K + rank)) over the indices
+    that returned it. Single-index modes keep the original distances. Every
+    result carries the mode in its `retrieval_mode` metadata field.
+    """
+    if retrieval_mode != "hybrid":
+        if retrieval_mode == "bm25":
+            results = _ranked(bm25_texts, bm25_metadatas, bm25_scores)
+        else:
+            results = _ranked(knn_texts, knn_metadatas, knn_scores)
+        return pw.Json(
+            [
+                {
+                    "text": text,
+                    "metadata": _with_mode(metadata, retrieval_mode),
+                    "dist": -score,
+                }
+                for text, metadata, score in results[:k]
+            ]
+        )
+
+    fused = {}
+    for weight, results in (
+        (knn_weight, _ranked(knn_texts, knn_metadatas, knn_scores)),
+        (bm25_weight, _ranked(bm25_texts, bm25_metadatas, bm25_scores)),
+    ):
+        for rank, (text, metadata, _) in enumerate(results, start=1):
+            key = _doc_key(text, metadata)
+            if key not in fused:
+                fused[key] = {
+                    "text": text,
+                    "metadata": _with_mode(metadata, retrieval_mode),
+                    "dist": 0.0,
+                }
+            fused[key]["dist"] -= weight / (config.HYBRID_RRF_K + rank)
+
+    return pw.Json(sorted(fused.values(), key=lambda x: x["dist"])[:k])
+
+
+class HybridDocumentStore(MemoryStatsDocumentStore):
+    """
+    `DocumentStore` keeping both a KNN and a BM25 index over the same chunks.
+
+    Every `/v1/retrieve` request can choose the `retrieval_mode` ("knn", "bm25" or
+    "hybrid") and the fusion weights (`knn_weight`, `bm25_weight`); the defaults
+    come from `RETRIEVAL_MODE` and `HYBRID_FUSION_WEIGHTS`. Requests without these
+    fields behave as with a plain `DocumentStore` in the default mode. Each
+    index is only queried for the requests whose mode needs it.
+
+    Args:
+        docs: Pathway tables with the documents, as for `DocumentStore`
+        knn_factory: Factory of the KNN index
+        bm25_factory: Factory of the BM25 index
+        **kwargs: Other arguments of `DocumentStore` (parser, splitter, ...)
+    """
+
+    class RetrieveQuerySchema(DocumentStore.RetrieveQuerySchema):
+        retrieval_mode: str | None = pw.column_definition(
+            default_value=None, description='One of "knn", "bm25" or "hybrid"'
+        )
+        knn_weight: float | None = pw.column_definition(
+            default_value=None, description="Weight of the KNN ranking in hybrid mode"
+        )
+        bm25_weight: float | None = pw.column_definition(
+            default_value=None, description="Weight of the BM25 ranking in hybrid mode"
+        )
+
+    def __init__(self, docs, knn_factory, bm25_factory, **kwargs):
+        self.bm25_factory = bm25_factory
+        super().__init__(docs, retriever_factory=knn_factory, **kwargs)
+
+    def build_pipeline(self):
+        super().build_pipeline()
+        self._bm25_retriever = self.bm25_factory.build_index(
+            self.chunked_docs.text,
+            self.chunked_docs,
+            metadata_column=self.chunked_docs.metadata,
+        )
+
+    @pw.table_transformer
+    def retrieve_query(
+        self, retrieval_queries: pw.Table[RetrieveQuerySchema]
+    ) -> pw.Table[DocumentStore.QueryResultSchema]:
+        """
+        Query ``HybridDocumentStore`` for the list of closest texts to a given ``query``.
+        """
+        retrieval_queries = self.merge_filters(retrieval_queries)
+        retrieval_queries = retrieval_queries.with_columns(
+            retrieval_mode=pw.coalesce(pw.this.retrieval_mode, config.RETRIEVAL_MODE),
+            knn_weight=pw.coalesce(
+                pw.this.knn_weight, float(config.HYBRID_FUSION_WEIGHTS["knn"])
+            ),
+            bm25_weight=pw.coalesce(
+                pw.this.bm25_weight, float(config.HYBRID_FUSION_WEIGHTS["bm25"])
+            ),
+        )
+        # in hybrid mode fetch more candidates, so the fusion can reorder them
+        retrieval_queries = retrieval_queries.with_columns(
+            candidates=pw.if_else(
+                pw.this.retrieval_mode == "hybrid",
+                pw.this.k * config.HYBRID_CANDIDATES_FACTOR,
+                pw.this.k,
+            ),
+        )
+
+        # each index only answers the queries whose mode needs it
+        knn_queries = retrieval_queries.filter(pw.this.retrieval_mode != "bm25")
+        knn_results = knn_queries + self._retriever.query_as_of_now(
+            knn_queries.query,
+            number_of_matches=knn_queries.candidates,
+            metadata_filter=knn_queries.metadata_filter,
+        ).select(
+            knn_texts=pw.coalesce(pw.right.text, ()),
+            knn_metadatas=pw.coalesce(pw.right.metadata, ()),
+            knn_scores=pw.coalesce(pw.right[_SCORE], ()),
+        )
+        bm25_queries = retrieval_queries.filter(pw.this.retrieval_mode != "knn")
+        bm25_results = bm25_queries + self._bm25_retriever.query_as_of_now(
+            bm25_queries.query,
+            number_of_matches=bm25_queries.candidates,
+            metadata_filter=bm25_queries.metadata_filter,
+        ).select(
+            bm25_texts=pw.coalesce(pw.right.text, ()),
+            bm25_metadatas=pw.coalesce(pw.right.metadata, ()),
+            bm25_scores=pw.coalesce(pw.right[_SCORE], ()),
+        )
+
+        retrieval_results = (
+            retrieval_queries.join_left(
+                knn_results, pw.left.id == pw.right.id, id=pw.left.id
+            )
+            .select(
+                *pw.left,
+                knn_texts=pw.coalesce(pw.right.knn_texts, ()),
+                knn_metadatas=pw.coalesce(pw.right.knn_metadatas, ()),
+                knn_scores=pw.coalesce(pw.right.knn_scores, ()),
+            )
+            .join_left(bm25_results, pw.left.id == pw.right.id, id=pw.left.id)
+            .select(
+                *pw.left,
+                bm25_texts=pw.coalesce(pw.right.bm25_texts, ()),
+                bm25_metadatas=pw.coalesce(pw.right.bm25_metadatas, ()),
+                bm25_scores=pw.coalesce(pw.right.bm25_scores, ()),
+            )
+        )
+        return retrieval_results.select(
+            result=fuse_results(
+                pw.this.retrieval_mode,
+                pw.this.k,
+                pw.this.knn_weight,
+                pw.this.bm25_weight,
+                pw.this.knn_texts,
+                pw.this.knn_metadatas,
+                pw.this.knn_scores,
+                pw.this.bm25_texts,
+                pw.this.bm25_metadatas,
+                pw.this.bm25_scores,
+            )
+        )
@@ -0,0 +1,84 @@
+import pathway as pw
+from pathway.stdlib.indexing import (
+    BruteForceKnnFactory,
+    HybridIndexFactory,
+    UsearchKnnFactory,
+)
+from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
+
+import config
+from quantized_index import QuantizedKnnFactory
+
+INDEX_TYPES = ("brute_force", "usearch", "quantized", "hybrid")
+
+
+def make_knn_factory(
+    embedder,
+    index_type: str = config.VECTOR_INDEX_TYPE,
+    dimensions: int = config.VECTOR_INDEX_DIMENSIONS,
+):
+    """
+    Builds the KNN index factory of the given type.
+
+    Args:
+        embedder (pw.UDF): Embedder of the indexed texts and of the queries
+        index_type (str): "brute_force" (exact), "usearch" (HNSW, approximate) or
+            "quantized" (exact over fp16/int8 vectors, re-scored in float32)
+        dimensions (int): Dimensions of the embeddings
+    """
+    if index_type == "brute_force":
+        return BruteForceKnnFactory(
+            reserved_space=config.VECTOR_INDEX_RESERVED_SPACE,
+            embedder=embedder,
+            metric=pw.engine.BruteForceKnnMetricKind.COS,
+            dimensions=dimensions,
+        )
+    if index_type == "usearch":
+        return UsearchKnnFactory(
+            reserved_space=config.VECTOR_INDEX_RESERVED_SPACE,
+            embedder=embedder,
+            metric=pw.engine.USearchMetricKind.COS,
+            dimensions=dimensions,
+            connectivity=config.USEARCH_CONNECTIVITY,
+            expansion_add=config.USEARCH_EXPANSION_ADD,
+            expansion_search=config.USEARCH_EXPANSION_SEARCH,
+        )
+    if index_type == "quantized":
+        return QuantizedKnnFactory(
+            reserved_space=config.VECTOR_INDEX_RESERVED_SPACE,
+            embedder=embedder,
+            dimensions=dimensions,
+            quantization=config.VECTOR_QUANTIZATION,
+            rescore_factor=config.QUANTIZED_RESCORE_FACTOR,
+        )
+    raise ValueError(f"Unknown KNN index type: {index_type}")
+
+
+def make_bm25_factory():
+    return TantivyBM25Factory(
+        ram_budget=config.BM25_RAM_BUDGET, in_memory_index=False
+    )
+
+
+def make_retriever_factory(
+    embedder,
+    index_type: str = config.VECTOR_INDEX_TYPE,
+    dimensions: int = config.VECTOR_INDEX_DIMENSIONS,
+):
+    """
+    Builds the retriever factory of a `DocumentStore` as selected in the config.
+
+    Args:
+        embedder (pw.UDF): Embedder of the indexed texts and of the queries
+        index_type (str): One of `INDEX_TYPES`, "hybrid" fuses BM25 with the
+            `HYBRID_KNN_INDEX_TYPE` KNN index
+        dimensions (int): Dimensions of the embeddings
+    """
+    if index_type != "hybrid":
+        return make_knn_factory(embedder, index_type, dimensions)
+
+    bm25_index = make_bm25_factory()
+    knn_index = make_knn_factory(embedder, config.HYBRID_KNN_INDEX_TYPE, dimensions)
+    return HybridIndexFactory(
+        retriever_factories=[bm25_index, knn_index],
+    )
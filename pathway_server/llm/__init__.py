@@ -1 +1 @@
-from .custom_llm import llm
+from .custom_llm import hedge_config, llm
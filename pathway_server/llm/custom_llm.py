@@ -1,6 +1,15 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import (
     Any,
+    AsyncIterator,
     Dict,
+    Iterator,
     Optional,
     Type,
     Union,
@@ -13,7 +22,7 @@ from pydantic import BaseModel, Field
 from langchain_core.language_models.base import LanguageModelInput
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import BaseMessage
-from langchain_core.runnables import RunnableConfig, ensure_config
+from langchain_core.runnables import RunnableConfig, ensure_config, get_config_list
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_mistralai import ChatMistralAI
@@ -21,9 +30,308 @@ import config
 from config import SIMULATE_ERRORS
 from utils import log_message
 from .model_wrappers import ChatGemini, Llama
+from .response_cache import (
+    dump_output,
+    load_output,
+    messages_digest,
+    model_id,
+    response_cache,
+    schema_id,
+)
 from dotenv import load_dotenv
 load_dotenv()
 
+
+class SimulatedProviderError(RuntimeError):
+    """Failure injected through `SIMULATE_ERRORS`, counted as a 503."""
+
+    status_code = 503
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    # the provider SDKs put the HTTP status on the error or on its response
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _is_transient(error: Exception) -> bool:
+    """Rate limits, server errors and timeouts: better try another provider."""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+class ProviderStats:
+    """
+    Rolling health of an LLM provider (EWMA latency, error rate, 429 and 5xx
+    counts) and its circuit breaker: closed, open after `failure_threshold`
+    consecutive failures, and half-open `open_seconds` later, when a single
+    probe call decides whether it closes or opens again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.ewma_latency: Optional[float] = None
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._recent: deque = deque(maxlen=config.LLM_ROUTER_WINDOW)
+
+    def available(self, now: float) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return now - self.opened_at >= config.LLM_CIRCUIT_OPEN_S
+        # half-open: one probe at a time, unless it never reported back
+        return (
+            self.probe_started_at is None
+            or now - self.probe_started_at >= config.LLM_CIRCUIT_OPEN_S
+        )
+
+    def begin(self, now: float):
+        if self.state == "open" and self.available(now):
+            self.state = "half_open"
+            log_message(f"Circuit of {self.name} is half-open, probing")
+        if self.state == "half_open":
+            self.probe_started_at = now
+
+    def error_rate(self) -> float:
+        return 1 - sum(self._recent) / len(self._recent) if self._recent else 0.0
+
+    def score(self) -> float:
+        # providers without any call yet come first, to get their latency
+        latency = self.ewma_latency or 0.0
+        return latency * (1 + config.LLM_ROUTER_ERROR_PENALTY * self.error_rate())
+
+    def _observe(self, latency: Optional[float], ok: bool):
+        self.calls += 1
+        self._recent.append(ok)
+        if latency is not None:
+            alpha = config.LLM_ROUTER_EWMA_ALPHA
+            self.ewma_latency = (
+                latency
+                if self.ewma_latency is None
+                else alpha * latency + (1 - alpha) * self.ewma_latency
+            )
+
+    def record_success(self, latency: Optional[float]):
+        self._observe(latency, True)
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            log_message(f"Circuit of {self.name} is closed")
+        self.state = "closed"
+        self.probe_started_at = None
+
+    def record_failure(self, error: Exception, latency: Optional[float], now: float):
+        self._observe(latency, False)
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        status = _status_code(error)
+        if status == 429:
+            self.rate_limited += 1
+        elif status is not None and status >= 500:
+            self.server_errors += 1
+        if self.state == "half_open" or (
+            self.state == "closed"
+            and self.consecutive_failures >= config.LLM_CIRCUIT_FAILURES
+        ):
+            log_message(f"Circuit of {self.name} is open: {error}")
+            self.state = "open"
+            self.opened_at = now
+            self.probe_started_at = None
+
+    def info(self) -> dict:
+        return {
+            "state": self.state,
+            "ewma_latency_s": self.ewma_latency,
+            "error_rate": self.error_rate(),
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+
+class ProviderRouter:
+    """
+    Health of the providers of an `LLM`, shared by all its calls (and by its
+    structured output copies), and the order in which a call tries them.
+    """
+
+    def __init__(self, names: list[str], routing: str = config.LLM_ROUTING):
+        self.routing = routing
+        self.stats = {name: ProviderStats(name) for name in names}
+        self.hedging: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def order(self, names: list[str]) -> list[str]:
+        """
+        `names` (in preference order) as they should be tried now, leaving out
+        the providers with an open circuit unless all of them are.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [name for name in names if self.stats[name].available(now)]
+            if not available:
+                log_message("All the LLM circuits are open, trying them anyway")
+                return list(names)
+
+            # a provider whose circuit is due for a probe gets this call first
+            probing = [name for name in available if self.stats[name].state != "closed"]
+            closed = sorted(
+                (name for name in available if name not in probing),
+                key=lambda name: (self.stats[name].score(), names.index(name)),
+            )
+            if self.routing == "preferred":
+                preferred = [name for name in names[:1] if name in available]
+                others = [name for name in closed + probing if name not in preferred]
+                return preferred + others
+            return probing + closed
+
+    def begin(self, name: str):
+        with self._lock:
+            self.stats[name].begin(time.monotonic())
+
+    def record_success(self, name: str, latency: Optional[float] = None):
+        with self._lock:
+            self.stats[name].record_success(latency)
+
+    def record_failure(self, name: str, error: Exception, latency: Optional[float] = None):
+        with self._lock:
+            self.stats[name].record_failure(error, latency, time.monotonic())
+
+    def is_available(self, name: str) -> bool:
+        with self._lock:
+            return self.stats[name].available(time.monotonic())
+
+    def count(self, event: str):
+        """Counts a hedging event: "calls", "hedges", "hedge_wins" or "losers_cancelled"."""
+        with self._lock:
+            self.hedging[event] += 1
+
+    def _hedging_info(self) -> dict:
+        calls = self.hedging["calls"]
+        hedges = self.hedging["hedges"]
+        requests = sum(stats.calls for stats in self.stats.values())
+        return {
+            "calls": calls,
+            "hedges": hedges,
+            "hedge_wins": self.hedging["hedge_wins"],
+            "losers_cancelled": self.hedging["losers_cancelled"],
+            "hedge_rate": hedges / calls if calls else 0.0,
+            # duplicate requests out of all the provider requests, each billed
+            "cost_overhead": hedges / requests if requests else 0.0,
+        }
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "routing": self.routing,
+                "providers": {name: stats.info() for name, stats in self.stats.items()},
+                "hedging": self._hedging_info(),
+            }
+
+
+class _Attempt:
+    """One call to a provider: reports its outcome to the router."""
+
+    def __init__(self, router: ProviderRouter, model: Any, model_name: str, number: int, delay: float):
+        self.router = router
+        self.model = model
+        self.model_name = model_name
+        self.number = number
+        # backoff to wait before the call
+        self.delay = delay
+        self.retry = True
+        self._start = None
+
+    def start(self):
+        self.router.begin(self.model_name)
+        self._start = time.monotonic()
+
+    def succeeded(self):
+        self.router.record_success(self.model_name, time.monotonic() - self._start)
+
+    def failed(self, error: Exception):
+        self.router.record_failure(self.model_name, error, time.monotonic() - self._start)
+        # the provider is degraded, do not burn the retries on it
+        self.retry = not _is_transient(error)
+
+
+def _simulated_error(model_name: str) -> bool:
+    simulate = SIMULATE_ERRORS.get(model_name, False)
+    if isinstance(simulate, bool):
+        return simulate
+    return random.random() < float(simulate)
+
+
+# key of `configurable` in the runnable config of a call, see `hedge_config`
+HEDGE_CONFIG_KEY = "llm_hedge_after_s"
+
+# threads of the racing sync calls
+_hedge_executor = ThreadPoolExecutor(thread_name_prefix="llm-hedge")
+_NO_RESULT = object()
+
+
+def hedge_config(
+    node: str, budget_s: Optional[float] = None, config_given: Optional[RunnableConfig] = None
+) -> RunnableConfig:
+    """
+    Runnable config opting the LLM calls of `node` into hedging: if the first
+    provider has not answered within `budget_s` seconds (by default
+    `LLM_HEDGE_BUDGETS_S[node]`, no hedging if the node is not there), the same
+    request is sent to the next healthy provider and the first valid answer wins.
+
+        chain.invoke(inputs, config=hedge_config("check_safety"))
+    """
+    config_given = dict(config_given or {})
+    if budget_s is None:
+        budget_s = config.LLM_HEDGE_BUDGETS_S.get(node)
+    if budget_s is not None:
+        config_given["configurable"] = {
+            **config_given.get("configurable", {}),
+            HEDGE_CONFIG_KEY: budget_s,
+        }
+    return config_given  # type: ignore
+
+
+def _hedge_budget(config_given: RunnableConfig) -> Optional[float]:
+    return (config_given.get("configurable") or {}).get(HEDGE_CONFIG_KEY)
+
+
+# (provider client, schema) -> structured output runnable, shared by all the
+# copies of the LLM: building one converts the schema to a tool or a parser
+_structured_runnables: dict = {}
+_structured_lock = threading.Lock()
+
+
+def structured_runnable(model: Any, schema: Union[Dict, Type[BaseModel]]) -> Any:
+    """`model.with_structured_output(schema)`, built once per model and schema."""
+    schema_key = schema if isinstance(schema, type) else json.dumps(schema, sort_keys=True)
+    # the model is kept in the entry, so its id cannot be reused while it is there
+    key = (id(model), schema_key)
+    entry = _structured_runnables.get(key)
+    if entry is None:
+        with _structured_lock:
+            entry = _structured_runnables.get(key)
+            if entry is None:
+                entry = (model, model.with_structured_output(schema))
+                _structured_runnables[key] = entry
+    return entry[1]
+
+
 class LLM(BaseChatModel):
     openai: Optional[ChatOpenAI] = None
     anthropic: Optional[ChatAnthropic] = None
@@ -37,6 +345,9 @@ class LLM(BaseChatModel):
     num_retries: int = Field(default=2, description="Number of retries for each model")
 
     _schema_given: Optional[Union[Dict, Type[BaseModel]]] = None
+    _router: Optional[ProviderRouter] = None
+    # name of the chain in LLM_CACHE_CHAINS, see `cached`
+    _cache_chain: Optional[str] = None
 
     def instanciate_models(self) -> None:
         """
@@ -94,8 +405,213 @@ class LLM(BaseChatModel):
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
         self.instanciate_models()
+        self._router = ProviderRouter(list(self._model_names))
         
 
+    def _attempts(self) -> Iterator[_Attempt]:
+        """
+        Yields the attempts of a call, by provider in the order picked by the
+        router, `num_retries` per provider. A provider is left after a 429 / 5xx
+        or when its circuit opens, and simulated errors count as its failures.
+        """
+        models = dict(zip(self._model_names, self._models))
+        for model_name in self._router.order(self._model_names):
+            model = models[model_name]
+            if model is None:
+                continue
+            if _simulated_error(model_name):
+                log_message(f"Simulating error in `{model_name}`")
+                self._router.begin(model_name)
+                self._router.record_failure(
+                    model_name, SimulatedProviderError(f"Simulated error in `{model_name}`")
+                )
+                continue
+
+            for attempt in range(self.num_retries):  # Retry twice for each model
+                if attempt > 0 and not self._router.is_available(model_name):
+                    break
+                current = _Attempt(
+                    self._router,
+                    model,
+                    model_name,
+                    attempt,
+                    delay=config.LLM_RETRY_BACKOFF_S * 2 ** (attempt - 1) if attempt else 0.0,
+                )
+                yield current
+                if not current.retry:
+                    break
+
+    def _cache_keys(self, input_given, kwargs: dict) -> Optional[dict[str, str]]:
+        # keys of the cached response by provider, None if the chain is not cached
+        if not response_cache.enabled(self._cache_chain):
+            return None
+        digest = messages_digest(self._convert_input(input_given).to_messages(), kwargs)
+        schema = schema_id(self._schema_given)
+        return {
+            model_name: response_cache.make_key(model_name, model_id(model), schema, digest)
+            for model_name, model in zip(self._model_names, self._models)
+            if model is not None
+        }
+
+    def _cache_get(self, cache_keys: dict[str, str]) -> Any:
+        # a response of any provider, in the order of the router
+        try:
+            data = response_cache.get(
+                self._cache_chain,
+                [cache_keys[name] for name in self._router.order(list(cache_keys))],
+            )
+            if data is not None:
+                return load_output(data, self._schema_given)
+        except Exception as e:
+            log_message(f"LLM cache lookup failed for {self._cache_chain}: {e}")
+        return _NO_RESULT
+
+    def _cache_put(self, cache_keys: Optional[dict[str, str]], model_name: str, output: Any):
+        if cache_keys is None or output is None:
+            return
+        try:
+            response_cache.put(self._cache_chain, cache_keys[model_name], dump_output(output))
+        except Exception as e:
+            log_message(f"LLM cache write failed for {self._cache_chain}: {e}")
+
+    def _call(self, attempt: _Attempt, input_given, config: RunnableConfig, kwargs: dict, validate: bool = False, cache_keys=None):
+        attempt.start()
+        try:
+            output = self._runnable(attempt.model).invoke(input_given, config, **kwargs)
+            if validate and output is None:
+                raise ValueError("No structured output")
+        except Exception as e:
+            attempt.failed(e)
+            raise
+        attempt.succeeded()
+        self._cache_put(cache_keys, attempt.model_name, output)
+        return output
+
+    async def _acall(self, attempt: _Attempt, input_given, config: RunnableConfig, kwargs: dict, validate: bool = False, cache_keys=None):
+        attempt.start()
+        try:
+            output = await self._runnable(attempt.model).ainvoke(input_given, config, **kwargs)
+            if validate and output is None:
+                raise ValueError("No structured output")
+        except Exception as e:
+            attempt.failed(e)
+            raise
+        attempt.succeeded()
+        self._cache_put(cache_keys, attempt.model_name, output)
+        return output
+
+    def _hedged_invoke(self, attempts: Iterator[_Attempt], budget: float, input_given, config: RunnableConfig, kwargs: dict, cache_keys=None):
+        """
+        Races the first attempt against the first one of the next provider,
+        started `budget` seconds later (or as soon as the first fails). Returns
+        `_NO_RESULT` if both failed, the remaining attempts are then tried in turn.
+        """
+        primary = next(attempts, None)
+        if primary is None:
+            return _NO_RESULT
+        self._router.count("calls")
+        log_message(f"Hedged attempt using {primary.model_name}, budget {budget}s")
+        futures = {
+            _hedge_executor.submit(self._call, primary, input_given, config, kwargs, True, cache_keys): primary
+        }
+        hedge_at = time.monotonic() + budget
+        hedged = False
+        while futures:
+            timeout = None if hedged else max(hedge_at - time.monotonic(), 0)
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = futures.pop(future)
+                if future.exception() is None:
+                    for loser in futures:
+                        # a sync call already sent cannot be interrupted, it is left to finish
+                        if loser.cancel():
+                            self._router.count("losers_cancelled")
+                    if attempt is not primary:
+                        self._router.count("hedge_wins")
+                    return future.result()
+                log_message(f"{attempt.model_name} failed in hedged call: {future.exception()}")
+            if not hedged and (done or time.monotonic() >= hedge_at):
+                hedged = True
+                primary.retry = False
+                hedge = next(attempts, None)
+                if hedge is None:
+                    continue
+                if primary in futures.values():
+                    self._router.count("hedges")
+                    log_message(f"{primary.model_name} over budget, hedging with {hedge.model_name}")
+                futures[
+                    _hedge_executor.submit(self._call, hedge, input_given, config, kwargs, True, cache_keys)
+                ] = hedge
+        return _NO_RESULT
+
+    async def _ahedged_invoke(self, attempts: Iterator[_Attempt], budget: float, input_given, config: RunnableConfig, kwargs: dict, cache_keys=None):
+        """`_hedged_invoke` on the event loop, the losing request is cancelled."""
+        primary = next(attempts, None)
+        if primary is None:
+            return _NO_RESULT
+        self._router.count("calls")
+        log_message(f"Hedged async attempt using {primary.model_name}, budget {budget}s")
+        tasks = {
+            asyncio.ensure_future(self._acall(primary, input_given, config, kwargs, True, cache_keys)): primary
+        }
+        hedge_at = time.monotonic() + budget
+        hedged = False
+        try:
+            while tasks:
+                timeout = None if hedged else max(hedge_at - time.monotonic(), 0)
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = tasks.pop(task)
+                    if task.exception() is None:
+                        if attempt is not primary:
+                            self._router.count("hedge_wins")
+                        return task.result()
+                    log_message(f"{attempt.model_name} failed in hedged call: {task.exception()}")
+                if not hedged and (done or time.monotonic() >= hedge_at):
+                    hedged = True
+                    primary.retry = False
+                    hedge = next(attempts, None)
+                    if hedge is None:
+                        continue
+                    if primary in tasks.values():
+                        self._router.count("hedges")
+                        log_message(f"{primary.model_name} over budget, hedging with {hedge.model_name}")
+                    tasks[
+                        asyncio.ensure_future(self._acall(hedge, input_given, config, kwargs, True, cache_keys))
+                    ] = hedge
+            return _NO_RESULT
+        finally:
+            # the loser, or both if this call was cancelled
+            for task in tasks:
+                if task.cancel():
+                    self._router.count("losers_cancelled")
+
+    def provider_stats(self) -> dict:
+        """Health of the providers and state of their circuits, for monitoring."""
+        return self._router.info()
+
+    def cache_stats(self) -> dict:
+        """Chains with a cached response and their hit rates in this process."""
+        return response_cache.summary()
+
+    def cached(self, chain: str) -> "LLM":
+        """
+        Copy whose responses are cached under `chain`, while it is enabled in
+        `LLM_CACHE_CHAINS`. Only for chains whose answer is a function of their
+        messages:
+
+            classifier = prompt | llm.with_structured_output(Route).cached("qq_classifier")
+        """
+        new_instance = self.model_copy(deep=False)
+        new_instance._cache_chain = chain
+        return new_instance
+
+    def _runnable(self, model: Any) -> Any:
+        # the model itself, or its structured output runnable if a schema was given
+        if self._schema_given:
+            return structured_runnable(model, self._schema_given)
+        return model
+
     @override
     def invoke(
         self,
@@ -106,26 +622,174 @@ class LLM(BaseChatModel):
         **kwargs: Any,
     ) -> BaseMessage:
         config = ensure_config(config)
+        cache_keys = self._cache_keys(input_given, kwargs)
+        if cache_keys:
+            output = self._cache_get(cache_keys)
+            if output is not _NO_RESULT:
+                return output
+        attempts = self._attempts()
 
-        for model, model_name in zip(self._models, self._model_names):
-            if SIMULATE_ERRORS[model_name]:
-                raise RuntimeError(f"Simulating error in `{model_name}`")
+        budget = _hedge_budget(config)
+        if budget is not None:
+            output = self._hedged_invoke(attempts, budget, input_given, config, kwargs, cache_keys)
+            if output is not _NO_RESULT:
+                return output
 
-            if model is None:
-                continue
+        for attempt in attempts:
+            time.sleep(attempt.delay)
+            try:
+                log_message(f"Attempt {attempt.number + 1} using {attempt.model_name}")
+                return self._call(attempt, input_given, config, kwargs, cache_keys=cache_keys)  # type: ignore
+            except Exception as e:
+                log_message(f"{attempt.model} failed on attempt {attempt.number + 1}: {e}")
 
-            for attempt in range(self.num_retries):  # Retry twice for each model
-                try:
-                    log_message(f"Attempt {attempt + 1} using {model_name}")
-                    if self._schema_given:
-                        # print(f"using {model}")
-                        return model.with_structured_output(self._schema_given).invoke(
-                            input_given, config, **kwargs
-                        )  # type: ignore
-                    else:
-                        return model.invoke(input_given, config, **kwargs)
-                except Exception as e:
-                    log_message(f"{model} failed on attempt {attempt + 1}: {e}")
+        raise RuntimeError("All models failed, and user chose not to retry.")
+
+    @override
+    async def ainvoke(
+        self,
+        input_given: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> BaseMessage:
+        """
+        `invoke` on the event loop: every attempt uses the native async client
+        of the model instead of a thread of the default executor.
+        """
+        config = ensure_config(config)
+        cache_keys = self._cache_keys(input_given, kwargs)
+        if cache_keys:
+            output = self._cache_get(cache_keys)
+            if output is not _NO_RESULT:
+                return output
+        attempts = self._attempts()
+
+        budget = _hedge_budget(config)
+        if budget is not None:
+            output = await self._ahedged_invoke(attempts, budget, input_given, config, kwargs, cache_keys)
+            if output is not _NO_RESULT:
+                return output
+
+        for attempt in attempts:
+            await asyncio.sleep(attempt.delay)
+            try:
+                log_message(f"Async attempt {attempt.number + 1} using {attempt.model_name}")
+                return await self._acall(attempt, input_given, config, kwargs, cache_keys=cache_keys)  # type: ignore
+            except Exception as e:
+                log_message(f"{attempt.model} failed on attempt {attempt.number + 1}: {e}")
+
+        raise RuntimeError("All models failed, and user chose not to retry.")
+
+    @override
+    async def abatch(
+        self,
+        inputs: list[LanguageModelInput],
+        config: Optional[Union[RunnableConfig, list[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> list[Any]:
+        """
+        Sends the whole batch to each model in the fallback order with its native
+        `abatch` (concurrent requests on the event loop, up to the
+        `max_concurrency` of `config`), and only the inputs that failed to the
+        next attempt.
+        """
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        results: list[Any] = [None] * len(inputs)
+        errors: dict[int, Exception] = {}
+        cache_keys = [self._cache_keys(input_given, kwargs) for input_given in inputs]
+        pending = []
+        for i, keys in enumerate(cache_keys):
+            output = self._cache_get(keys) if keys else _NO_RESULT
+            if output is _NO_RESULT:
+                pending.append(i)
+            else:
+                results[i] = output
+        if not pending:
+            return results
+
+        for attempt in self._attempts():
+            await asyncio.sleep(attempt.delay)
+            log_message(
+                f"Async attempt {attempt.number + 1} using {attempt.model_name} for {len(pending)} inputs"
+            )
+            attempt.start()
+            outputs = await self._runnable(attempt.model).abatch(
+                [inputs[i] for i in pending],
+                [configs[i] for i in pending],
+                return_exceptions=True,
+                **kwargs,
+            )
+            failed = []
+            for i, output in zip(pending, outputs):
+                if isinstance(output, Exception):
+                    errors[i] = output
+                    failed.append(i)
+                else:
+                    results[i] = output
+                    self._cache_put(cache_keys[i], attempt.model_name, output)
+            if failed:
+                log_message(
+                    f"{attempt.model} failed on attempt {attempt.number + 1} for {len(failed)} inputs: {errors[failed[0]]}"
+                )
+            # one outcome per batch, so a batch weighs as much as a call
+            if len(failed) == len(pending):
+                attempt.failed(errors[failed[0]])
+            else:
+                attempt.succeeded()
+                if failed:
+                    attempt.retry = not _is_transient(errors[failed[0]])
+            pending = failed
+            if not pending:
+                break
+
+        for i in pending:
+            error = RuntimeError("All models failed, and user chose not to retry.")
+            if not return_exceptions:
+                raise error from errors.get(i)
+            results[i] = error
+        return results
+
+    @override
+    async def astream(
+        self,
+        input_given: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[Any]:
+        """
+        Streams the output of the first model that starts answering. A model
+        failing before its first chunk falls back to the next attempt, once a
+        chunk was yielded the error is raised.
+        """
+        config = ensure_config(config)
+
+        for attempt in self._attempts():
+            await asyncio.sleep(attempt.delay)
+            started = False
+            try:
+                log_message(f"Streaming attempt {attempt.number + 1} using {attempt.model_name}")
+                attempt.start()
+                async for chunk in self._runnable(attempt.model).astream(
+                    input_given, config, **kwargs
+                ):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                attempt.failed(e)
+                if started:
+                    raise
+                log_message(f"{attempt.model} failed on attempt {attempt.number + 1}: {e}")
+                continue
+            attempt.succeeded()
+            return
 
         raise RuntimeError("All models failed, and user chose not to retry.")
 
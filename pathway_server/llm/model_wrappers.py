@@ -1,4 +1,5 @@
 from __future__ import annotations
+import asyncio
 from typing import Union, Dict, Any, Optional, Type
 from typing_extensions import override
 
@@ -84,6 +85,20 @@ class ChatGemini(ChatGoogleGenerativeAI):
             log_message(f"Error during invocation: {e}")
             raise RuntimeError(f"Error during invocation: {e}")
 
+    @override
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> Any:
+        if self.schema_given:
+            # the instructor client is sync only
+            return await asyncio.to_thread(self.invoke, input, config, stop=stop, **kwargs)
+        return await self.lng_instance.ainvoke(input=input)
+
     @override
     def with_structured_output(
         self,
@@ -114,3 +129,12 @@ class Llama:
 
     def invoke(self, input: Any, config: Any):
         return self.model.invoke(input, config)
+
+    async def ainvoke(self, input: Any, config: Any = None, **kwargs: Any):
+        return await self.model.ainvoke(input, config, **kwargs)
+
+    async def abatch(self, inputs: list, config: Any = None, **kwargs: Any):
+        return await self.model.abatch(inputs, config, **kwargs)
+
+    def astream(self, input: Any, config: Any = None, **kwargs: Any):
+        return self.model.astream(input, config, **kwargs)
@@ -0,0 +1,221 @@
+"""
+Persistent exact-match cache of the LLM responses of deterministic chains.
+
+A chain opts in with `LLM.cached(chain)`, and is cached while
+`LLM_CACHE_CHAINS[chain]` is true. A response is keyed by the provider and model
+that gave it, the identity of the output schema and a canonical hash of the
+rendered messages, so a changed prompt, schema or model is a miss.
+
+Entries live in SQLite (WAL mode, shared by the thread pools and the worker
+processes), expire after `LLM_CACHE_TTL_S` seconds, and the least recently used
+ones are evicted once the values take more than `LLM_CACHE_MAX_MB`.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Optional
+
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+from pydantic import BaseModel
+
+import config
+
+
+def model_id(model: Any) -> str:
+    """Name of the model behind a provider client, e.g. `gpt-4o-mini`."""
+    for attr in ("model_name", "model"):
+        name = getattr(model, attr, None)
+        if isinstance(name, str):
+            return name
+    return type(model).__name__
+
+
+@functools.lru_cache(maxsize=None)
+def _model_schema_id(schema: type) -> str:
+    # a change of the fields or their descriptions changes the prompt of the tool
+    fields = json.dumps(schema.model_json_schema(), sort_keys=True)
+    digest = hashlib.sha256(fields.encode("utf-8")).hexdigest()[:16]
+    return f"{schema.__module__}.{schema.__qualname__}:{digest}"
+
+
+def schema_id(schema) -> str:
+    """Identity of an output schema (pydantic model or JSON schema), "" if none."""
+    if not schema:
+        return ""
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return _model_schema_id(schema)
+    fields = json.dumps(schema, sort_keys=True, default=str)
+    return "json:" + hashlib.sha256(fields.encode("utf-8")).hexdigest()[:16]
+
+
+def messages_digest(messages: list[BaseMessage], kwargs: dict) -> str:
+    """Canonical hash of the rendered messages of a call and its call arguments."""
+    canonical = json.dumps(
+        {
+            "messages": [
+                {"type": message.type, "content": message.content}
+                for message in messages
+            ],
+            "kwargs": kwargs,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def dump_output(output: Any) -> str:
+    if isinstance(output, BaseMessage):
+        return json.dumps({"message": messages_to_dict([output])[0]})
+    if isinstance(output, BaseModel):
+        return json.dumps({"model": output.model_dump(mode="json")})
+    return json.dumps({"json": output})
+
+
+def load_output(data: str, schema) -> Any:
+    value = json.loads(data)
+    if "message" in value:
+        return messages_from_dict([value["message"]])[0]
+    if "model" in value:
+        return schema.model_validate(value["model"])
+    return value["json"]
+
+
+class LLMResponseCache:
+    """
+    SQLite backed cache of LLM responses, with hits and misses counted per chain
+    in each process.
+
+    Args:
+        path (str): SQLite database file
+        max_mb (float): Size of the values above which the least recently used are evicted
+        ttl_s (float): Age after which an entry is a miss
+        evict_every (int): Writes of a process between two evictions
+    """
+
+    def __init__(
+        self,
+        path: str = config.LLM_CACHE_PATH,
+        max_mb: float = config.LLM_CACHE_MAX_MB,
+        ttl_s: float = config.LLM_CACHE_TTL_S,
+        evict_every: int = 100,
+    ):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_s = ttl_s
+        self.evict_every = evict_every
+
+        self._lock = threading.Lock()
+        self._counts: dict[str, Counter] = {}
+        self._puts = 0
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # opened lazily, and again in every forked worker process
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    chain TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def enabled(chain: Optional[str]) -> bool:
+        return chain is not None and bool(config.LLM_CACHE_CHAINS.get(chain))
+
+    @staticmethod
+    def make_key(provider: str, model: str, schema: str, digest: str) -> str:
+        return hashlib.sha256(
+            "\x00".join((provider, model, schema, digest)).encode("utf-8")
+        ).hexdigest()
+
+    def _count(self, chain: str, event: str):
+        self._counts.setdefault(chain, Counter())[event] += 1
+
+    def get(self, chain: str, keys: list[str]) -> Optional[str]:
+        """Value of the first of `keys` in the cache and not expired, None on a miss."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            rows = dict(
+                conn.execute(
+                    f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(keys))}) AND created_at > ?",
+                    (*keys, now - self.ttl_s),
+                ).fetchall()
+            )
+            key = next((key for key in keys if key in rows), None)
+            if key is None:
+                self._count(chain, "misses")
+                return None
+            self._count(chain, "hits")
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return rows[key]
+
+    def put(self, chain: str, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, chain, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, chain, value, len(value), now, now),
+            )
+            conn.commit()
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl_s,))
+        # keeps the most recently used entries that fit in max_bytes
+        conn.execute(
+            """DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS kept
+                    FROM responses
+                ) WHERE kept > ?
+            )""",
+            (self.max_bytes,),
+        )
+        conn.commit()
+
+    def summary(self) -> dict:
+        with self._lock:
+            chains = {}
+            for chain, counts in self._counts.items():
+                lookups = counts["hits"] + counts["misses"]
+                chains[chain] = {
+                    "hits": counts["hits"],
+                    "misses": counts["misses"],
+                    "hit_rate": counts["hits"] / lookups if lookups else 0.0,
+                }
+            return {
+                "enabled": sorted(
+                    chain for chain, enabled in config.LLM_CACHE_CHAINS.items() if enabled
+                ),
+                "chains": chains,
+            }
+
+
+# shared by all the copies of the LLM
+response_cache = LLMResponseCache()
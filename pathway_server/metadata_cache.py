@@ -0,0 +1,230 @@
+"""
+Persistent cache of the static metadata (type, company, year, quarter) of the
+indexed documents, shared by all the indexer processes.
+
+Entries are keyed by a fingerprint of the text of the first
+`METADATA_FINGERPRINT_PAGES` pages, so the same filing read by several replicas,
+or downloaded again, is only sent to the LLM once. Entries can also be pre-seeded
+from file names or EDGAR headers, without any LLM call:
+
+    python metadata_cache.py data/
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+from pypdf import PdfReader
+
+from config import METADATA_CACHE_PATH, METADATA_FINGERPRINT_PAGES
+
+# kinds of entries: the full static metadata, or only the company name and year
+STATIC = "static"
+COMPANY_YEAR = "company_year"
+
+_COMPANY_SUFFIXES = re.compile(
+    r"[\s,]+(inc|incorporated|corp|corporation|co|company|llc|ltd|plc)\.?$"
+)
+
+
+def document_fingerprint(reader: PdfReader, num_pages: int = METADATA_FINGERPRINT_PAGES) -> str:
+    """SHA-256 of the raw text of the first `num_pages` pages of a PDF."""
+    h = hashlib.sha256()
+    for page in reader.pages[:num_pages]:
+        h.update((page.extract_text() or "").encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class MetadataCache:
+    """
+    SQLite backed cache of document metadata, in WAL mode so that several indexer
+    processes can read and write it at the same time.
+
+    Args:
+        path (str): SQLite database file
+    """
+
+    def __init__(self, path: str = METADATA_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS metadata (
+                fingerprint TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (fingerprint, kind)
+            )"""
+        )
+        self._conn.commit()
+
+    def get(self, fingerprint: str | None, kind: str) -> dict | None:
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM metadata WHERE fingerprint = ? AND kind = ?",
+                (fingerprint, kind),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_company_and_year(self, fingerprint: str | None) -> dict | None:
+        """Company name and year, from either kind of entry."""
+        for kind in (STATIC, COMPANY_YEAR):
+            value = self.get(fingerprint, kind)
+            if value is not None and value["company_name"] and value["year"]:
+                return {"company_name": value["company_name"], "year": value["year"]}
+        return None
+
+    def put(self, fingerprint: str | None, kind: str, value: dict, source: str = "llm"):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (fingerprint, kind, value, source) VALUES (?, ?, ?, ?)",
+                (fingerprint, kind, json.dumps(value), source),
+            )
+            self._conn.commit()
+
+
+def normalize_company(name: str) -> str:
+    name = name.lower().strip()
+    return _COMPANY_SUFFIXES.sub("", name).strip()
+
+
+def canonical_company(name: str, companies) -> str | None:
+    """
+    Spelling of `name` among the known `companies` (`db.get_companies()`, which
+    the LLM extraction is asked to reuse), None if it is not one of them.
+    """
+    normalized = normalize_company(name)
+    for company in sorted(company for company in companies if company):
+        if normalize_company(company) == normalized:
+            return company
+    return None
+
+
+def _quarter_from_month(month: int) -> str | None:
+    return {3: "Q1", 4: "Q1", 6: "Q2", 7: "Q2", 9: "Q3", 10: "Q3"}.get(month)
+
+
+def metadata_from_edgar_header(text: str) -> dict | None:
+    """
+    Reads the metadata of the SEC header of EDGAR submissions, e.g.
+    `COMPANY CONFORMED NAME: APPLE INC`, `CONFORMED SUBMISSION TYPE: 10-K` and
+    `CONFORMED PERIOD OF REPORT: 20220924`.
+    """
+    company = re.search(r"COMPANY CONFORMED NAME:\s*(.+)", text)
+    form = re.search(r"CONFORMED SUBMISSION TYPE:\s*(10-[KQ])", text)
+    period = re.search(r"CONFORMED PERIOD OF REPORT:\s*(\d{4})(\d{2})\d{2}", text)
+    if not (company and form and period):
+        return None
+
+    type = form.group(1)
+    return {
+        "type": type,
+        "company_name": normalize_company(company.group(1)),
+        "year": period.group(1),
+        "quarter": _quarter_from_month(int(period.group(2))) if type == "10-Q" else None,
+    }
+
+
+def metadata_from_filename(path: str) -> dict | None:
+    """
+    Reads company, form and year from file names like `apple-10k-2022.pdf` or
+    `nike_inc_10-Q_2021.pdf`. Returns None unless the name holds exactly one year,
+    exactly one form and a one-word company name.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0].lower()
+    years = re.findall(r"(?<!\d)((?:19|20)\d{2})(?!\d)", stem)
+    forms = re.findall(r"(?<![a-z0-9])10[-_ ]?([kq])(?![a-z])", stem)
+    # without a form, a name like `earnings_2023.pdf` says nothing of the company
+    if len(years) != 1 or len(forms) != 1:
+        return None
+
+    company = re.sub(r"(?<![a-z0-9])10[-_ ]?[kq](?![a-z])", " ", stem)
+    company = re.sub(r"(?<!\d)(?:19|20)\d{2}(?!\d)", " ", company)
+    company = normalize_company(re.sub(r"[-_.\s]+", " ", company))
+    # anything but a single word (e.g. "msft annual") is ambiguous
+    if not re.fullmatch(r"[a-z0-9&]+", company):
+        return None
+
+    # the quarter is not in the name, so 10-Q files only get company and year
+    return {
+        "company_name": company,
+        "year": years[0],
+        "type": f"10-{forms[0].upper()}",
+        "quarter": None,
+    }
+
+
+def seed(paths: list[str], cache: MetadataCache | None = None, companies=None) -> int:
+    """
+    Pre-seeds the cache for the PDFs under `paths` whose EDGAR header or file name
+    gives the metadata unambiguously. Returns the number of seeded documents.
+
+    Company names are spelled as in `companies` (by default the ones of the
+    reports database), like the names extracted by the LLM; files of any other
+    company (or ticker) are left to the LLM.
+    """
+    cache = cache or MetadataCache()
+    if companies is None:
+        from database import FinancialDatabase
+
+        companies = FinancialDatabase().get_companies()
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+
+    seeded = 0
+    for file in files:
+        if not file.lower().endswith(".pdf"):
+            continue
+        try:
+            reader = PdfReader(file)
+            fingerprint = document_fingerprint(reader)
+            first_page = (reader.pages[0].extract_text() or "") if len(reader.pages) else ""
+        except Exception as e:
+            print(f"Error reading {file}: {e}")
+            continue
+
+        metadata = metadata_from_edgar_header(first_page)
+        source = "edgar_header"
+        if metadata is None:
+            metadata = metadata_from_filename(file)
+            source = "filename"
+        if metadata is None:
+            print(f"Skipping {file}: no unambiguous company and year")
+            continue
+        company = canonical_company(metadata["company_name"], companies)
+        if company is None:
+            print(f"Skipping {file}: unknown company {metadata['company_name']!r}")
+            continue
+        metadata["company_name"] = company
+
+        if metadata.get("type") == "10-K" or metadata.get("quarter"):
+            cache.put(fingerprint, STATIC, metadata, source)
+        cache.put(
+            fingerprint,
+            COMPANY_YEAR,
+            {"company_name": metadata["company_name"], "year": metadata["year"]},
+            source,
+        )
+        print(f"Seeded {file} from its {source}: {metadata}")
+        seeded += 1
+    return seeded
+
+
+if __name__ == "__main__":
+    seed(sys.argv[1:] or ["data"])
@@ -0,0 +1,159 @@
+"""
+Inverted index of the low-cardinality metadata fields of the chunks, used to
+resolve the `metadata_filter` of a query to candidate rows before any vector is
+scored.
+
+The conjuncts of the JMESPath filter that the index can answer are
+
+    field == `value`                 (either side, any of METADATA_INDEX_FIELDS)
+    contains(field, `value`)         (list or string fields)
+    globmatch(`pattern`, path)       (from `filepath_globpattern`)
+
+combined with `&&` and `||`. Any other part of the filter (negations,
+comparisons, nested fields) leaves the candidates unconstrained; the full filter
+is still evaluated on every candidate, so the index only prunes.
+"""
+
+import json
+
+import jmespath
+from pathway.stdlib.ml.classifiers import _knn_lsh
+
+import config
+
+_COMPARATORS = ("eq",)
+
+
+def _value_key(value):
+    # hashable key with the equality of JMESPath: 1 == 1.0, but "1" != 1 != true
+    if isinstance(value, bool) or value is None:
+        return ("c", value)
+    if isinstance(value, (int, float)):
+        return ("n", float(value))
+    if isinstance(value, str):
+        return ("s", value)
+    if isinstance(value, list):
+        return ("l", tuple(_value_key(item) for item in value))
+    return ("j", json.dumps(value, sort_keys=True, default=str))
+
+
+def _contains(value, item) -> bool:
+    if isinstance(value, list):
+        return any(_value_key(element) == _value_key(item) for element in value)
+    if isinstance(value, str) and isinstance(item, str):
+        return item in value
+    return False
+
+
+class MetadataIndex:
+    """
+    Postings of the rows of a vector store by the value of each of `fields`.
+
+    Args:
+        fields: Metadata fields indexed, others are never used to prune
+    """
+
+    def __init__(self, fields=config.METADATA_INDEX_FIELDS):
+        self.fields = tuple(fields)
+        # field -> value key -> (value, set of rows)
+        self._postings: dict[str, dict] = {field: {} for field in self.fields}
+
+    def add(self, row: int, metadata: dict | None):
+        if not isinstance(metadata, dict):
+            return
+        for field in self.fields:
+            if field not in metadata:
+                continue
+            value = metadata[field]
+            key = _value_key(value)
+            self._postings[field].setdefault(key, (value, set()))[1].add(row)
+
+    def remove(self, row: int, metadata: dict | None):
+        if not isinstance(metadata, dict):
+            return
+        for field in self.fields:
+            if field not in metadata:
+                continue
+            postings = self._postings[field]
+            key = _value_key(metadata[field])
+            entry = postings.get(key)
+            if entry is None:
+                continue
+            entry[1].discard(row)
+            if not entry[1]:
+                del postings[key]
+
+    def _rows(self, field: str, matches) -> set:
+        rows = set()
+        for value, value_rows in self._postings[field].values():
+            if matches(value):
+                rows |= value_rows
+        return rows
+
+    def _field(self, node) -> str | None:
+        if node["type"] == "field" and node["value"] in self.fields:
+            return node["value"]
+        return None
+
+    def _resolve(self, node) -> set | None:
+        # rows that can match the expression, None if it cannot be resolved
+        kind = node["type"]
+        if kind == "and_expression":
+            left, right = (self._resolve(child) for child in node["children"])
+            if left is None:
+                return right
+            if right is None:
+                return left
+            return left & right
+        if kind == "or_expression":
+            left, right = (self._resolve(child) for child in node["children"])
+            if left is None or right is None:
+                return None
+            return left | right
+        if kind == "comparator" and node["value"] in _COMPARATORS:
+            left, right = node["children"]
+            for field_node, literal in ((left, right), (right, left)):
+                field = self._field(field_node)
+                if field is not None and literal["type"] == "literal":
+                    entry = self._postings[field].get(_value_key(literal["value"]))
+                    return set(entry[1]) if entry is not None else set()
+            return None
+        if kind == "function_expression" and len(node["children"]) == 2:
+            first, second = node["children"]
+            if node["value"] == "contains":
+                field = self._field(first)
+                if field is not None and second["type"] == "literal":
+                    item = second["value"]
+                    return self._rows(field, lambda value: _contains(value, item))
+            if node["value"] == "globmatch":
+                field = self._field(second)
+                if (
+                    field is not None
+                    and first["type"] == "literal"
+                    and isinstance(first["value"], str)
+                ):
+                    pattern = first["value"]
+                    # per path component, as the `globmatch` of the filters
+                    return self._rows(
+                        field,
+                        lambda value: isinstance(value, str)
+                        and _knn_lsh._globmatch(pattern, value),
+                    )
+            return None
+        return None
+
+    def candidates(self, metadata_filter: str | None) -> set | None:
+        """
+        Rows that can match `metadata_filter`, None if the filter does not
+        constrain any indexed field (every row is a candidate).
+        """
+        if not metadata_filter:
+            return None
+        try:
+            parsed = jmespath.compile(metadata_filter).parsed
+        except jmespath.exceptions.JMESPathError:
+            return None
+        return self._resolve(parsed)
+
+    def stats(self) -> dict:
+        return {field: len(postings) for field, postings in self._postings.items()}
@@ -3,14 +3,81 @@ from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.servers import DocumentStoreServer
 import aiohttp
 import aiohttp_cors
-import random
-import requests
-import json
-import os
+import asyncio
 import multiprocessing
+import time
+
+import config
+from blob_store import BlobStore, serve_blobs
+from batch_retrieval import serve_retrieve_batch
+from snapshot import SnapshotDocumentStore, serve_snapshot
+
+
+# hop-by-hop headers, not forwarded by the proxy
+_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+}
+
+_STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class Replica:
+    """
+    Health and load of one backend of the proxy: whether its last probe
+    succeeded, its requests in flight and an EWMA of its response time.
+    """
+
+    def __init__(self, name: str, url: str, alpha: float = config.MULTI_SERVER_EWMA_ALPHA):
+        self.name = name
+        self.url = url
+        self.alpha = alpha
+        self.healthy = False
+        self.statistics: dict | None = None
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def observe(self, seconds: float):
+        if self.requests == 0:
+            self.ewma_latency = seconds
+        else:
+            self.ewma_latency += self.alpha * (seconds - self.ewma_latency)
+        self.requests += 1
+
+    def load(self, balancing: str) -> tuple:
+        if balancing == "ewma":
+            # the latency of a replica grows with its queue
+            return (self.ewma_latency * (self.outstanding + 1), self.outstanding)
+        return (self.outstanding, self.ewma_latency)
+
+    def info(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "ewma_latency_s": self.ewma_latency,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
 
 
 class MultiDocumentServer:
+    """
+    Runs two replicas of a `DocumentStoreServer` and an aiohttp proxy in front of
+    them. The proxy probes the replicas in the background, and streams each
+    request to a healthy replica picked by `balancing` ("least_outstanding" or
+    "ewma"), over one shared keep-alive `ClientSession`.
+    """
+
     def __init__(
         self,
         host: str,
@@ -21,6 +88,9 @@ class MultiDocumentServer:
         document_store2: DocumentStore,
         server1_cache_dir: str,
         server2_cache_dir: str,
+        balancing: str = config.MULTI_SERVER_BALANCING,
+        health_interval: float = config.MULTI_SERVER_HEALTH_INTERVAL_S,
+        health_timeout: float = config.MULTI_SERVER_HEALTH_TIMEOUT_S,
     ):
         self.host = host
         self.proxy_port = proxy_port
@@ -30,85 +100,172 @@ class MultiDocumentServer:
         self.document_store2 = document_store2
         self.server1_cache_dir = server1_cache_dir
         self.server2_cache_dir = server2_cache_dir
+        self.balancing = balancing
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+
+        self.replicas = [
+            Replica("server1", f"http://{self.host}:{self.server1_port}"),
+            Replica("server2", f"http://{self.host}:{self.server2_port}"),
+        ]
+        self._session: aiohttp.ClientSession | None = None
+        self._prober: asyncio.Task | None = None
 
-    def check_server_status(self, url):
-        stat_url = url + "/v1/statistics"
+    async def _probe(self, replica: Replica):
         try:
-            response = requests.post(
-                stat_url,
+            async with self._session.post(
+                replica.url + "/v1/statistics",
                 json={},
-                headers={"Content-Type": "application/json"},
-                timeout=2,
-            )
-            responses = response.json()
-            return True
+                timeout=aiohttp.ClientTimeout(total=self.health_timeout),
+            ) as resp:
+                replica.statistics = await resp.json(content_type=None)
+            if not replica.healthy:
+                print(f"{replica.name} is up")
+            replica.healthy = True
         except Exception as e:
-            print(f"Error: {e}")
-            return False
+            if replica.healthy:
+                print(f"{replica.name} is down: {e!r}")
+            replica.healthy = False
+            replica.statistics = None
+
+    async def _probe_all(self):
+        await asyncio.gather(*(self._probe(replica) for replica in self.replicas))
+
+    async def _probe_forever(self):
+        while True:
+            await self._probe_all()
+            await asyncio.sleep(self.health_interval)
+
+    async def _on_startup(self, app):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            # bodies are passed through as they are, compressed or not
+            auto_decompress=False,
+            # no total limit, so large responses can stream, but a replica that
+            # stops sending for VECTOR_STORE_TIMEOUT seconds is given up
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=config.VECTOR_STORE_TIMEOUT,
+                sock_read=config.VECTOR_STORE_TIMEOUT,
+            ),
+        )
+        self._prober = asyncio.create_task(self._probe_forever())
+
+    async def _on_cleanup(self, app):
+        self._prober.cancel()
+        await self._session.close()
+
+    def _pick(self, exclude=()) -> Replica | None:
+        healthy = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not healthy:
+            return None
+        return min(healthy, key=lambda r: r.load(self.balancing))
 
     async def handle_request(self, request):
-        server1_url = f"http://{self.host}:{self.server1_port}"
-        server2_url = f"http://{self.host}:{self.server2_port}"
-
-        server1_status = self.check_server_status(server1_url)
-        server2_status = self.check_server_status(server2_url)
-
-        if server1_status and server2_status:
-            print("Both servers are up")
-            remote_url = (
-                random.choice([server1_url, server2_url]) + request.rel_url.path_qs
-            )
-            print(f"Selected server: {remote_url}")
-        elif server1_status:
-            print("Server 1 is up")
-            remote_url = server1_url + request.rel_url.path_qs
-        elif server2_status:
-            print("Server 2 is up")
-            remote_url = server2_url + request.rel_url.path_qs
-        else:
+        replica = self._pick()
+        if replica is None:
+            # the replicas may have come up since the last probe
+            await self._probe_all()
+            replica = self._pick()
+        if replica is None:
             print("Both servers are down")
             return aiohttp.web.Response(status=500, text="Both servers are down")
 
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector()) as session:
-            # Send the request to the remote URL using the same method
-            body = await request.read()
-            async with session.request(
-                request.method, remote_url, headers=request.headers, data=body
-            ) as resp:
-                if resp.content_type == "application/json":
-                    print("JSON response")
-                    response_json = await resp.json()  # Parse JSON response
-                    return aiohttp.web.Response(
-                        status=resp.status,
-                        body=json.dumps(
-                            response_json
-                        ),  # Convert dict back to string (for returning as body)
-                        headers=resp.headers,
-                    )
-                else:
-                    # Handle non-JSON responses (like text, html, etc.)
-                    text = await resp.text()
-                    print("Non-JSON response")
+        body = await request.read()
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() not in _HOP_HEADERS
+        }
+        tried = []
+        while True:
+            tried.append(replica)
+            try:
+                return await self._forward(request, replica, headers, body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # nothing was sent back yet, so another replica can answer
+                print(f"Error forwarding to {replica.name}: {e!r}")
+                replica.healthy = False
+                replica = self._pick(exclude=tried)
+                if replica is None:
                     return aiohttp.web.Response(
-                        status=resp.status, text=text, headers=resp.headers
+                        status=502, text="No server could answer"
                     )
 
-    async def handle_health_check(self, request):
-        server1_url = f"http://{self.host}:{self.server1_port}"
-        server2_url = f"http://{self.host}:{self.server2_port}"
+    async def _forward(self, request, replica: Replica, headers: dict, body: bytes):
+        replica.outstanding += 1
+        start = time.monotonic()
+        response = None
+        try:
+            async with self._session.request(
+                request.method,
+                replica.url + request.rel_url.path_qs,
+                headers=headers,
+                data=body,
+            ) as resp:
+                response = aiohttp.web.StreamResponse(
+                    status=resp.status,
+                    headers={
+                        name: value
+                        for name, value in resp.headers.items()
+                        if name.lower() not in _HOP_HEADERS
+                    },
+                )
+                await response.prepare(request)
+                async for chunk in resp.content.iter_chunked(_STREAM_CHUNK_BYTES):
+                    await response.write(chunk)
+                await response.write_eof()
+                replica.observe(time.monotonic() - start)
+                return response
+        except Exception:
+            replica.errors += 1
+            if response is not None and response.prepared:
+                # part of the response was sent, so it cannot be retried
+                raise aiohttp.web.HTTPBadGateway() from None
+            raise
+        finally:
+            replica.outstanding -= 1
+
+    async def handle_statistics(self, request):
+        """
+        Statistics of the first server that is up, with the memory of every
+        replica under "replicas", from the last health probes.
+        """
+        stats = next(
+            (r.statistics for r in self.replicas if r.statistics is not None), None
+        )
+        if stats is None:
+            return aiohttp.web.Response(status=500, text="Both servers are down")
+        stats = {
+            **stats,
+            "replicas": {
+                r.name: r.statistics.get("memory") if r.statistics is not None else None
+                for r in self.replicas
+            },
+        }
+        return aiohttp.web.json_response(stats)
 
-        server1_status = self.check_server_status(server1_url)
-        server2_status = self.check_server_status(server2_url)
+    async def handle_health_check(self, request):
+        server1, server2 = (r.healthy for r in self.replicas)
 
-        if server1_status and server2_status:
+        if server1 and server2:
             return aiohttp.web.Response(status=200, text="both")
-        elif server1_status:
+        elif server1:
             return aiohttp.web.Response(status=200, text="server1")
-        elif server2_status:
+        elif server2:
             return aiohttp.web.Response(status=200, text="server2")
         else:
             return aiohttp.web.Response(status=500, text="none")
 
+    async def handle_replicas(self, request):
+        """Health, requests in flight and latency of every replica."""
+        return aiohttp.web.json_response(
+            {
+                "balancing": self.balancing,
+                "replicas": {r.name: r.info() for r in self.replicas},
+            }
+        )
+
     def run_server1(self):
         # Running server1 with its own cache backend in a separate process
         server1 = DocumentStoreServer(
@@ -116,6 +273,10 @@ class MultiDocumentServer:
             port=self.server1_port,
             document_store=self.document_store1,
         )
+        serve_blobs(server1, BlobStore())
+        serve_retrieve_batch(server1, self.document_store1)
+        if isinstance(self.document_store1, SnapshotDocumentStore):
+            serve_snapshot(server1, self.document_store1)
 
         server1.run(
             cache_backend=pw.persistence.Backend.filesystem(self.server1_cache_dir)
@@ -128,6 +289,10 @@ class MultiDocumentServer:
             port=self.server2_port,
             document_store=self.document_store2,
         )
+        serve_blobs(server2, BlobStore())
+        serve_retrieve_batch(server2, self.document_store2)
+        if isinstance(self.document_store2, SnapshotDocumentStore):
+            serve_snapshot(server2, self.document_store2)
 
         server2.run(
             cache_backend=pw.persistence.Backend.filesystem(self.server2_cache_dir)
@@ -142,10 +307,16 @@ class MultiDocumentServer:
         process2.start()
 
         app = aiohttp.web.Application()
-        app.router.add_route("*", "/v1/statistics", self.handle_request)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        app.router.add_route("*", "/v1/statistics", self.handle_statistics)
         app.router.add_route("*", "/v1/retrieve", self.handle_request)
+        app.router.add_route("*", "/v1/retrieve_batch", self.handle_request)
         app.router.add_route("*", "/v1/inputs", self.handle_request)
+        app.router.add_route("GET", "/v1/blob/{hash}", self.handle_request)
+        app.router.add_route("GET", "/v1/snapshot", self.handle_request)
         app.router.add_route("*", "/v1/health", self.handle_health_check)
+        app.router.add_route("GET", "/v1/replicas", self.handle_replicas)
 
         aiohttp_cors.setup(app)
         aiohttp.web.run_app(app, host=self.host, port=self.proxy_port)
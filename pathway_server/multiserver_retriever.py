@@ -1,23 +1,76 @@
-from typing import Optional
-
-# in order to allow timoouts, we use a temporary fix
-from pathway.xpacks.llm.vector_store import VectorStoreClient
+import json
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Any, Optional
 
 import requests
-import json
+
 import config
-import logging
-from langchain_core.documents import Document
 from retriever import PathwayVectorStoreClient
 
 
+class _Replica:
+    """Cached health and recent latencies of one of the servers of the client."""
+
+    def __init__(self, name: str, client: PathwayVectorStoreClient, window: int):
+        self.name = name
+        self.client = client
+        # healthy until a probe or a query says otherwise
+        self.healthy = True
+        self.latencies: deque = deque(maxlen=window)
+        self.queries = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.queries += 1
+
+    def percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[max(math.ceil(q / 100 * len(latencies)) - 1, 0)]
+
+    def info(self) -> dict:
+        return {
+            "url": self.client.client.url,
+            "healthy": self.healthy,
+            "queries": self.queries,
+            "errors": self.errors,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+        }
+
+
 class CustomPathwayVectorStoreClient:
+    """
+    Client of two vector store servers (e.g. the multi server proxy and the fast
+    server).
+
+    A query is sent to all the healthy servers at once, each with a deadline of
+    `timeout` seconds, and their results are merged: de-duplicated by text and
+    metadata, fused by reciprocal rank and cut to `k`. With `hedging`, it is sent to the
+    server with the lowest p95 latency only, and to the next one if it has not
+    answered within its `hedge_percentile` latency (or failed).
+
+    The health of the servers is probed in the background every
+    `health_interval` seconds instead of before every query.
+    """
+
     def __init__(
         self,
         server1_url: Optional[str] = None,
         server2_url: Optional[str] = None,
         timeout: int = config.VECTOR_STORE_TIMEOUT,
+        hedging: bool = config.RETRIEVER_HEDGING,
+        hedge_percentile: float = config.RETRIEVER_HEDGE_PERCENTILE,
+        health_interval: float = config.RETRIEVER_HEALTH_INTERVAL_S,
     ):
         self.client1 = PathwayVectorStoreClient(
             host=None, port=None, url=server1_url, timeout=timeout
@@ -28,6 +81,21 @@ class CustomPathwayVectorStoreClient:
         self.url1 = server1_url
         self.url2 = server2_url
         self.timeout = timeout
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.health_interval = health_interval
+
+        self.replicas = [
+            _Replica("server1", self.client1, config.RETRIEVER_LATENCY_WINDOW),
+            _Replica("server2", self.client2, config.RETRIEVER_LATENCY_WINDOW),
+        ]
+        self.hedges = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.VECTOR_STORE_POOL_SIZE,
+            thread_name_prefix="multiserver-retriever",
+        )
+        self._prober: Optional[threading.Thread] = None
+        self._prober_lock = threading.Lock()
 
     def check_server_status(self, url):
         stat_url = url + "/v1/statistics"
@@ -36,25 +104,145 @@ class CustomPathwayVectorStoreClient:
                 stat_url,
                 json={},
                 headers={"Content-Type": "application/json"},
-                timeout=5,
+                timeout=min(self.timeout, 5),
             )
-            responses = response.json()
+            response.json()
             return True
         except Exception as e:
             print(f"Error: {e}")
             return False
 
+    def _probe_forever(self):
+        while True:
+            for replica in self.replicas:
+                healthy = self.check_server_status(replica.client.client.url)
+                if healthy != replica.healthy:
+                    print(f"{replica.name} is {'up' if healthy else 'down'}")
+                replica.healthy = healthy
+            time.sleep(self.health_interval)
+
+    def _ensure_prober(self):
+        with self._prober_lock:
+            if self._prober is None:
+                self._prober = threading.Thread(
+                    target=self._probe_forever,
+                    name="multiserver-retriever-health",
+                    daemon=True,
+                )
+                self._prober.start()
+
+    def _healthy_replicas(self) -> list[_Replica]:
+        self._ensure_prober()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        # the probes may be out of date, so try them all rather than none
+        return healthy or list(self.replicas)
+
     def get_active_url(self):
-        if self.check_server_status(self.url1):
-            print("Server 1 is active")
-            return self.url1
-        elif self.check_server_status(self.url2):
-            print("Server 2 is active")
-            return self.url2
+        return self._healthy_replicas()[0].client.client.url
+
+    def _retrieve_from(
+        self, replica: _Replica, query: str, k: int, kwargs: dict
+    ) -> list[dict]:
+        start = time.monotonic()
+        try:
+            replica.client._check_simulated_error()
+            rets = replica.client.retrieve(query, k, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            print(f"Error from {replica.name}: {e}")
+            replica.errors += 1
+            replica.healthy = False
+            raise
+        except Exception as e:
+            print(f"Error from {replica.name}: {e}")
+            replica.errors += 1
+            raise
+        replica.observe(time.monotonic() - start)
+        return rets
+
+    @staticmethod
+    def _merge(results: list[list[dict]], k: int) -> list[dict]:
+        """
+        Reciprocal rank fusion of the results of the servers: a document scores
+        sum(1 / (HYBRID_RRF_K + rank)) over the servers that returned it, and gets
+        `dist = -score`. The `dist` of different servers are not comparable (a
+        hybrid index returns negative fused scores, a KNN index cosine
+        distances), only their order within a server is.
+        """
+        results = [rets for rets in results if rets]
+        if len(results) == 1:
+            return sorted(results[0], key=lambda x: x["dist"])[:k]
+
+        fused = {}
+        for rets in results:
+            for rank, ret in enumerate(sorted(rets, key=lambda x: x["dist"]), start=1):
+                key = (ret["text"], json.dumps(ret["metadata"], sort_keys=True, default=str))
+                if key not in fused:
+                    fused[key] = {**ret, "dist": 0.0}
+                fused[key]["dist"] -= 1 / (config.HYBRID_RRF_K + rank)
+        return sorted(fused.values(), key=lambda x: x["dist"])[:k]
+
+    def _scatter_gather(self, query: str, k: int, kwargs: dict) -> list[list[dict]]:
+        futures = {
+            self._executor.submit(self._retrieve_from, replica, query, k, kwargs): replica
+            for replica in self._healthy_replicas()
+        }
+        done, not_done = wait(futures, timeout=self.timeout)
+        for future in not_done:
+            print(f"Timeout from {futures[future].name}")
+            future.cancel()
+        return [future.result() for future in done if future.exception() is None]
+
+    def _hedged(self, query: str, k: int, kwargs: dict) -> list[list[dict]]:
+        # fastest first, servers without latencies yet keep their order
+        remaining = sorted(
+            self._healthy_replicas(),
+            key=lambda r: r.percentile(self.hedge_percentile) or 0.0,
+        )
+        deadline = time.monotonic() + self.timeout
+        pending = set()
+        hedge_at = None
+
+        def launch():
+            nonlocal hedge_at
+            replica = remaining.pop(0)
+            pending.add(
+                self._executor.submit(self._retrieve_from, replica, query, k, kwargs)
+            )
+            delay = replica.percentile(
+                self.hedge_percentile, config.RETRIEVER_HEDGE_MIN_SAMPLES
+            )
+            hedge_at = time.monotonic() + delay if delay is not None else None
+
+        launch()
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline
+            if remaining and hedge_at is not None:
+                wait_until = min(wait_until, hedge_at)
+            done, pending = wait(
+                pending, timeout=max(wait_until - now, 0), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    return [future.result()]
+            if remaining and (done or (hedge_at is not None and time.monotonic() >= hedge_at)):
+                if not done:
+                    self.hedges += 1
+                launch()
+        return []
+
+    def retrieve(self, query: str, k: int = 4, **kwargs: Any) -> list[dict]:
+        """
+        Merged results of the servers, as dicts with "text", "metadata" and "dist".
+        `kwargs` are those of `PathwayVectorStoreClient.retrieve`.
+        """
+        if self.hedging:
+            results = self._hedged(query, k, kwargs)
         else:
-            print("Both servers are inactive")
-            print("Using server 1 as default")
-            return self.url1
+            results = self._scatter_gather(query, k, kwargs)
+        return self._merge(results, k)
 
     def query(
         self,
@@ -75,60 +263,27 @@ class CustomPathwayVectorStoreClient:
             filepath_globpattern: optional glob pattern specifying which documents
                 will be searched for this query.
         """
-
-        data = {"query": query, "k": k}
-        if metadata_filter is not None:
-            data["metadata_filter"] = metadata_filter
-        if filepath_globpattern is not None:
-            data["filepath_globpattern"] = filepath_globpattern
-        url = self.get_active_url() + "/v1/retrieve"
-        response = requests.post(
-            url,
-            data=json.dumps(data),
-            headers=self._get_request_headers(),
-            timeout=self.timeout,
+        return self.retrieve(
+            query,
+            k,
+            metadata_filter=metadata_filter,
+            filepath_globpattern=filepath_globpattern,
         )
 
-        responses = response.json()
-        return sorted(responses, key=lambda x: x["dist"])
-
     def similarity_search(self, query: str, k: int = 4, **kwargs: Any):
-        try:
-            response = requests.post(
-                self.url1 + "/v1/health",
-                json={},
-                headers={"Content-Type": "application/json"},
-                timeout=5,
-            )
-            text = response.text
-            print(f"Server 1: {text}")
-        except Exception as e:
-            print(f"Error: {e}")
-            text = "none"
-
-        try:
-            if text != "none":
-                ret1 = self.client1.similarity_search(query, k, **kwargs)
-            else:
-                ret1 = []
-        except Exception as e:
-            print(f"Error: {e}")
-            ret1 = []
-
-        try:
-            if text != "both":
-                ret2 = self.client2.similarity_search(query, k, **kwargs)
-            else:
-                ret2 = []
-        except Exception as e:
-            print(f"Error: {e}")
-            ret2 = []
-
-        return ret1 + ret2
+        return PathwayVectorStoreClient._to_documents(self.retrieve(query, k, **kwargs))
 
     # Make an alias
     __call__ = query
 
+    def stats(self) -> dict:
+        """Health and latencies of the servers, and the number of hedged queries."""
+        return {
+            "hedging": self.hedging,
+            "hedges": self.hedges,
+            "replicas": {replica.name: replica.info() for replica in self.replicas},
+        }
+
     def get_vectorstore_statistics(self):
         """Fetch basic statistics about the vector store."""
 
@@ -68,7 +68,7 @@ import os
 import state
 import jsonlines
 import nodes
-from llm import llm
+from llm import hedge_config, llm
 from utils import log_message
 import uuid
 import config
@@ -128,7 +128,7 @@ def check_context(state: state.OverallState):
 
     # Decision making
     decision_pipeline = decision_prompt | llm.with_structured_output(ContextCheckerDecision)
-    decision_data: ContextCheckerDecision = decision_pipeline.invoke({})  # type: ignore
+    decision_data: ContextCheckerDecision = decision_pipeline.invoke({}, config=hedge_config("check_context"))  # type: ignore
     log_message(f"Context Required: {decision_data.context_required}")
 
     # # Logging the execution tree
@@ -30,7 +30,7 @@ fallback strategies and retries.
 6. **retrieve_documents_with_quant_qual**:
    - Retrieves documents based on quantitative or qualitative question types.
    - It handles the retrieval differently based on the question's category, using different metadata types (e.g., tables, key-value pairs).
-   - Uses concurrent execution for optimized retrieval, especially for handling tables and key-value data types.
+   - Sends the text, table and key-value retrievals of all the question parts in a single `/v1/retrieve_batch` request.
 
 7. **Logging**:
    - The module includes detailed logging at each retrieval step, ensuring that the system's state can be tracked and analyzed for debugging and performance monitoring.
@@ -48,7 +48,7 @@ fallback strategies and retries.
 3. **Quantitative and Qualitative Retrieval**:
    - The `retrieve_documents_with_quant_qual` function retrieves documents based on whether the question is quantitative (involving tables, key-value pairs) or qualitative.
    - For quantitative questions, it retrieves documents with different metadata types (e.g., tables, key-value pairs) and processes them accordingly.
-   - This function also handles concurrent retrieval requests to optimize the process.
+   - All of these retrievals are batched into one request to the vector store.
 
 4. **Fallback and Retry Logic**:
    - Several fallback mechanisms are in place to ensure the system retrieves relevant documents, even if initial attempts fail.
@@ -67,7 +67,7 @@ fallback strategies and retries.
    - If no documents are retrieved, retries occur based on the retry counters.
 
 3. **Quantitative and Qualitative Handling**:
-   - The system differentiates between quantitative and qualitative questions and applies appropriate retrieval strategies, including concurrent requests for different types of data (e.g., table data, key-value pairs).
+   - The system differentiates between quantitative and qualitative questions and applies appropriate retrieval strategies, including a single batched request for the different types of data (e.g., table data, key-value pairs).
 
 4. **Logging**:
    - The retrieval process is logged, and the log tree helps track the document retrieval flow from start to finish.
@@ -84,7 +84,6 @@ fallback strategies and retries.
 - **retriever**: For querying the document retrieval system (e.g., BM25-based retrieval).
 - **utils.send_logs**: For sending logs to a logging server for monitoring and debugging.
 - **nodes**: For logging node transitions and metadata conversion during document retrieval.
-- **concurrent.futures**: For handling parallel document retrieval in a multithreaded manner, especially for processing multiple types of data (e.g., tables, key-value pairs).
 
 """
 
@@ -95,7 +94,6 @@ from retriever import retriever
 from utils import log_message
 from .quant_qual import qq_classifier
 import uuid
-import concurrent.futures
 from utils import send_logs
 from config import LOGGING_SETTINGS
 
@@ -334,63 +332,33 @@ def retrieve_documents_with_quant_qual(state: state.InternalRAGState):
     docs = []
     docs_kv = []
 
-    for question in questions:
-        ## Routing
-        cat = state["category"]
-        if cat == "Quantitative":
-            ## Quantitative
-            if config.WORKFLOW_SETTINGS["with_table_for_quant_qual"]:
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future_text = executor.submit(
-                        retriever_helper,
-                        retriever,
-                        question,
-                        config.NUM_DOCS_TO_RETRIEVE,
-                        metadata_text,
-                    )
-                    future_table = executor.submit(
-                        retriever_helper,
-                        retriever,
-                        question,
-                        config.NUM_DOCS_TO_RETRIEVE_TABLE,
-                        metadata_table,
-                    )
-                    future_kv = executor.submit(
-                        retriever_helper,
-                        retriever,
-                        question,
-                        config.NUM_DOCS_TO_RETRIEVE_KV,
-                        metadata_kv,
-                    )
-                    docs += (
-                        future_text.result()
-                        + future_table.result()
-                        + future_kv.result()
-                    )
-                    docs_kv += future_kv.result()
-            else:
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future_text_table = executor.submit(
-                        retriever_helper,
-                        retriever,
-                        question,
-                        config.NUM_DOCS_TO_RETRIEVE,
-                        formatted_metadata,
-                    )
-                    future_kv = executor.submit(
-                        retriever_helper,
-                        retriever,
-                        question,
-                        config.NUM_DOCS_TO_RETRIEVE_KV,
-                        metadata_kv,
-                    )
-                    docs += future_text_table.result() + future_kv.result()
-                    docs_kv += future_kv.result()
+    ## Routing: (k, metadata filter, is key-value) of the retrievals of each question
+    cat = state["category"]
+    if cat == "Quantitative":
+        if config.WORKFLOW_SETTINGS["with_table_for_quant_qual"]:
+            searches = [
+                (config.NUM_DOCS_TO_RETRIEVE, metadata_text, False),
+                (config.NUM_DOCS_TO_RETRIEVE_TABLE, metadata_table, False),
+            ]
         else:
-            ## Qualitative
-            docs += retriever_helper(
-                retriever, question, config.NUM_DOCS_TO_RETRIEVE, formatted_metadata
-            )
+            searches = [(config.NUM_DOCS_TO_RETRIEVE, formatted_metadata, False)]
+        searches.append((config.NUM_DOCS_TO_RETRIEVE_KV, metadata_kv, True))
+    else:
+        ## Qualitative
+        searches = [(config.NUM_DOCS_TO_RETRIEVE, formatted_metadata, False)]
+
+    # all the retrievals of all the questions in a single request
+    items = [
+        {"query": question, "k": num_docs, "metadata_filter": filter or None}
+        for question in questions
+        for num_docs, filter, _ in searches
+    ]
+    results = retriever.similarity_search_batch(items)
+    for item_docs, (_, _, is_kv) in zip(results, searches * len(questions)):
+        docs += item_docs
+        if is_kv:
+            docs_kv += item_docs
+    question = questions[-1]
 
     ## Fallback when 0 doc retrieved
     flag = False
@@ -56,7 +56,7 @@ get_required_value_prompt = ChatPromptTemplate.from_template(
     prompts.get_required_value_prompt
 )
 
-value_llm = get_required_value_prompt | llm.with_structured_output(Value)
+value_llm = get_required_value_prompt | llm.with_structured_output(Value).cached("value_llm")
 
 
 def retriever_helper(retriever, question, num_docs, filter):
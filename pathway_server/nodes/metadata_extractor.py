@@ -86,7 +86,7 @@ metadata_extraction_with_qq_prompt = ChatPromptTemplate.from_messages(
 )
 metadata_extractor_qq = metadata_extraction_with_qq_prompt | llm.with_structured_output(
     QueryMetadata_QQ
-)
+).cached("metadata_extractor_qq")
 
 
 def extract_metadata_1(state: state.InternalRAGState):
@@ -29,7 +29,7 @@ from utils import log_message
 from langchain_core.output_parsers import StrOutputParser
 from prompt import prompts
 import state
-from llm import llm
+from llm import hedge_config, llm
 import uuid
 from utils import send_logs
 from config import LOGGING_SETTINGS
@@ -54,7 +54,9 @@ path_decider_prompt = ChatPromptTemplate.from_messages(
     [("system", _system_prompt_for_path_decider), ("human", "User query: {query}")]
 )
 
-query_path_decider = path_decider_prompt | llm.with_structured_output(PathDecider)
+query_path_decider = path_decider_prompt | llm.with_structured_output(
+    PathDecider
+).cached("query_path_decider")
 
 
 def path_decider(state: state.OverallState):
@@ -89,7 +91,9 @@ split_path_first_decider = split_decider_first_prompt | llm.with_structured_outp
 def split_path_decider_1(state: state.OverallState):
     log_message("---DECIDING THE PATH FOR THE QUERY---")
     query = state["question"]
-    path_decider_output = split_path_first_decider.invoke({"query": query})
+    path_decider_output = split_path_first_decider.invoke(
+        {"query": query}, config=hedge_config("split_path_decider_1")
+    )
     log_message(
         f"---DECIDED THE PATH FOR THE QUERY: {path_decider_output.path_decided}---"
     )
@@ -32,4 +32,6 @@ routing_prompt_template = ChatPromptTemplate.from_messages(
 )
 
 # Define the routing pipeline
-qq_classifier = routing_prompt_template | llm.with_structured_output(RouteSchema)
+qq_classifier = routing_prompt_template | llm.with_structured_output(
+    RouteSchema
+).cached("qq_classifier")
@@ -827,7 +827,7 @@ Answers:
     ]
 )
 
-cache_answer = cache_answer_prompt | llm.with_structured_output(CacheSufficient)
+cache_answer = cache_answer_prompt | llm.with_structured_output(CacheSufficient).cached("cache_answer")
 
 def cache_retriever_call(query):
     try:
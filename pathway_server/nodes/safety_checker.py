@@ -13,7 +13,7 @@ from langchain_core.prompts import ChatPromptTemplate
 from utils import log_message, image_to_description
 from prompt import prompts
 import state, nodes, config
-from llm import llm
+from llm import hedge_config, llm
 from utils import send_logs
 from config import LOGGING_SETTINGS
 
@@ -37,7 +37,9 @@ safety_prompt = ChatPromptTemplate.from_messages(
     ],
 )
 
-query_safety_checker = safety_prompt | llm.with_structured_output(SafetyChecker)
+query_safety_checker = safety_prompt | llm.with_structured_output(SafetyChecker).cached(
+    "query_safety_checker"
+)
 
 
 def check_safety(state: state.OverallState):
@@ -49,7 +51,10 @@ def check_safety(state: state.OverallState):
         image_path = ""
 
     image_url, image_desc = image_to_description(image_path)
-    safety_output = query_safety_checker.invoke({"query": question, "image_desc": image_desc})
+    safety_output = query_safety_checker.invoke(
+        {"query": question, "image_desc": image_desc},
+        config=hedge_config("check_safety"),
+    )
 
     log_message(f"{safety_output.modified_query}")
 
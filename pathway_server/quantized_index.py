@@ -0,0 +1,386 @@
+"""
+Brute force KNN index storing the embeddings quantized in memory.
+
+Pathway's built-in KNN indices keep every embedding as float32 (6 KB per chunk with
+1536 dimensions). `QuantizedKnn` keeps a float16 copy (2x smaller) or an int8 copy
+with a per-vector scale (~4x smaller) instead, scores all the chunks with it, and
+re-scores the `QUANTIZED_RESCORE_FACTOR * k` best candidates with the full
+precision vectors, which are kept on disk and only read for these candidates.
+
+The rows a `metadata_filter` can match are looked up in an inverted index of
+the `METADATA_INDEX_FIELDS` first (see `metadata_index.py`), so a filtered query
+only scores the vectors of the matching chunks, whatever the size of the corpus.
+
+Select it with `VECTOR_INDEX_TYPE = "quantized"` and `VECTOR_QUANTIZATION`. The
+memory used by the indices of a server is reported by `/v1/statistics`.
+"""
+
+import os
+import resource
+import tempfile
+import threading
+from dataclasses import dataclass, field
+
+import jmespath
+import numpy as np
+import pathway as pw
+from pathway.stdlib.indexing.colnames import _INDEX_REPLY
+from pathway.stdlib.indexing.data_index import InnerIndex
+from pathway.stdlib.indexing.nearest_neighbors import KnnIndexFactory
+from pathway.stdlib.ml.classifiers import _knn_lsh
+from pathway.xpacks.llm.document_store import DocumentStore
+
+import config
+from metadata_index import MetadataIndex
+from udf_caches import embedding_cache_stats
+
+QUANTIZATIONS = ("fp16", "int8")
+
+# rows scored at once, bounds the float32 temporaries of a query
+_BLOCK_ROWS = 16384
+
+# all the quantized vector stores of this process, for the memory statistics
+_stores: list["QuantizedVectorStore"] = []
+
+
+class QuantizedVectorStore:
+    """
+    Quantized copies of unit-normalized vectors, with the float32 originals in a
+    file under `directory`.
+
+    Args:
+        dimensions (int): Dimensions of the vectors
+        quantization (str): "fp16" or "int8" (per-vector scale)
+        rescore_factor (int): Candidates re-scored in full precision, per match
+        reserved_space (int): Initial capacity, grows as needed
+        directory (str): Directory of the full precision vectors
+    """
+
+    def __init__(
+        self,
+        dimensions: int,
+        quantization: str = config.VECTOR_QUANTIZATION,
+        rescore_factor: int = config.QUANTIZED_RESCORE_FACTOR,
+        reserved_space: int = config.VECTOR_INDEX_RESERVED_SPACE,
+        directory: str = config.QUANTIZED_INDEX_DIR,
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        self.dimensions = dimensions
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+
+        self._lock = threading.Lock()
+        dtype = np.float16 if quantization == "fp16" else np.int8
+        self._vectors = np.zeros((reserved_space, dimensions), dtype=dtype)
+        self._scales = np.ones(reserved_space, dtype=np.float32)
+        self._live = np.zeros(reserved_space, dtype=bool)
+        self._keys: list = [None] * reserved_space
+        self._metadata: list = [None] * reserved_space
+        self._slots: dict = {}
+        self._free: list[int] = []
+        self._size = 0
+        self._metadata_index = MetadataIndex()
+
+        os.makedirs(directory, exist_ok=True)
+        # unlinked at once, its space is freed when the process ends, even on a crash
+        self._file = tempfile.TemporaryFile(dir=directory, suffix=".f32")
+        _stores.append(self)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _grow(self):
+        capacity = max(2 * len(self._vectors), 1)
+        extra = capacity - len(self._vectors)
+        self._vectors = np.concatenate(
+            [self._vectors, np.zeros((extra, self.dimensions), self._vectors.dtype)]
+        )
+        self._scales = np.concatenate([self._scales, np.ones(extra, np.float32)])
+        self._live = np.concatenate([self._live, np.zeros(extra, bool)])
+        self._keys.extend([None] * extra)
+        self._metadata.extend([None] * extra)
+
+    def _quantize(self, vector: np.ndarray) -> tuple[np.ndarray, float]:
+        if self.quantization == "fp16":
+            return vector.astype(np.float16), 1.0
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        return np.round(vector / scale).astype(np.int8), scale
+
+    def add(self, key, vector, metadata=None):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        quantized, scale = self._quantize(vector)
+        with self._lock:
+            if key in self._slots:
+                slot = self._slots[key]
+                self._metadata_index.remove(slot, self._metadata[slot])
+            elif self._free:
+                slot = self._free.pop()
+            else:
+                if self._size == len(self._vectors):
+                    self._grow()
+                slot = self._size
+                self._size += 1
+            self._vectors[slot] = quantized
+            self._scales[slot] = scale
+            self._live[slot] = True
+            self._keys[slot] = key
+            self._metadata[slot] = metadata
+            self._metadata_index.add(slot, metadata)
+            self._slots[key] = slot
+            os.pwrite(self._file.fileno(), vector.tobytes(), slot * vector.nbytes)
+
+    def remove(self, key):
+        with self._lock:
+            slot = self._slots.pop(key, None)
+            if slot is None:
+                return
+            self._live[slot] = False
+            self._metadata_index.remove(slot, self._metadata[slot])
+            self._keys[slot] = None
+            self._metadata[slot] = None
+            self._free.append(slot)
+
+    def _full_precision(self, slots) -> np.ndarray:
+        row_bytes = self.dimensions * 4
+        return np.stack(
+            [
+                np.frombuffer(
+                    os.pread(self._file.fileno(), row_bytes, int(slot) * row_bytes),
+                    dtype=np.float32,
+                )
+                for slot in slots
+            ]
+        )
+
+    def _matching_slots(self, metadata_filter: str) -> np.ndarray:
+        candidates = self._metadata_index.candidates(metadata_filter)
+        if candidates is None:
+            slots = np.flatnonzero(self._live[: self._size])
+        else:
+            slots = np.fromiter(sorted(candidates), dtype=np.int64, count=len(candidates))
+        expression = jmespath.compile(metadata_filter)
+        return np.array(
+            [
+                slot
+                for slot in slots
+                if expression.search(
+                    # the `globmatch` of the filters built by `DocumentStore.merge_filters`
+                    self._metadata[slot], _knn_lsh._glob_options
+                )
+            ],
+            dtype=np.int64,
+        )
+
+    def _score(self, query: np.ndarray, slots: np.ndarray | None) -> np.ndarray:
+        # scores of `slots`, or of all the rows if None
+        count = self._size if slots is None else len(slots)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, _BLOCK_ROWS):
+            end = min(start + _BLOCK_ROWS, count)
+            rows = slice(start, end) if slots is None else slots[start:end]
+            block = self._vectors[rows].astype(np.float32)
+            scores[start:end] = (block @ query) * self._scales[rows]
+        return scores
+
+    def search(self, query, k: int, metadata_filter: str | None = None) -> list:
+        """
+        Returns the `k` closest (key, score) pairs, best first. The score is minus
+        the cosine distance, as with `BruteForceKnnMetricKind.COS`.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            if k <= 0 or not self._slots:
+                return []
+            if metadata_filter:
+                # only the vectors of the matching chunks are scored
+                slots = self._matching_slots(metadata_filter)
+                scores = self._score(query, slots)
+                candidates_count = min(k * self.rescore_factor, len(slots))
+            else:
+                slots = None
+                scores = self._score(query, None)
+                scores[~self._live[: self._size]] = -np.inf
+                candidates_count = min(k * self.rescore_factor, len(self._slots))
+            if candidates_count == 0:
+                return []
+
+            candidates = np.argpartition(-scores, candidates_count - 1)[
+                :candidates_count
+            ]
+            if slots is not None:
+                candidates = slots[candidates]
+
+            exact = self._full_precision(candidates) @ query
+            order = np.argsort(-exact)[:k]
+            return [
+                (self._keys[candidates[i]], float(exact[i]) - 1.0) for i in order
+            ]
+
+    def memory_stats(self) -> dict:
+        live = len(self._slots)
+        with self._lock:
+            metadata_index_values = self._metadata_index.stats()
+        return {
+            "quantization": self.quantization,
+            "vectors": live,
+            "dimensions": self.dimensions,
+            "quantized_bytes": int(self._vectors.nbytes + self._scales.nbytes),
+            "float32_bytes": live * self.dimensions * 4,
+            "full_precision_bytes_on_disk": os.fstat(self._file.fileno()).st_size,
+            "metadata_index_values": metadata_index_values,
+        }
+
+
+def process_memory_stats() -> dict:
+    """Resident memory of this process and of its quantized indices."""
+    try:
+        with open("/proc/self/statm") as f:
+            rss_bytes = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        rss_bytes = None
+    return {
+        "pid": os.getpid(),
+        "rss_bytes": rss_bytes,
+        # kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "quantized_indices": [store.memory_stats() for store in _stores],
+    }
+
+
+@dataclass(frozen=True, kw_only=True)
+class QuantizedKnn(InnerIndex):
+    """
+    Brute force KNN index over quantized vectors, see `QuantizedVectorStore`.
+
+    Only supports `query_as_of_now`, like `BruteForceKnn`.
+    """
+
+    dimensions: int
+    quantization: str = config.VECTOR_QUANTIZATION
+    rescore_factor: int = config.QUANTIZED_RESCORE_FACTOR
+    reserved_space: int = config.VECTOR_INDEX_RESERVED_SPACE
+    embedder: pw.UDF | None = None
+
+    _store: QuantizedVectorStore = field(init=False)
+
+    def __post_init__(self):
+        store = QuantizedVectorStore(
+            self.dimensions,
+            quantization=self.quantization,
+            rescore_factor=self.rescore_factor,
+            reserved_space=self.reserved_space,
+        )
+        object.__setattr__(self, "_store", store)
+
+        data = self.data_column.table
+        vectors = data.select(
+            vector=(
+                self.embedder(self.data_column) if self.embedder else self.data_column
+            ),
+            metadata=self.metadata_column if self.metadata_column is not None else None,
+        )
+
+        def on_change(key, row, time, is_addition):
+            if is_addition:
+                metadata = row["metadata"]
+                if isinstance(metadata, pw.Json):
+                    metadata = metadata.value
+                store.add(key, row["vector"], metadata)
+            else:
+                store.remove(key)
+
+        pw.io.subscribe(vectors, on_change=on_change)
+
+    def query(
+        self,
+        query_column: pw.ColumnReference,
+        number_of_matches: pw.ColumnExpression | int = 3,
+        metadata_filter: pw.ColumnExpression | None = None,
+    ) -> pw.Table:
+        raise NotImplementedError(
+            "The quantized knn index is supported only in the as-of-now variant"
+        )
+
+    def query_as_of_now(
+        self,
+        query_column: pw.ColumnReference,
+        number_of_matches: pw.ColumnExpression | int = 3,
+        metadata_filter: pw.ColumnExpression | None = None,
+    ) -> pw.Table:
+        store = self._store
+
+        @pw.udf(deterministic=False)
+        def search(vector, k: int, metadata_filter: str | None) -> list[tuple[pw.Pointer, float]]:
+            return store.search(vector, k, metadata_filter)
+
+        queries = query_column.table
+        return queries.select(
+            **{
+                _INDEX_REPLY: search(
+                    self.embedder(query_column) if self.embedder else query_column,
+                    number_of_matches,
+                    metadata_filter,
+                )
+            }
+        )
+
+
+@dataclass(kw_only=True)
+class QuantizedKnnFactory(KnnIndexFactory):
+    """
+    Factory of `QuantizedKnn` indices.
+
+    Args:
+        dimensions (int): Dimensions of the embeddings
+        quantization (str): "fp16" or "int8"
+        rescore_factor (int): Candidates re-scored in full precision, per match
+        reserved_space (int): Initial capacity of the index
+        embedder (pw.UDF): Embedder of the indexed texts and of the queries
+    """
+
+    quantization: str = config.VECTOR_QUANTIZATION
+    rescore_factor: int = config.QUANTIZED_RESCORE_FACTOR
+    reserved_space: int = config.VECTOR_INDEX_RESERVED_SPACE
+
+    def build_inner_index(
+        self,
+        data_column: pw.ColumnReference,
+        metadata_column: pw.ColumnExpression | None = None,
+    ) -> QuantizedKnn:
+        return QuantizedKnn(
+            data_column=data_column,
+            metadata_column=metadata_column,
+            dimensions=self.dimensions,
+            quantization=self.quantization,
+            rescore_factor=self.rescore_factor,
+            reserved_space=self.reserved_space,
+            embedder=self.embedder,
+        )
+
+
+@pw.udf(deterministic=False)
+def add_memory_stats(stats: pw.Json) -> pw.Json:
+    return pw.Json(
+        {
+            **stats.as_dict(),
+            "memory": process_memory_stats(),
+            "embedding_cache": embedding_cache_stats(),
+        }
+    )
+
+
+class MemoryStatsDocumentStore(DocumentStore):
+    """
+    `DocumentStore` whose `/v1/statistics` also reports the memory of the server
+    process and of its quantized indices, so each replica can be checked.
+    """
+
+    @pw.table_transformer
+    def statistics_query(
+        self, info_queries: pw.Table[DocumentStore.StatisticsQuerySchema]
+    ) -> pw.Table[DocumentStore.QueryResultSchema]:
+        results = super().statistics_query(info_queries)
+        return results.select(result=add_memory_stats(pw.this.result))
@@ -1,34 +1,577 @@
+import asyncio
+import copy
+import json
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict, defaultdict
 from typing import Optional
 
+import aiohttp
+import requests
+
 from langchain_community.vectorstores import PathwayVectorClient
+from langchain_core.documents import Document
 from pathway.xpacks.llm.vector_store import VectorStoreClient
 
 import config
 
 
+class RetrievalCache:
+    """
+    LRU cache of retrieval results with a time to live, tagged with the version
+    of the index they were retrieved from: setting a different version clears it.
+
+    Args:
+        max_size (int): Maximum number of cached results
+        ttl (float): Seconds after which a result is retrieved again
+    """
+
+    def __init__(
+        self,
+        max_size: int = config.RETRIEVAL_CACHE_SIZE,
+        ttl: float = config.RETRIEVAL_CACHE_TTL_S,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def get(self, key: str) -> Optional[list[dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self._counts["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+        # callers may modify the documents they get
+        return copy.deepcopy(entry[1])
+
+    def put(self, key: str, value: list[dict], version=None):
+        """Caches `value`, unless it was retrieved from an older `version`."""
+        value = copy.deepcopy(value)
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counts["evictions"] += 1
+
+    def set_version(self, version):
+        with self._lock:
+            if version == self.version:
+                return
+            if self.version is not None:
+                self._counts["invalidations"] += 1
+            self.version = version
+            self._entries.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            lookups = self._counts["hits"] + self._counts["misses"]
+            return {
+                **self._counts,
+                "size": len(self._entries),
+                "hit_rate": self._counts["hits"] / lookups if lookups else 0.0,
+                "index_version": self.version,
+            }
+
+
+async def _session_lifetime(session: aiohttp.ClientSession):
+    # suspended for the life of the loop; `loop.shutdown_asyncgens()` (run by
+    # `asyncio.run` when its loop finishes) resumes it, which closes the session
+    try:
+        yield
+    finally:
+        await session.close()
+
+
 class PathwayVectorStoreClient(PathwayVectorClient):
+    """
+    Client of a Pathway `DocumentStoreServer`, usable wherever langchain's
+    `PathwayVectorClient` is.
+
+    Requests go through long-lived keep-alive sessions instead of a new
+    connection per query: a pooled `requests.Session` for the blocking methods,
+    and one `aiohttp.ClientSession` per event loop for the async ones
+    (`asimilarity_search`, `aquery`, `aretrieve`), so graph nodes can await
+    retrieval instead of holding a worker thread. A loop's session is closed when
+    `asyncio.run` finishes it, or by `aclose`.
+
+    Results of `retrieve` (and of every query of `retrieve_batch`) are kept in a
+    `RetrievalCache`, keyed by the whitespace-normalized query and the other
+    arguments of the request. It is cleared whenever the file count or the last
+    indexing time in the `/v1/statistics` of the server change, checked at most
+    every `cache_version_check` seconds. `use_cache=False`, or
+    `config.RETRIEVAL_CACHE_BYPASS`, sends every query to the server.
+
+    Args:
+        host, port, url: Address of the server, as for `PathwayVectorClient`
+        timeout (float): Default timeout of a request, in seconds
+        retrieval_mode (str): Default retrieval mode, None uses the server's
+        pool_size (int): Maximum number of open connections to the server
+        use_cache (bool): Whether to cache the retrieval results
+        cache_size (int): Maximum number of cached results
+        cache_ttl (float): Seconds for which a result is cached
+        cache_version_check (float): Seconds between checks of the index version
+    """
+
     def __init__(
         self,
         host: Optional[str] = None,
         port: Optional[int] = None,
         url: Optional[str] = None,
         timeout: int = config.VECTOR_STORE_TIMEOUT,
+        retrieval_mode: Optional[str] = None,
+        pool_size: int = config.VECTOR_STORE_POOL_SIZE,
+        use_cache: bool = True,
+        cache_size: int = config.RETRIEVAL_CACHE_SIZE,
+        cache_ttl: float = config.RETRIEVAL_CACHE_TTL_S,
+        cache_version_check: float = config.RETRIEVAL_CACHE_VERSION_CHECK_S,
     ):
         super().__init__(host, port, url)
 
         self.client = VectorStoreClient(host, port, url, timeout)
-    
-    
+        # None lets the server use its default (`RETRIEVAL_MODE`)
+        self.retrieval_mode = retrieval_mode
+        self.pool_size = pool_size
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # aiohttp sessions can only be used from the loop they were created in
+        self._async_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._async_sessions_lock = threading.Lock()
+
+        self.use_cache = use_cache
+        self.cache = RetrievalCache(cache_size, cache_ttl)
+        self.cache_version_check = cache_version_check
+        self._version_checked_at = float("-inf")
+        self._version_lock = threading.Lock()
 
-    def similarity_search(self, *args, **kwargs):
+    async def _async_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        with self._async_sessions_lock:
+            entry = self._async_sessions.get(loop)
+            if entry is not None and not entry[0].closed:
+                return entry[0]
+            # a session references its loop, so finished loops are never collected
+            for closed_loop in [l for l in self._async_sessions if l.is_closed()]:
+                del self._async_sessions[closed_loop]
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers={"Content-Type": "application/json"},
+            )
+            lifetime = _session_lifetime(session)
+            # the loop only keeps a weak reference to the generator
+            self._async_sessions[loop] = (session, lifetime)
+        await anext(lifetime)
+        return session
+
+    def _check_simulated_error(self):
         # Check config for RETRIEVER_FALL_BACK
         if config.SIMULATE_ERRORS["retriever"]:
             raise ValueError("Simulating error in `retriever`")
-        else:
-            # Call the parent class's similarity_search method
-            return super().similarity_search(*args, **kwargs)
-    
 
+    def _request_data(
+        self,
+        query: str,
+        k: int,
+        retrieval_mode: Optional[str] = None,
+        fusion_weights: Optional[dict] = None,
+        metadata_filter: Optional[str] = None,
+        filepath_globpattern: Optional[str] = None,
+    ) -> dict:
+        data = {"query": query, "k": k}
+        if metadata_filter is not None:
+            data["metadata_filter"] = metadata_filter
+        if filepath_globpattern is not None:
+            data["filepath_globpattern"] = filepath_globpattern
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+        if retrieval_mode is not None:
+            data["retrieval_mode"] = retrieval_mode
+        for index, weight in (fusion_weights or {}).items():
+            data[f"{index}_weight"] = weight
+        return data
+
+    def _caching(self, use_cache: Optional[bool]) -> bool:
+        if config.RETRIEVAL_CACHE_BYPASS:
+            return False
+        return self.use_cache if use_cache is None else use_cache
+
+    @staticmethod
+    def _cache_key(data: dict) -> str:
+        return json.dumps(
+            {**data, "query": " ".join(data["query"].split())}, sort_keys=True
+        )
+
+    def _version_check_due(self) -> bool:
+        # a single caller checks the version once it is due
+        with self._version_lock:
+            now = time.monotonic()
+            if now - self._version_checked_at < self.cache_version_check:
+                return False
+            self._version_checked_at = now
+            return True
+
+    @staticmethod
+    def _index_version(statistics: dict):
+        return (
+            statistics.get("file_count"),
+            statistics.get("last_modified"),
+            statistics.get("last_indexed"),
+        )
+
+    def _check_index_version(self):
+        if not self._version_check_due():
+            return
+        try:
+            response = self._session.post(
+                self.client.url + "/v1/statistics",
+                data=json.dumps({}),
+                headers={"Content-Type": "application/json"},
+                timeout=self.client.timeout,
+            )
+            self.cache.set_version(self._index_version(response.json()))
+        except Exception as e:
+            # the index may have changed, so stop using the cached results
+            print(f"Error checking the index version of {self.client.url}: {e}")
+            self.cache.set_version(None)
+
+    async def _acheck_index_version(self):
+        if not self._version_check_due():
+            return
+        try:
+            async with (await self._async_session()).post(
+                self.client.url + "/v1/statistics",
+                data=json.dumps({}),
+                timeout=aiohttp.ClientTimeout(total=self.client.timeout),
+            ) as response:
+                statistics = await response.json(content_type=None)
+            self.cache.set_version(self._index_version(statistics))
+        except Exception as e:
+            print(f"Error checking the index version of {self.client.url}: {e}")
+            self.cache.set_version(None)
+
+    def _cached(self, keys: list[str]) -> tuple[list, object]:
+        """Cached results of `keys` (None if missing) and the current version."""
+        version = self.cache.version
+        if version is None:
+            return [None] * len(keys), None
+        return [self.cache.get(key) for key in keys], version
+
+    def cache_stats(self) -> dict:
+        """Hits, misses, hit rate and invalidations of the result cache."""
+        return self.cache.summary()
+
+    @staticmethod
+    def _to_documents(rets: list[dict]) -> list[Document]:
+        return [
+            Document(page_content=ret["text"], metadata=ret["metadata"])
+            for ret in rets
+        ]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        retrieval_mode: Optional[str] = None,
+        fusion_weights: Optional[dict] = None,
+        **kwargs,
+    ):
+        """
+        Args:
+            retrieval_mode: "knn", "bm25" or "hybrid", only served by a `HybridDocumentStore`
+            fusion_weights: {"knn": .., "bm25": ..} weights of the hybrid mode
+        """
+        self._check_simulated_error()
+        rets = self.retrieve(query, k, retrieval_mode, fusion_weights, **kwargs)
+        return self._to_documents(rets)
+
+    async def asimilarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        retrieval_mode: Optional[str] = None,
+        fusion_weights: Optional[dict] = None,
+        **kwargs,
+    ):
+        """Async `similarity_search`."""
+        self._check_simulated_error()
+        rets = await self.aretrieve(query, k, retrieval_mode, fusion_weights, **kwargs)
+        return self._to_documents(rets)
+
+    def retrieve(
+        self,
+        query: str,
+        k: int,
+        retrieval_mode: Optional[str] = None,
+        fusion_weights: Optional[dict] = None,
+        metadata_filter: Optional[str] = None,
+        filepath_globpattern: Optional[str] = None,
+        timeout: Optional[float] = None,
+        use_cache: Optional[bool] = None,
+    ) -> list[dict]:
+        """
+        `VectorStoreClient.query` with the retrieval mode and fusion weights.
+        `use_cache` overrides the `use_cache` of the client for this call.
+        """
+        data = self._request_data(
+            query, k, retrieval_mode, fusion_weights, metadata_filter, filepath_globpattern
+        )
+        caching = self._caching(use_cache)
+        if caching:
+            self._check_index_version()
+            key = self._cache_key(data)
+            [cached], version = self._cached([key])
+            if cached is not None:
+                return cached
+
+        response = self._session.post(
+            self.client.url + "/v1/retrieve",
+            data=json.dumps(data),
+            headers={"Content-Type": "application/json"},
+            timeout=timeout or self.client.timeout,
+        )
+        responses = sorted(response.json(), key=lambda x: x["dist"])
+        if caching and version is not None:
+            self.cache.put(key, responses, version)
+        return responses
+
+    async def aretrieve(
+        self,
+        query: str,
+        k: int,
+        retrieval_mode: Optional[str] = None,
+        fusion_weights: Optional[dict] = None,
+        metadata_filter: Optional[str] = None,
+        filepath_globpattern: Optional[str] = None,
+        timeout: Optional[float] = None,
+        use_cache: Optional[bool] = None,
+    ) -> list[dict]:
+        """Async `retrieve`."""
+        data = self._request_data(
+            query, k, retrieval_mode, fusion_weights, metadata_filter, filepath_globpattern
+        )
+        caching = self._caching(use_cache)
+        if caching:
+            await self._acheck_index_version()
+            key = self._cache_key(data)
+            [cached], version = self._cached([key])
+            if cached is not None:
+                return cached
+
+        async with (await self._async_session()).post(
+            self.client.url + "/v1/retrieve",
+            data=json.dumps(data),
+            timeout=aiohttp.ClientTimeout(total=timeout or self.client.timeout),
+        ) as response:
+            responses = sorted(
+                await response.json(content_type=None), key=lambda x: x["dist"]
+            )
+        if caching and version is not None:
+            self.cache.put(key, responses, version)
+        return responses
+
+    def retrieve_batch(
+        self,
+        items: list[dict],
+        timeout: Optional[float] = None,
+        use_cache: Optional[bool] = None,
+    ) -> list[list[dict]]:
+        """
+        Several `retrieve` calls in a single `/v1/retrieve_batch` request, where the
+        server embeds every distinct query once.
+
+        Args:
+            items: `retrieve` arguments of every query (`query`, `k`, and optionally
+                `metadata_filter`, `filepath_globpattern`, `retrieval_mode`,
+                `fusion_weights`)
+
+        Returns:
+            The results of every item, in order.
+        """
+        if not items:
+            return []
+        queries = [self._request_data(**item) for item in items]
+        caching = self._caching(use_cache)
+        if caching:
+            self._check_index_version()
+        results, version, missing = self._batch_from_cache(queries, caching)
+        if missing:
+            response = self._session.post(
+                self.client.url + "/v1/retrieve_batch",
+                data=json.dumps({"queries": [queries[i] for i in missing]}),
+                headers={"Content-Type": "application/json"},
+                timeout=timeout or self.client.timeout,
+            )
+            self._fill_batch(queries, results, version, missing, response.json())
+        return results
+
+    async def aretrieve_batch(
+        self,
+        items: list[dict],
+        timeout: Optional[float] = None,
+        use_cache: Optional[bool] = None,
+    ) -> list[list[dict]]:
+        """Async `retrieve_batch`."""
+        if not items:
+            return []
+        queries = [self._request_data(**item) for item in items]
+        caching = self._caching(use_cache)
+        if caching:
+            await self._acheck_index_version()
+        results, version, missing = self._batch_from_cache(queries, caching)
+        if missing:
+            async with (await self._async_session()).post(
+                self.client.url + "/v1/retrieve_batch",
+                data=json.dumps({"queries": [queries[i] for i in missing]}),
+                timeout=aiohttp.ClientTimeout(total=timeout or self.client.timeout),
+            ) as response:
+                responses = await response.json(content_type=None)
+            self._fill_batch(queries, results, version, missing, responses)
+        return results
+
+    def _batch_from_cache(self, queries: list[dict], caching: bool):
+        """Cached results of a batch, its version and the positions to retrieve."""
+        if not caching:
+            return [None] * len(queries), None, list(range(len(queries)))
+        results, version = self._cached([self._cache_key(q) for q in queries])
+        missing = [i for i, result in enumerate(results) if result is None]
+        return results, version, missing
+
+    def _fill_batch(self, queries, results, version, missing, responses):
+        for i, rets in zip(missing, responses):
+            results[i] = sorted(rets, key=lambda x: x["dist"])
+            if version is not None:
+                self.cache.put(self._cache_key(queries[i]), results[i], version)
+
+    def similarity_search_batch(
+        self, items: list[dict], use_cache: Optional[bool] = None
+    ) -> list[list[Document]]:
+        """`similarity_search` of every item of `retrieve_batch`, in one request."""
+        self._check_simulated_error()
+        return [
+            self._to_documents(rets)
+            for rets in self.retrieve_batch(items, use_cache=use_cache)
+        ]
+
+    async def asimilarity_search_batch(
+        self, items: list[dict], use_cache: Optional[bool] = None
+    ) -> list[list[Document]]:
+        """Async `similarity_search_batch`."""
+        self._check_simulated_error()
+        return [
+            self._to_documents(rets)
+            for rets in await self.aretrieve_batch(items, use_cache=use_cache)
+        ]
+
+    def query(
+        self,
+        query: str,
+        k: int = 3,
+        metadata_filter: Optional[str] = None,
+        filepath_globpattern: Optional[str] = None,
+    ) -> list[dict]:
+        """Same as `VectorStoreClient.query`, over the pooled session."""
+        return self.retrieve(
+            query,
+            k,
+            metadata_filter=metadata_filter,
+            filepath_globpattern=filepath_globpattern,
+        )
+
+    async def aquery(
+        self,
+        query: str,
+        k: int = 3,
+        metadata_filter: Optional[str] = None,
+        filepath_globpattern: Optional[str] = None,
+    ) -> list[dict]:
+        """Async `query`."""
+        return await self.aretrieve(
+            query,
+            k,
+            metadata_filter=metadata_filter,
+            filepath_globpattern=filepath_globpattern,
+        )
+
+    def get_blob(self, blob_hash: str) -> Optional[bytes]:
+        """Fetches a chunk image by the `image_hash` stored in its metadata."""
+        if not blob_hash:
+            return None
+        response = self._session.get(
+            f"{self.client.url}/v1/blob/{blob_hash}", timeout=self.client.timeout
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    async def aclose(self):
+        """
+        Closes the async session of the running event loop. Needed only for loops
+        closed without `shutdown_asyncgens()`, `asyncio.run` closes it itself.
+        """
+        with self._async_sessions_lock:
+            entry = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            await entry[1].aclose()
+
+    def close(self):
+        self._session.close()
+
+
+class RetrievalModeStats:
+    """
+    Counts, per retrieval mode, how the document grading of a question ends: with
+    relevant documents from the first retrieval ("first_try"), only after query
+    rewrites ("after_rewrite") or in a web search ("too_many_retries"). "rewrites"
+    counts the rewrite -> retrieve loops that were triggered. The mode is the one
+    the server applied (see `served_retrieval_mode`), stores without retrieval
+    modes are not counted.
+    """
+
+    def __init__(self):
+        self._counts: dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record(self, retrieval_mode: str, outcome: str):
+        with self._lock:
+            self._counts[retrieval_mode][outcome] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            summary = {}
+            for mode, counts in self._counts.items():
+                questions = (
+                    counts["first_try"]
+                    + counts["after_rewrite"]
+                    + counts["too_many_retries"]
+                )
+                summary[mode] = {
+                    **counts,
+                    # share of the questions that needed no rewrite loop
+                    "loop_avoided_rate": counts["first_try"] / questions
+                    if questions
+                    else 0.0,
+                }
+            return summary
+
+
+retrieval_mode_stats = RetrievalModeStats()
 
 retriever = PathwayVectorStoreClient(
     url=f"http://{config.VECTOR_STORE_HOST}:{config.VECTOR_STORE_PORT}",
@@ -12,15 +12,13 @@ import pathway as pw
 from pathway.udfs import DiskCache, ExponentialBackoffRetryStrategy
 from pathway.xpacks.llm import embedders, llms
 from pathway.xpacks.llm.parsers import OpenParse
-from pathway.stdlib.indexing import (
-    BruteForceKnnFactory,
-    HybridIndexFactory,
-    UsearchKnnFactory,
-)
-from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
-from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.servers import DocumentStoreServer
 import config
+from metadata_cache import COMPANY_YEAR, MetadataCache, document_fingerprint
+from index_factory import make_retriever_factory
+from quantized_index import MemoryStatsDocumentStore
+from batch_retrieval import serve_retrieve_batch
+from udf_caches import SharedEmbeddingCache
 from llm import llm
 
 os.environ["TESSDATA_PREFIX"] = "/usr/share/tesseract-ocr/5/tessdata"
@@ -44,14 +42,26 @@ company_name_and_year_extractor_prompt = ChatPromptTemplate.from_messages(
 )
 company_name_and_year_extractor = (
     company_name_and_year_extractor_prompt
-    | llm.with_structured_output(FinancialStatementSchema)
+    | llm.with_structured_output(FinancialStatementSchema).cached(
+        "company_name_and_year_extractor"
+    )
 )
+# shared by all the indexer processes, hits skip the LLM call
+metadata_cache = MetadataCache()
 
 
-def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
+def extract_company_name_and_year_from_nodes(
+    nodes, fingerprint: str | None = None
+) -> FinancialStatementSchema:
     """
     Extracts the 'Company Name' and 'Year of Report' from a list of nodes.
+
+    If `fingerprint` is given, the shared metadata cache is checked first and the
+    LLM is only called on a miss.
     """
+    cached = metadata_cache.get_company_and_year(fingerprint)
+    if cached is not None:
+        return FinancialStatementSchema(**cached)
 
     # Combine text from nodes to form the document content
     nodes_first_three_pages = []
@@ -61,6 +71,7 @@ def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
     document_text = "\n".join(node.text for node in nodes_first_three_pages)
 
     res = company_name_and_year_extractor.invoke({"text": document_text})
+    metadata_cache.put(fingerprint, COMPANY_YEAR, res.model_dump())
 
     return res  # type: ignore
 
@@ -90,7 +101,7 @@ class CustomOpenParse(OpenParse):
         parsed_content = self.doc_parser.parse(doc)
         nodes = list(parsed_content.nodes)
         extracted_statement_schema = extract_company_name_and_year_from_nodes(
-            parsed_content.nodes
+            parsed_content.nodes, fingerprint=document_fingerprint(reader)
         )
 
         company_name = extracted_statement_schema.company_name.lower().strip()
@@ -147,8 +158,10 @@ parser_fast = CustomOpenParse(
     cache_strategy=DiskCache(),
 )
 embedder = embedders.OpenAIEmbedder(
-    # model="text-embedding-3-large",
-    cache_strategy=DiskCache()
+    model=config.OPENAI_EMBEDDING_MODEL,
+    # shared by all the servers of the host, a query repeated within a batch of
+    # retrievals is embedded once
+    cache_strategy=SharedEmbeddingCache(config.OPENAI_EMBEDDING_MODEL),
 )
 
 if __name__ == "__main__":
@@ -158,31 +171,18 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    knn_index = BruteForceKnnFactory(
-        reserved_space=1000,
-        embedder=embedder,
-        metric=pw.engine.BruteForceKnnMetricKind.COS,
-        dimensions=1536,
-    )
-    bm25_index = TantivyBM25Factory(
-        ram_budget=5000 * 1024 * 1024, in_memory_index=False
-    )
-    # usearch_knn_index = UsearchKnnFactory(embedder=embedder)
-
-    hybrid_index_factory = HybridIndexFactory(
-        retriever_factories=[bm25_index, knn_index],
-    )
+    index = make_retriever_factory(embedder, config.FAST_VECTOR_INDEX_TYPE)
 
     # doc_store_slow = DocumentStore(
     #     *sources,
-    #     retriever_factory=knn_index,
+    #     retriever_factory=index,
     #     splitter=None,  # OpenParse parser handles the chunking
     #     parser=parser,
     # )
 
-    doc_store_fast = DocumentStore(
+    doc_store_fast = MemoryStatsDocumentStore(
         *sources,
-        retriever_factory=hybrid_index_factory,
+        retriever_factory=index,
         splitter=None,  # OpenParse parser handles the chunking
         parser=parser_fast,
     )
@@ -192,6 +192,7 @@ if __name__ == "__main__":
         port=config.FAST_VECTOR_STORE_PORT,
         document_store=doc_store_fast,
     )
+    serve_retrieve_batch(server, doc_store_fast)
     server.run(
         cache_backend=pw.persistence.Backend.filesystem(
             config.FAST_VECTOR_STORE_CACHE_DIR
@@ -12,15 +12,12 @@ import pathway as pw
 from pathway.udfs import DiskCache, ExponentialBackoffRetryStrategy
 from pathway.xpacks.llm import embedders, llms
 from pathway.xpacks.llm.parsers import OpenParse
-from pathway.stdlib.indexing import (
-    BruteForceKnnFactory,
-    HybridIndexFactory,
-    UsearchKnnFactory,
-)
-from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
-from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.servers import DocumentStoreServer
 import config
+from metadata_cache import COMPANY_YEAR, MetadataCache, document_fingerprint
+from index_factory import make_retriever_factory
+from snapshot import SnapshotDocumentStore
+from udf_caches import SharedEmbeddingCache
 from llm import llm
 
 from multiserver import MultiDocumentServer
@@ -46,14 +43,26 @@ company_name_and_year_extractor_prompt = ChatPromptTemplate.from_messages(
 )
 company_name_and_year_extractor = (
     company_name_and_year_extractor_prompt
-    | llm.with_structured_output(FinancialStatementSchema)
+    | llm.with_structured_output(FinancialStatementSchema).cached(
+        "company_name_and_year_extractor"
+    )
 )
+# shared by all the indexer processes, hits skip the LLM call
+metadata_cache = MetadataCache()
 
 
-def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
+def extract_company_name_and_year_from_nodes(
+    nodes, fingerprint: str | None = None
+) -> FinancialStatementSchema:
     """
     Extracts the 'Company Name' and 'Year of Report' from a list of nodes.
+
+    If `fingerprint` is given, the shared metadata cache is checked first and the
+    LLM is only called on a miss.
     """
+    cached = metadata_cache.get_company_and_year(fingerprint)
+    if cached is not None:
+        return FinancialStatementSchema(**cached)
 
     # Combine text from nodes to form the document content
     nodes_first_three_pages = []
@@ -63,6 +72,7 @@ def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
     document_text = "\n".join(node.text for node in nodes_first_three_pages)
 
     res = company_name_and_year_extractor.invoke({"text": document_text})
+    metadata_cache.put(fingerprint, COMPANY_YEAR, res.model_dump())
 
     return res  # type: ignore
 
@@ -92,7 +102,7 @@ class CustomOpenParse(OpenParse):
         parsed_content = self.doc_parser.parse(doc)
         nodes = list(parsed_content.nodes)
         extracted_statement_schema = extract_company_name_and_year_from_nodes(
-            parsed_content.nodes
+            parsed_content.nodes, fingerprint=document_fingerprint(reader)
         )
 
         company_name = extracted_statement_schema.company_name.lower().strip()
@@ -155,9 +165,12 @@ parser_fast = CustomOpenParse(
     parse_images=False,
     cache_strategy=DiskCache(),
 )
+embedding_cache = SharedEmbeddingCache(config.OPENAI_EMBEDDING_MODEL)
 embedder = embedders.OpenAIEmbedder(
-    # model="text-embedding-3-large",
-    cache_strategy=DiskCache()
+    model=config.OPENAI_EMBEDDING_MODEL,
+    # shared by all the servers of the host, a query repeated within a batch of
+    # retrievals is embedded once
+    cache_strategy=embedding_cache,
 )
 
 if __name__ == "__main__":
@@ -167,33 +180,26 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    knn_index = BruteForceKnnFactory(
-        reserved_space=1000,
-        embedder=embedder,
-        metric=pw.engine.BruteForceKnnMetricKind.COS,
-        dimensions=1536,
-    )
-    bm25_index = TantivyBM25Factory(
-        ram_budget=5000 * 1024 * 1024, in_memory_index=False
-    )
-    # usearch_knn_index = UsearchKnnFactory(embedder=embedder)
-
-    hybrid_index_factory = HybridIndexFactory(
-        retriever_factories=[bm25_index, knn_index],
-    )
+    index = make_retriever_factory(embedder, config.VECTOR_INDEX_TYPE)
 
-    doc_store_slow1 = DocumentStore(
+    doc_store_slow1 = SnapshotDocumentStore(
         *sources1,
-        retriever_factory=knn_index,
+        retriever_factory=index,
         splitter=None,  # OpenParse parser handles the chunking
         parser=parser,
+        # only the files not in the snapshot are parsed and embedded
+        snapshot_path=config.WARM_START_SNAPSHOT,
+        embedding_cache=embedding_cache,
     )
 
-    doc_store_slow2 = DocumentStore(
+    doc_store_slow2 = SnapshotDocumentStore(
         *sources2,
-        retriever_factory=knn_index,
+        retriever_factory=index,
         splitter=None,  # OpenParse parser handles the chunking
         parser=parser,
+        # only the files not in the snapshot are parsed and embedded
+        snapshot_path=config.WARM_START_SNAPSHOT,
+        embedding_cache=embedding_cache,
     )
 
     server = MultiDocumentServer(
@@ -0,0 +1,80 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import logging
+import multiprocessing
+
+import pathway as pw
+from pathway.xpacks.llm.servers import DocumentStoreServer
+
+import config
+from batch_retrieval import serve_retrieve_batch
+from blob_store import BlobStore, serve_blobs
+from index_factory import make_bm25_factory, make_knn_factory
+from sharding import ShardRouter, ShardedDocumentStore
+from vector_store import embedder, extract_company_name_and_year_from_pdf, parser
+
+
+def shard_url(shard: int) -> str:
+    return f"http://{config.SHARD_HOST}:{config.SHARD_BASE_PORT + shard}"
+
+
+def run_shard(shard: int):
+    # each shard builds its own graph, in its own process
+    folder = pw.io.fs.read(
+        path="./data/",
+        format="binary",
+        with_metadata=True,
+    )
+    doc_store = ShardedDocumentStore(
+        [folder],
+        knn_factory=make_knn_factory(embedder, config.VECTOR_INDEX_TYPE),
+        bm25_factory=make_bm25_factory(),
+        shard=shard,
+        num_shards=config.NUM_SHARDS,
+        extract_company=lambda reader, fingerprint: extract_company_name_and_year_from_pdf(
+            reader, fingerprint
+        ).company_name,
+        splitter=None,  # OpenParse parser handles the chunking
+        parser=parser,
+    )
+    server = DocumentStoreServer(
+        host=config.SHARD_HOST,
+        port=config.SHARD_BASE_PORT + shard,
+        document_store=doc_store,
+    )
+    serve_blobs(server, BlobStore())
+    serve_retrieve_batch(server, doc_store)
+
+    server.run(
+        cache_backend=pw.persistence.Backend.filesystem(
+            f"{config.SHARD_CACHE_DIR}/shard{shard}"
+        )
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    processes = [
+        multiprocessing.Process(target=run_shard, args=(shard,))
+        for shard in range(config.NUM_SHARDS)
+    ]
+    for process in processes:
+        process.start()
+
+    # in place of the single server, so the clients need no change
+    router = ShardRouter(
+        host=config.VECTOR_STORE_HOST,
+        port=config.VECTOR_STORE_PORT,
+        shard_urls=[shard_url(shard) for shard in range(config.NUM_SHARDS)],
+    )
+    router.run()
+
+    for process in processes:
+        process.join()
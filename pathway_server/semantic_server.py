@@ -1,25 +1,23 @@
 from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.servers import DocumentStoreServer
-from pathway.stdlib.indexing import BruteForceKnnFactory
-from pathway.udfs import DiskCache
 from pathway.xpacks.llm import embedders
 import pathway as pw
 from dotenv import load_dotenv
 import config
+from index_factory import make_retriever_factory
+from udf_caches import SharedEmbeddingCache
 from langchain_core.documents import Document
 
 load_dotenv()
 
 # Initialize Embedder and KNN Index
-embedder = embedders.OpenAIEmbedder(cache_strategy=DiskCache())
-
-knn_index = BruteForceKnnFactory(
-    reserved_space=1000,
-    embedder=embedder,
-    metric=pw.engine.BruteForceKnnMetricKind.COS,
-    dimensions=1536,
+embedder = embedders.OpenAIEmbedder(
+    model=config.OPENAI_EMBEDDING_MODEL,
+    cache_strategy=SharedEmbeddingCache(config.OPENAI_EMBEDDING_MODEL),
 )
 
+knn_index = make_retriever_factory(embedder, config.CACHE_VECTOR_INDEX_TYPE)
+
 
 # Define schema to match JSON structure
 class InputSchema(pw.Schema):
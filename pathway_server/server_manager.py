@@ -1,5 +1,26 @@
+"""
+Keeps the data directories of the fast server and of the two slow servers in
+sync with BASE_DATA_DIRECTORY.
+
+New files are picked up from filesystem events (inotify, through `watchdog`,
+with a fallback to polling every TIME_PERIOD seconds) and hard-linked in
+batches:
+
+- to the fast server, as soon as it is up;
+- to the slow servers one after the other: a batch is linked to Slow1 only, and
+  to Slow2 (with the cache of Slow1 copied first) once Slow1 lists all its files
+  in `/v1/inputs`, so one of them always serves the complete previous batch.
+
+The progress of every server (files linked and ingested, lag of the oldest file
+not ingested yet) is served as JSON at http://SERVER_MANAGER_HOST:SERVER_MANAGER_PORT/status.
+"""
+
+import json
 import os
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import config
 import requests
 
@@ -77,139 +98,283 @@ def get_all_server_status():
     )
 
 
-added_to_slow1 = False  # Flag to check if the file is added to slow1
-file_added_to_slow1 = None  # File added to slow1
-added_to_slow2 = False  # Flag to check if the file is added to slow2
-file_added_to_slow2 = None  # File added to slow2
-
 """
-Manage the servers
-Should be called in a loop
+Names of the files listed by the /v1/inputs endpoint of the server,
+None if the server does not answer
 """
 
 
-def manage(past_base_data_directory):
-
-    global added_to_slow1
-    global added_to_slow2
-    global file_added_to_slow1
-    global file_added_to_slow2
-
-    fast_server_status, slow1_server_status, slow2_server_status = (
-        get_all_server_status()
-    )
-
-    curr_base_data_directory = os.listdir(BASE_DATA_DIRECTORY)
-    curr_fast_data_directory = os.listdir(FAST_SERVER_DATA_DIRECTORY)
-    curr_slow1_data_directory = os.listdir(SLOW1_SERVER_DATA_DIRECTORY)
-    curr_slow2_data_directory = os.listdir(SLOW2_SERVER_DATA_DIRECTORY)
+def get_ingested_files(url):
+    try:
+        response = requests.post(
+            url + "/v1/inputs",
+            json={},
+            headers={"Content-Type": "application/json"},
+            timeout=5,
+        )
+        inputs = response.json()
+    except Exception as e:
+        log(LOGDEBUG, f"Could not list the inputs of {url}: {e}")
+        return None
+    return {
+        os.path.basename(metadata["path"])
+        for metadata in inputs
+        if isinstance(metadata, dict) and metadata.get("path")
+    }
 
-    fast_data_directory_pending = list(
-        set(curr_base_data_directory) - set(curr_fast_data_directory)
-    )
-    slow1_data_directory_pending = list(
-        set(curr_base_data_directory) - set(curr_slow1_data_directory)
-    )
-    slow2_data_directory_pending = list(
-        set(curr_base_data_directory) - set(curr_slow2_data_directory)
-    )
 
-    if fast_server_status:
-        log(LOGINFO, f"Fast server is up")
-
-        if len(fast_data_directory_pending) > 0:
-            log(LOGINFO, "Fast server has pending files")
-
-            # Link the file to the fast server
-            # This is a hard link
-            file = fast_data_directory_pending[0]
-            os.link(
-                os.path.join(BASE_DATA_DIRECTORY, file),
-                os.path.join(FAST_SERVER_DATA_DIRECTORY, file),
-            )
-
-            log(LOGINFO, f"File {file} is linked to fast server")
-        else:
-            log(LOGINFO, "Fast server has no pending files")
-    else:
-        log(LOGINFO, f"Fast server is down")
-
-    if not slow1_server_status:
-        log(LOGINFO, f"Slow1 server is down")
-
-    if not slow2_server_status:
-        log(LOGINFO, f"Slow2 server is down")
-
-    if slow1_server_status and slow2_server_status:
-        log(LOGINFO, f"Both Slow1 and Slow2 servers are up")
-
-        if added_to_slow1 and added_to_slow2:
-            log(LOGERROR, "Added to both")
-
-        # Slow1 is up and running
-        # Indexing is also done
-        # Transfer the slow1 cache to slow2
-        # Link the file to slow2 as well
-        if added_to_slow1:
-            log(LOGINFO, "Copying cache of Slow1 to Slow2")
-            os.system(
-                f"cp -ruT {SLOW1_SERVER_CACHE_DIRECTORY} {SLOW2_SERVER_CACHE_DIRECTORY}"
-            )
-            os.link(
-                os.path.join(BASE_DATA_DIRECTORY, file_added_to_slow1),
-                os.path.join(SLOW2_SERVER_DATA_DIRECTORY, file_added_to_slow1),
-            )
-            added_to_slow1 = False
-            file_added_to_slow1 = None
-
-        # redundant code
-        # never used
-        elif added_to_slow2:
-            log(LOGINFO, "Copying cache of Slow2 to Slow1")
-            os.system(
-                f"cp -ruT {SLOW2_SERVER_CACHE_DIRECTORY} {SLOW1_SERVER_CACHE_DIRECTORY}"
-            )
-            os.link(
-                os.path.join(BASE_DATA_DIRECTORY, file_added_to_slow2),
-                os.path.join(SLOW1_SERVER_DATA_DIRECTORY, file_added_to_slow2),
-            )
-            added_to_slow2 = False
-            file_added_to_slow2 = None
-
-        # Slow1 and Slow2 are up and running
-        # Check if the data directories are consistent
-        # If not consistent, log an error
-        # If consistent, link the file to the slow1 server if pending
-        # SLow1 will go down if file is linked
-        elif not added_to_slow1 and not added_to_slow2:
-            diff_of_slow1_slow2_data = list(
-                set(curr_slow1_data_directory) - set(curr_slow2_data_directory)
-            )
-
-            if len(diff_of_slow1_slow2_data) > 0:
-                log(LOGERROR, "Slow1 and Slow2 data directories inconsistent")
-
-            if len(slow1_data_directory_pending) > 0:
-                log(LOGINFO, "Slow1 server has pending files")
-                file = slow1_data_directory_pending[0]
+def list_files(directory):
+    try:
+        return set(os.listdir(directory))
+    except FileNotFoundError:
+        return set()
+
+
+class Replica:
+    """A server, with the files linked to its data directory and ingested by it."""
+
+    def __init__(self, name, url, data_directory, cache_directory):
+        self.name = name
+        self.url = url
+        self.data_directory = data_directory
+        self.cache_directory = cache_directory
+        self.healthy = False
+        self.linked = set()
+        self.ingested = set()
+        self.last_ingest_check = None
+
+    def refresh(self):
+        self.linked = list_files(self.data_directory)
+        ingested = get_ingested_files(self.url)
+        self.healthy = ingested is not None
+        if ingested is not None:
+            self.ingested = ingested
+            self.last_ingest_check = time.time()
+
+    def link(self, files, base_directory=BASE_DATA_DIRECTORY):
+        """Hard-links `files` of `base_directory`, returns those linked."""
+        linked = []
+        os.makedirs(self.data_directory, exist_ok=True)
+        for file in sorted(set(files) - self.linked):
+            try:
                 os.link(
-                    os.path.join(BASE_DATA_DIRECTORY, file),
-                    os.path.join(SLOW1_SERVER_DATA_DIRECTORY, file),
+                    os.path.join(base_directory, file),
+                    os.path.join(self.data_directory, file),
                 )
-                added_to_slow1 = True
-                file_added_to_slow1 = file
-                log(LOGINFO, f"File {file} is linked to slow1 server")
-            else:
-                log(LOGINFO, "Slow1 server has no pending files")
-        else:
-            log(LOGERROR, "This should not happen")
+            except FileExistsError:
+                pass
+            except OSError as e:
+                log(LOGERROR, f"Could not link {file} to {self.name}: {e}")
+                continue
+            linked.append(file)
+        self.linked.update(linked)
+        if linked:
+            log(LOGINFO, f"Linked {len(linked)} files to {self.name}")
+        return linked
+
+
+class SyncDaemon:
+    """
+    Links the files of `base_directory` to `fast` at once and to the `slow`
+    replicas in staged rollouts, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        base_directory,
+        fast,
+        slow,
+        period=TIME_PERIOD,
+        debounce=config.SERVER_MANAGER_DEBOUNCE_S,
+    ):
+        self.base_directory = base_directory
+        self.fast = fast
+        self.slow = slow
+        self.period = period
+        self.debounce = debounce
+
+        self.base_files = set()
+        # when the daemon first saw every file, for the lag
+        self.first_seen = {}
+        # current rollout to the slow replicas: its files and stage
+        self.rollout = None
+        self.rollouts_done = 0
+        self.last_sync = None
+        self.watching = None
+
+        self._wake = threading.Event()
+        self._last_event = 0.0
+        self._lock = threading.Lock()
+
+    def notify(self, *args):
+        """Called on every filesystem event of the base directory."""
+        self._last_event = time.monotonic()
+        self._wake.set()
+
+    def _start_rollout(self):
+        files = self.base_files - set.intersection(*(r.linked for r in self.slow))
+        if not files:
+            return
+        if not all(r.healthy for r in self.slow):
+            log(LOGINFO, f"{len(files)} files waiting for both slow servers to be up")
+            return
+        self.rollout = {"files": files, "stage": 0, "started_at": time.time()}
+        log(LOGINFO, f"Rolling out {len(files)} files to the slow servers")
+        self.slow[0].link(files, self.base_directory)
+
+    def _advance_rollout(self):
+        # files deleted meanwhile will never be ingested
+        self.rollout["files"] &= self.base_files
+        replica = self.slow[self.rollout["stage"]]
+        if not (replica.healthy and self.rollout["files"] <= replica.ingested):
+            return
+        log(LOGINFO, f"{replica.name} ingested the {len(self.rollout['files'])} files")
+        self.rollout["stage"] += 1
+        if self.rollout["stage"] == len(self.slow):
+            self.rollout = None
+            self.rollouts_done += 1
+            return
+
+        following = self.slow[self.rollout["stage"]]
+        # the next server finds the parsed documents in its cache
+        log(LOGINFO, f"Copying cache of {replica.name} to {following.name}")
+        os.system(f"cp -ruT {replica.cache_directory} {following.cache_directory}")
+        following.link(self.rollout["files"], self.base_directory)
+
+    def sync(self):
+        with self._lock:
+            self.base_files = list_files(self.base_directory)
+            now = time.time()
+            for file in self.base_files:
+                self.first_seen.setdefault(file, now)
+
+            for replica in [self.fast, *self.slow]:
+                replica.refresh()
+                if not replica.healthy:
+                    log(LOGDEBUG, f"{replica.name} is down")
+
+            if self.fast.healthy:
+                self.fast.link(self.base_files, self.base_directory)
+
+            if self.rollout is not None:
+                self._advance_rollout()
+            if self.rollout is None:
+                self._start_rollout()
+            self.last_sync = time.time()
+
+    def _replica_status(self, replica, now):
+        waiting = self.base_files - replica.ingested
+        return {
+            "url": replica.url,
+            "healthy": replica.healthy,
+            "linked": len(replica.linked & self.base_files),
+            "ingested": len(replica.ingested & self.base_files),
+            "pending": len(self.base_files - replica.linked),
+            "ingesting": len((replica.linked - replica.ingested) & self.base_files),
+            "lag_s": max(
+                (now - self.first_seen.get(file, now) for file in waiting), default=0.0
+            ),
+            "last_ingest_check": replica.last_ingest_check,
+        }
+
+    def status(self):
+        with self._lock:
+            now = time.time()
+            return {
+                "watching": self.watching,
+                "base_files": len(self.base_files),
+                "last_sync": self.last_sync,
+                "rollout": self.rollout
+                and {
+                    "files": len(self.rollout["files"]),
+                    "stage": self.slow[self.rollout["stage"]].name,
+                    "started_at": self.rollout["started_at"],
+                },
+                "rollouts_done": self.rollouts_done,
+                "replicas": {
+                    replica.name: self._replica_status(replica, now)
+                    for replica in [self.fast, *self.slow]
+                },
+            }
+
+    def _watch(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            log(LOGWARN, f"watchdog is not installed, polling every {self.period}s")
+            self.watching = "polling"
+            return
+
+        daemon = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                daemon.notify(event)
+
+        os.makedirs(self.base_directory, exist_ok=True)
+        observer = Observer()
+        observer.schedule(Handler(), self.base_directory, recursive=False)
+        observer.daemon = True
+        observer.start()
+        self.watching = "events"
+
+    def run_forever(self):
+        self._watch()
+        while True:
+            # woken by new files, or every period to follow the ingestion
+            self._wake.wait(self.period)
+            # let the files being copied settle, and batch them
+            while time.monotonic() - self._last_event < self.debounce:
+                time.sleep(self.debounce)
+            self._wake.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                log(LOGERROR, f"Sync failed: {e}")
+
+
+def serve_status(daemon, host=config.SERVER_MANAGER_HOST, port=config.SERVER_MANAGER_PORT):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(daemon.status()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 
 if __name__ == "__main__":
     print("Server Manager started")
 
-    past_base_data_directory = os.listdir(BASE_DATA_DIRECTORY)
-
-    while True:
-        manage(past_base_data_directory=past_base_data_directory)
-        time.sleep(TIME_PERIOD)
+    daemon = SyncDaemon(
+        BASE_DATA_DIRECTORY,
+        fast=Replica(
+            "fast", FAST_SERVER_URL, FAST_SERVER_DATA_DIRECTORY, FAST_SERVER_CACHE_DIRECTORY
+        ),
+        slow=[
+            Replica(
+                "slow1",
+                SLOW1_SERVER_URL,
+                SLOW1_SERVER_DATA_DIRECTORY,
+                SLOW1_SERVER_CACHE_DIRECTORY,
+            ),
+            Replica(
+                "slow2",
+                SLOW2_SERVER_URL,
+                SLOW2_SERVER_DATA_DIRECTORY,
+                SLOW2_SERVER_CACHE_DIRECTORY,
+            ),
+        ],
+    )
+    serve_status(daemon)
+    daemon.sync()
+    daemon.run_forever()
@@ -0,0 +1,398 @@
+"""
+Sharding of the document store by company.
+
+Every chunk belongs to the shard `shard_of(company_name)` of its parser metadata.
+`ShardedDocumentStore` keeps only the chunks of one shard, and `ShardRouter`
+sends every query only to the shards its `metadata_filter` can match:
+
+    company_name == `apple` && year == `2022`                  -> shard of apple
+    (company_name == `apple` || company_name == `nike`) && ... -> shards of both
+    year == `2022`                                             -> all the shards
+
+Every file is parsed by the shard of its company only. The company comes from
+the shared `MetadataCache` (an earlier ingestion, or `python metadata_cache.py
+data/`), or else from `extract_company` on the first pages of the file, by one
+shard while the others wait for its result in the cache; the parser then reads
+the same cached company. Files whose company cannot be found before parsing are
+parsed by every shard, each keeping its chunks.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Callable
+
+import aiohttp
+import aiohttp.web
+import jmespath
+import pathway as pw
+
+import config
+from hybrid_document_store import HybridDocumentStore
+from metadata_cache import MetadataCache, document_fingerprint, normalize_company
+
+metadata_cache = MetadataCache()
+
+
+def shard_of(company_name, num_shards: int = config.NUM_SHARDS) -> int:
+    """Shard of the chunks of a company, chunks without a company go to shard 0."""
+    if not company_name:
+        return 0
+    key = normalize_company(str(company_name)).encode("utf-8")
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "big") % num_shards
+
+
+def _literal_company(node):
+    left, right = node["children"]
+    for field, literal in ((left, right), (right, left)):
+        if (
+            field["type"] == "field"
+            and field["value"] == "company_name"
+            and literal["type"] == "literal"
+        ):
+            return literal["value"]
+    return None
+
+
+def _companies(node) -> set | None:
+    # companies a chunk must have to match the expression, None if any company can
+    if node["type"] == "comparator" and node["value"] == "eq":
+        company = _literal_company(node)
+        return {company} if company is not None else None
+    if node["type"] == "or_expression":
+        left, right = (_companies(child) for child in node["children"])
+        if left is None or right is None:
+            return None
+        return left | right
+    if node["type"] == "and_expression":
+        left, right = (_companies(child) for child in node["children"])
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return left & right
+    return None
+
+
+def shards_for_filter(
+    metadata_filter: str | None, num_shards: int = config.NUM_SHARDS
+) -> list[int]:
+    """Shards holding the chunks that can match `metadata_filter`."""
+    all_shards = list(range(num_shards))
+    if not metadata_filter:
+        return all_shards
+    try:
+        companies = _companies(jmespath.compile(metadata_filter).parsed)
+    except jmespath.exceptions.JMESPathError:
+        return all_shards
+    if companies is None:
+        return all_shards
+    return sorted({shard_of(company, num_shards) for company in companies})
+
+
+@contextmanager
+def _fingerprint_lock(fingerprint: str):
+    # held across the shard processes, by one of them at a time
+    directory = os.path.join(config.SHARD_CACHE_DIR, "locks")
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{fingerprint}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _company(data: bytes, extract_company: Callable | None = None) -> str | None:
+    if not data.startswith(b"%PDF"):
+        return None
+    try:
+        from pypdf import PdfReader
+
+        reader = PdfReader(stream=BytesIO(data))
+        fingerprint = document_fingerprint(reader)
+    except Exception:
+        return None
+    cached = metadata_cache.get_company_and_year(fingerprint)
+    if cached is not None or extract_company is None:
+        return cached["company_name"] if cached is not None else None
+
+    # the first shard to get here extracts, the others then hit the cache
+    with _fingerprint_lock(fingerprint):
+        cached = metadata_cache.get_company_and_year(fingerprint)
+        if cached is not None:
+            return cached["company_name"]
+        try:
+            return extract_company(reader, fingerprint)
+        except Exception as e:
+            print(f"Error extracting the company before parsing: {e!r}")
+            return None
+
+
+class ShardedDocumentStore(HybridDocumentStore):
+    """
+    `HybridDocumentStore` holding the chunks of shard `shard` out of `num_shards`.
+
+    Args:
+        docs, knn_factory, bm25_factory: As for `HybridDocumentStore`
+        shard (int): Index of this shard
+        num_shards (int): Number of shards
+        extract_company: Called with the `PdfReader` and fingerprint of a file
+            whose company is not cached, returns its company (and caches it for
+            the parser); without it such files are parsed by every shard
+    """
+
+    def __init__(
+        self,
+        docs,
+        knn_factory,
+        bm25_factory,
+        shard: int,
+        num_shards: int = config.NUM_SHARDS,
+        extract_company: Callable | None = None,
+        **kwargs,
+    ):
+        self.shard = shard
+        self.num_shards = num_shards
+        self.extract_company = extract_company
+        if isinstance(docs, pw.Table):
+            docs = [docs]
+        docs = [self._skip_other_shards(table) for table in docs]
+        super().__init__(docs, knn_factory, bm25_factory, **kwargs)
+
+    def _skip_other_shards(self, docs: pw.Table) -> pw.Table:
+        # files of a known company are not even parsed by the other shards
+        @pw.udf
+        def may_hold(data: bytes) -> bool:
+            company = _company(data, self.extract_company)
+            return company is None or shard_of(company, self.num_shards) == self.shard
+
+        return docs.filter(may_hold(pw.this.data))
+
+    def parse_documents(self, input_docs: pw.Table) -> pw.Table:
+        @pw.udf
+        def in_shard(metadata: pw.Json) -> bool:
+            company = metadata.as_dict().get("company_name")
+            return shard_of(company, self.num_shards) == self.shard
+
+        parsed_docs = super().parse_documents(input_docs)
+        return parsed_docs.filter(in_shard(pw.this.metadata))
+
+
+class ShardRouter:
+    """
+    aiohttp server in front of the shards, with the endpoints of a
+    `DocumentStoreServer`: `/v1/retrieve` and `/v1/retrieve_batch` go to the
+    shards of their `metadata_filter` (see `shards_for_filter`), and their results
+    are merged (see `_merge`); `/v1/statistics` and `/v1/inputs` combine all the
+    shards.
+
+    Args:
+        host, port: Address of the router
+        shard_urls: URLs of the shard servers, in shard order
+    """
+
+    def __init__(self, host: str, port: int, shard_urls: list[str]):
+        self.host = host
+        self.port = port
+        self.shard_urls = shard_urls
+        self._session: aiohttp.ClientSession | None = None
+
+    async def _post(self, shard: int, route: str, data: dict):
+        try:
+            async with self._session.post(
+                self.shard_urls[shard] + route,
+                json=data,
+                timeout=aiohttp.ClientTimeout(total=config.VECTOR_STORE_TIMEOUT),
+            ) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+        except Exception as e:
+            print(f"Error from shard {shard}: {e!r}")
+            return None
+
+    async def _scatter(self, requests: dict[int, tuple[str, dict]]) -> dict:
+        shards = list(requests)
+        responses = await asyncio.gather(
+            *(self._post(shard, *requests[shard]) for shard in shards)
+        )
+        return {
+            shard: response
+            for shard, response in zip(shards, responses)
+            if response is not None
+        }
+
+    @staticmethod
+    def _split(query: dict, num_shards: int) -> list[dict]:
+        """
+        Queries sent to the shards for `query`. The fused `dist` of a hybrid query
+        only ranks the chunks of one shard, so over several shards the query is
+        split into its KNN and BM25 halves, fused by `_merge` over all the shards.
+        """
+        retrieval_mode = query.get("retrieval_mode") or config.RETRIEVAL_MODE
+        if num_shards == 1 or retrieval_mode != "hybrid":
+            return [query]
+        k = int(query.get("k") or config.NUM_DOCS_TO_RETRIEVE)
+        candidates = k * config.HYBRID_CANDIDATES_FACTOR
+        return [
+            {**query, "retrieval_mode": mode, "k": candidates}
+            for mode in ("knn", "bm25")
+        ]
+
+    @staticmethod
+    def _merge(query: dict, results: list[list[dict]]) -> list[dict]:
+        """
+        Results of `query` from the results of its `_split` queries over all the
+        shards. The KNN (cosine) and BM25 `dist` are comparable across shards, so
+        each split query is merged by `dist`; the KNN and BM25 halves of a hybrid
+        query are then fused as `fuse_results` does on a single store.
+        """
+        k = query.get("k")
+        if len(results) == 1:
+            merged = sorted(results[0], key=lambda x: x["dist"])
+            return merged[:k] if isinstance(k, int) else merged
+
+        weights = [
+            config.HYBRID_FUSION_WEIGHTS[mode]
+            if query.get(f"{mode}_weight") is None
+            else query[f"{mode}_weight"]
+            for mode in ("knn", "bm25")
+        ]
+        fused = {}
+        for weight, rets in zip(weights, results):
+            for rank, ret in enumerate(sorted(rets, key=lambda x: x["dist"]), start=1):
+                metadata = {**(ret.get("metadata") or {}), "retrieval_mode": "hybrid"}
+                key = (ret["text"], json.dumps(metadata, sort_keys=True, default=str))
+                if key not in fused:
+                    fused[key] = {**ret, "metadata": metadata, "dist": 0.0}
+                fused[key]["dist"] -= float(weight) / (config.HYBRID_RRF_K + rank)
+        merged = sorted(fused.values(), key=lambda x: x["dist"])
+        return merged[: int(k or config.NUM_DOCS_TO_RETRIEVE)]
+
+    async def _retrieve(self, queries: list) -> list[list[dict]] | None:
+        # every query goes to the shards of its metadata_filter, split by `_split`
+        split_queries = []
+        positions: dict[int, list[tuple[int, int]]] = {}
+        for position, query in enumerate(queries):
+            if not isinstance(query, dict):
+                split_queries.append([])
+                continue
+            shards = shards_for_filter(
+                query.get("metadata_filter"), len(self.shard_urls)
+            )
+            split_queries.append(self._split(query, len(shards)))
+            for shard in shards:
+                positions.setdefault(shard, []).extend(
+                    (position, part) for part in range(len(split_queries[-1]))
+                )
+
+        responses = await self._scatter(
+            {
+                shard: (
+                    "/v1/retrieve_batch",
+                    {
+                        "queries": [
+                            split_queries[position][part]
+                            for position, part in shard_positions
+                        ]
+                    },
+                )
+                for shard, shard_positions in positions.items()
+            }
+        )
+        if positions and not responses:
+            return None
+        results = [[[] for _ in parts] for parts in split_queries]
+        for shard, response in responses.items():
+            for (position, part), rets in zip(positions[shard], response):
+                results[position][part].extend(rets)
+        return [
+            self._merge(query, query_results) if isinstance(query, dict) else []
+            for query, query_results in zip(queries, results)
+        ]
+
+    async def handle_retrieve(self, request):
+        results = await self._retrieve([await request.json()])
+        if results is None:
+            return aiohttp.web.Response(status=502, text="No shard answered")
+        return aiohttp.web.json_response(results[0])
+
+    async def handle_retrieve_batch(self, request):
+        queries = (await request.json()).get("queries") or []
+        results = await self._retrieve(queries)
+        if results is None:
+            return aiohttp.web.Response(status=502, text="No shard answered")
+        return aiohttp.web.json_response(results)
+
+    async def handle_statistics(self, request):
+        responses = await self._scatter(
+            {shard: ("/v1/statistics", {}) for shard in range(len(self.shard_urls))}
+        )
+        if not responses:
+            return aiohttp.web.Response(status=500, text="All shards are down")
+
+        def latest(field):
+            values = [s.get(field) for s in responses.values() if s.get(field)]
+            return max(values) if values else None
+
+        return aiohttp.web.json_response(
+            {
+                "file_count": sum(s.get("file_count") or 0 for s in responses.values()),
+                "last_modified": latest("last_modified"),
+                "last_indexed": latest("last_indexed"),
+                "shards": {
+                    str(shard): responses.get(shard)
+                    for shard in range(len(self.shard_urls))
+                },
+            }
+        )
+
+    async def handle_inputs(self, request):
+        data = await request.json() if request.can_read_body else {}
+        responses = await self._scatter(
+            {shard: ("/v1/inputs", data) for shard in range(len(self.shard_urls))}
+        )
+        # files whose company was not found before parsing are read by every shard
+        inputs = {}
+        for response in responses.values():
+            for metadata in response:
+                inputs.setdefault(json.dumps(metadata, sort_keys=True), metadata)
+        return aiohttp.web.json_response(list(inputs.values()))
+
+    async def handle_blob(self, request):
+        for url in self.shard_urls:
+            try:
+                async with self._session.get(url + request.rel_url.path_qs) as resp:
+                    if resp.status == 200:
+                        return aiohttp.web.Response(
+                            body=await resp.read(), content_type=resp.content_type
+                        )
+            except aiohttp.ClientError as e:
+                print(f"Error from {url}: {e!r}")
+        return aiohttp.web.Response(status=404)
+
+    async def _on_startup(self, app):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        )
+
+    async def _on_cleanup(self, app):
+        await self._session.close()
+
+    def make_app(self) -> aiohttp.web.Application:
+        app = aiohttp.web.Application()
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        app.router.add_route("*", "/v1/retrieve", self.handle_retrieve)
+        app.router.add_route("*", "/v1/retrieve_batch", self.handle_retrieve_batch)
+        app.router.add_route("*", "/v1/statistics", self.handle_statistics)
+        app.router.add_route("*", "/v1/inputs", self.handle_inputs)
+        app.router.add_route("GET", "/v1/blob/{hash}", self.handle_blob)
+        return app
+
+    def run(self):
+        aiohttp.web.run_app(self.make_app(), host=self.host, port=self.port)
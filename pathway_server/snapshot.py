@@ -0,0 +1,289 @@
+"""
+Snapshots of a document store, so a new replica (or one whose cache was wiped)
+starts warm instead of parsing, contextualizing and embedding the whole corpus.
+
+A snapshot is a single SQLite file with:
+
+- `documents`: the parser output (chunks and their metadata) of every input file,
+  keyed by the SHA-256 of the file content;
+- `embeddings`: the vectors of these chunks, as in the shared embedding cache;
+- `meta`: when and from what it was taken.
+
+A `SnapshotDocumentStore` records its parsed documents, and its replica serves
+a snapshot of their state at the end of the last processed batch at
+`GET /v1/snapshot`. Started with `snapshot_path`, it restores the chunks of the
+files found in the snapshot and loads the vectors into the embedding cache, so
+only the files that are new or changed since are parsed and embedded:
+
+    python snapshot.py http://localhost:7001 Snapshots/latest.db
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import pathway as pw
+import requests
+from aiohttp import web
+
+import config
+from quantized_index import MemoryStatsDocumentStore
+from udf_caches import SharedEmbeddingCache
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS documents (
+    hash TEXT PRIMARY KEY,
+    path TEXT,
+    modified_at INTEGER,
+    chunks TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    dtype TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (model, hash)
+);
+"""
+
+
+class SnapshotRecorder:
+    """
+    Mirror of the parsed documents of a document store, fed by `pw.io.subscribe`.
+    Changes are applied at the end of each Pathway time only, so an export
+    never sees half of an update.
+    """
+
+    def __init__(self):
+        self.documents: dict = {}
+        self.last_time = None
+        self._pending: list = []
+        self._lock = threading.Lock()
+
+    def on_change(self, key, row: dict, time: int, is_addition: bool):
+        self._pending.append((key, row, is_addition))
+
+    def on_time_end(self, time: int):
+        with self._lock:
+            # retractions first, an updated document is retracted and re-added
+            for key, row, is_addition in sorted(self._pending, key=lambda x: x[2]):
+                if is_addition:
+                    self.documents[key] = row
+                else:
+                    self.documents.pop(key, None)
+            self._pending = []
+            self.last_time = time
+
+    def export(self, path: str, embedding_cache: SharedEmbeddingCache | None = None) -> dict:
+        """Writes a snapshot to `path` (atomically) and returns its summary."""
+        with self._lock:
+            documents = list(self.documents.values())
+            last_time = self.last_time
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".db")
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            conn.executescript(_SCHEMA)
+            conn.executemany(
+                "INSERT OR REPLACE INTO documents (hash, path, modified_at, chunks) VALUES (?, ?, ?, ?)",
+                (
+                    (row["hash"], row["path"], row["modified_at"], json.dumps(row["chunks"].value))
+                    for row in documents
+                ),
+            )
+            vectors = 0
+            if embedding_cache is not None:
+                # chunks parsed but not embedded yet are embedded by the new replica
+                keys = {
+                    embedding_cache.make_key((text,), {})
+                    for row in documents
+                    for text, _ in row["chunks"].value
+                }
+                rows = embedding_cache.get_many(keys)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, hash, dtype, vector) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                vectors = len(rows)
+            summary = {
+                "created_at": time.time(),
+                "pathway_time": last_time,
+                "documents": len(documents),
+                "chunks": sum(len(row["chunks"].value) for row in documents),
+                "vectors": vectors,
+            }
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in summary.items()),
+            )
+            conn.commit()
+            conn.close()
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return summary
+
+
+def load_snapshot(
+    path: str, embedding_cache: SharedEmbeddingCache | None = None
+) -> dict[str, list]:
+    """
+    Chunks of the documents of the snapshot at `path`, by content hash. Its
+    vectors are added to `embedding_cache`.
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        documents = {
+            content_hash: json.loads(chunks)
+            for content_hash, chunks in conn.execute("SELECT hash, chunks FROM documents")
+        }
+        if embedding_cache is not None:
+            embedding_cache.put_many(
+                conn.execute("SELECT model, hash, dtype, vector FROM embeddings")
+            )
+        meta = {
+            key: json.loads(value)
+            for key, value in conn.execute("SELECT key, value FROM meta")
+        }
+    finally:
+        conn.close()
+    print(f"Loaded snapshot {path}: {meta}")
+    return documents
+
+
+class SnapshotDocumentStore(MemoryStatsDocumentStore):
+    """
+    `MemoryStatsDocumentStore` that records its parsed documents for the
+    snapshots, and starts from the snapshot at `snapshot_path` if given.
+
+    Args:
+        snapshot_path (str): Snapshot to restore the documents from
+        embedding_cache (SharedEmbeddingCache): Cache of the embedder, for the vectors
+    """
+
+    def __init__(
+        self,
+        *args,
+        snapshot_path: str | None = None,
+        embedding_cache: SharedEmbeddingCache | None = None,
+        **kwargs,
+    ):
+        self.embedding_cache = embedding_cache
+        self.recorder = SnapshotRecorder()
+        self.restored = (
+            load_snapshot(snapshot_path, embedding_cache) if snapshot_path else {}
+        )
+        super().__init__(*args, **kwargs)
+
+    def parse_documents(self, input_docs: pw.Table) -> pw.Table:
+        @pw.udf
+        def content_hash(data: bytes) -> str:
+            return hashlib.sha256(data).hexdigest()
+
+        @pw.udf
+        def parse_doc(data: bytes, content_hash: str) -> pw.Json:
+            rets = self.restored.get(content_hash)
+            if rets is None:
+                rets = [[text, metadata] for text, metadata in self.parser(data)]
+            return pw.Json(rets)
+
+        @pw.udf
+        def to_chunks(chunks: pw.Json, metadata: pw.Json) -> list[dict]:
+            metadata_dict = metadata.as_dict()
+            return [
+                dict(text=text, metadata={**metadata_dict, **chunk_metadata})
+                for text, chunk_metadata in chunks.value
+            ]
+
+        documents = input_docs.with_columns(hash=content_hash(pw.this.text))
+        documents = documents.select(
+            pw.this.hash,
+            pw.this.metadata,
+            chunks=parse_doc(pw.this.text, pw.this.hash),
+        )
+        pw.io.subscribe(
+            documents.select(
+                pw.this.hash,
+                pw.this.chunks,
+                path=pw.this.metadata["path"].as_str(),
+                modified_at=pw.this.metadata["modified_at"].as_int(),
+            ),
+            on_change=self.recorder.on_change,
+            on_time_end=self.recorder.on_time_end,
+        )
+
+        return (
+            documents.select(data=to_chunks(pw.this.chunks, pw.this.metadata))
+            .flatten(pw.this.data)
+            .select(
+                text=pw.unwrap(pw.this.data["text"].as_str()),
+                metadata=pw.this.data["metadata"],
+            )
+        )
+
+
+def serve_snapshot(server, document_store: SnapshotDocumentStore, route: str = "/v1/snapshot"):
+    """
+    Adds a `GET /v1/snapshot` endpoint to a `DocumentStoreServer`, returning a
+    fresh snapshot of `document_store` as an SQLite file.
+    """
+
+    async def handle_snapshot(request: web.Request) -> web.StreamResponse:
+        # every request exports to its own file, so the file sent is the one
+        # its `X-Snapshot` summary describes
+        loop = asyncio.get_running_loop()
+        os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=config.SNAPSHOT_DIR, prefix="snapshot-", suffix=".db")
+        os.close(fd)
+        try:
+            summary = await loop.run_in_executor(
+                None, document_store.recorder.export, path, document_store.embedding_cache
+            )
+            response = web.StreamResponse(
+                headers={
+                    "Content-Type": "application/vnd.sqlite3",
+                    "X-Snapshot": json.dumps(summary),
+                }
+            )
+            response.content_length = os.path.getsize(path)
+            await response.prepare(request)
+            with open(path, "rb") as f:
+                while chunk := await loop.run_in_executor(None, f.read, 1 << 20):
+                    await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            os.remove(path)
+
+    server.webserver._add_endpoint_to_app("GET", route, handle_snapshot)
+
+
+def fetch_snapshot(url: str, path: str, timeout: int = 600) -> dict:
+    """Downloads the snapshot of the replica at `url` to `path`."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".part"
+    with requests.get(url + "/v1/snapshot", stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    os.replace(tmp_path, path)
+    return json.loads(response.headers.get("X-Snapshot", "{}"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python snapshot.py <replica url> <snapshot path>")
+        sys.exit(1)
+    print(fetch_snapshot(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,233 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from pathway.udfs import CacheStrategy, DiskCache
+
+import config
+
+# all the shared embedding caches of this process, for the statistics
+_embedding_caches: list["SharedEmbeddingCache"] = []
+
+
+def _coalesce(cached_func, make_key, in_flight: dict):
+    # concurrent calls with the same key share a single call of `cached_func`
+    async def wrapper(*args, **kwargs):
+        # futures belong to the event loop that created them
+        key = (id(asyncio.get_running_loop()), make_key(args, kwargs))
+        future = in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(cached_func(*args, **kwargs))
+            in_flight[key] = future
+            future.add_done_callback(lambda _: in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    return wrapper
+
+
+class CoalescingDiskCache(DiskCache):
+    """
+    `DiskCache` that also shares a single call between the concurrent calls with
+    the same arguments. Pathway runs the async UDFs of a batch concurrently, so
+    with a plain `DiskCache` a query repeated within a batch (e.g. in a
+    `/v1/retrieve_batch` request) would be embedded once per occurrence.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._in_flight: dict = {}
+
+    def wrap_async(self, func):
+        cached_func = super().wrap_async(func)
+        return functools.wraps(func)(
+            _coalesce(cached_func, self.make_key, self._in_flight)
+        )
+
+
+class SharedEmbeddingCache(CacheStrategy):
+    """
+    Cache strategy of embedders shared by all the servers of a host: embeddings
+    are stored in SQLite (WAL mode, so several processes can use it at once)
+    keyed by `(model, whitespace-normalized text)`, with the most recently used
+    ones of the process also kept in memory. Concurrent calls for the same text
+    share a single request, as with `CoalescingDiskCache`. In async UDFs the
+    SQLite reads and writes run in a worker thread, only the in-memory hits are
+    answered on the event loop.
+
+    Unlike `DiskCache`, it does not need Pathway persistence to be enabled.
+
+    Args:
+        model (str): Model of the embedder, part of the key
+        path (str): SQLite database file
+        hot_size (int): Number of embeddings kept in memory
+    """
+
+    def __init__(
+        self,
+        model: str = config.OPENAI_EMBEDDING_MODEL,
+        path: str = config.EMBEDDING_CACHE_PATH,
+        hot_size: int = config.EMBEDDING_CACHE_HOT_SIZE,
+    ):
+        self.model = model
+        self.path = path
+        self.hot_size = hot_size
+
+        self._lock = threading.Lock()
+        # held around the SQLite connection, so disk I/O never blocks `_lock`
+        self._db_lock = threading.Lock()
+        self._hot: collections.OrderedDict = collections.OrderedDict()
+        self._counts: collections.Counter = collections.Counter()
+        self._in_flight: dict = {}
+        self._conn = None
+        self._pid = None
+        _embedding_caches.append(self)
+
+    def _connection(self) -> sqlite3.Connection:
+        # servers are forked after their embedders are created, and SQLite
+        # connections cannot be shared with a child process
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    dtype TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, hash)
+                )"""
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def make_key(self, args, kwargs) -> tuple[str, str]:
+        text = args[0] if args else kwargs.get("input", "")
+        model = kwargs.get("model") or self.model
+        normalized = " ".join(str(text).split())
+        return model, hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key: tuple[str, str]) -> np.ndarray | None:
+        vector = self._get_hot(key)
+        return vector if vector is not None else self._get_disk(key)
+
+    def put(self, key: tuple[str, str], vector):
+        vector = np.asarray(vector)
+        self._put_hot(key, vector)
+        self._put_disk(key, vector)
+
+    def _get_hot(self, key) -> np.ndarray | None:
+        with self._lock:
+            vector = self._hot.get(key)
+            if vector is not None:
+                self._hot.move_to_end(key)
+                self._counts["hot_hits"] += 1
+            return vector
+
+    def _get_disk(self, key) -> np.ndarray | None:
+        with self._db_lock:
+            row = self._connection().execute(
+                "SELECT dtype, vector FROM embeddings WHERE model = ? AND hash = ?",
+                key,
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self._counts["misses"] += 1
+                return None
+            self._counts["disk_hits"] += 1
+            vector = np.frombuffer(row[1], dtype=row[0])
+            self._remember(key, vector)
+            return vector
+
+    def _put_hot(self, key, vector: np.ndarray):
+        with self._lock:
+            self._remember(key, vector)
+
+    def _put_disk(self, key, vector: np.ndarray):
+        with self._db_lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings (model, hash, dtype, vector) VALUES (?, ?, ?, ?)",
+                (*key, vector.dtype.str, vector.tobytes()),
+            )
+            conn.commit()
+
+    def get_many(self, keys) -> list[tuple]:
+        """Stored `(model, hash, dtype, vector)` rows of `keys`, for the snapshots."""
+        with self._db_lock:
+            conn = self._connection()
+            return [
+                row
+                for key in keys
+                for row in conn.execute(
+                    "SELECT model, hash, dtype, vector FROM embeddings WHERE model = ? AND hash = ?",
+                    key,
+                )
+            ]
+
+    def put_many(self, rows) -> None:
+        """Stores `(model, hash, dtype, vector)` rows, e.g. of a snapshot."""
+        with self._db_lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, hash, dtype, vector) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+    def _remember(self, key, vector):
+        self._hot[key] = vector
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    def wrap_async(self, func):
+        async def cached_func(*args, **kwargs):
+            key = self.make_key(args, kwargs)
+            vector = self._get_hot(key)
+            if vector is None:
+                vector = await asyncio.to_thread(self._get_disk, key)
+            if vector is None:
+                vector = np.asarray(await func(*args, **kwargs))
+                self._put_hot(key, vector)
+                await asyncio.to_thread(self._put_disk, key, vector)
+            return vector
+
+        return functools.wraps(func)(
+            _coalesce(cached_func, self.make_key, self._in_flight)
+        )
+
+    def wrap_sync(self, func):
+        @functools.wraps(func)
+        def cached_func(*args, **kwargs):
+            key = self.make_key(args, kwargs)
+            vector = self.get(key)
+            if vector is None:
+                vector = func(*args, **kwargs)
+                self.put(key, vector)
+            return vector
+
+        return cached_func
+
+    def summary(self) -> dict:
+        with self._lock:
+            lookups = sum(self._counts.values())
+            hits = self._counts["hot_hits"] + self._counts["disk_hits"]
+            return {
+                "model": self.model,
+                "hot_hits": self._counts["hot_hits"],
+                "disk_hits": self._counts["disk_hits"],
+                "misses": self._counts["misses"],
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "hot_size": len(self._hot),
+            }
+
+
+def embedding_cache_stats() -> list[dict]:
+    """Hits and misses of the shared embedding caches of this process."""
+    return [cache.summary() for cache in _embedding_caches]
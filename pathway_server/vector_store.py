@@ -12,15 +12,14 @@ import pathway as pw
 from pathway.udfs import DiskCache, ExponentialBackoffRetryStrategy
 from pathway.xpacks.llm import embedders, llms
 from pathway.xpacks.llm.parsers import OpenParse
-from pathway.stdlib.indexing import (
-    BruteForceKnnFactory,
-    HybridIndexFactory,
-    UsearchKnnFactory,
-)
-from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
-from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.servers import DocumentStoreServer
 import config
+from metadata_cache import COMPANY_YEAR, MetadataCache, document_fingerprint
+from index_factory import make_bm25_factory, make_knn_factory
+from hybrid_document_store import HybridDocumentStore
+from blob_store import BlobStore, serve_blobs
+from batch_retrieval import serve_retrieve_batch
+from udf_caches import SharedEmbeddingCache
 from llm import llm
 from workflows.repeater import repeater
 from workflows.rag_e2e import rag_e2e
@@ -135,14 +134,26 @@ company_name_and_year_extractor_prompt = ChatPromptTemplate.from_messages(
 )
 company_name_and_year_extractor = (
     company_name_and_year_extractor_prompt
-    | llm.with_structured_output(FinancialStatementSchema)
+    | llm.with_structured_output(FinancialStatementSchema).cached(
+        "company_name_and_year_extractor"
+    )
 )
+# shared by all the indexer processes, hits skip the LLM call
+metadata_cache = MetadataCache()
 
 
-def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
+def extract_company_name_and_year_from_nodes(
+    nodes, fingerprint: str | None = None
+) -> FinancialStatementSchema:
     """
     Extracts the 'Company Name' and 'Year of Report' from a list of nodes.
+
+    If `fingerprint` is given, the shared metadata cache is checked first and the
+    LLM is only called on a miss.
     """
+    cached = metadata_cache.get_company_and_year(fingerprint)
+    if cached is not None:
+        return FinancialStatementSchema(**cached)
 
     # Combine text from nodes to form the document content
     nodes_first_three_pages = []
@@ -151,7 +162,28 @@ def extract_company_name_and_year_from_nodes(nodes) -> FinancialStatementSchema:
             nodes_first_three_pages.append(node)
     document_text = "\n".join(node.text for node in nodes_first_three_pages)
 
+    return _extract_company_name_and_year(document_text, fingerprint)
+
+
+def extract_company_name_and_year_from_pdf(
+    reader, fingerprint: str | None = None
+) -> FinancialStatementSchema:
+    """
+    Same as `extract_company_name_and_year_from_nodes`, from the raw text of the
+    first pages of a PDF, before it is parsed: the shards use it to pick the one
+    that parses a new file. Its result is cached for the parser.
+    """
+    cached = metadata_cache.get_company_and_year(fingerprint)
+    if cached is not None:
+        return FinancialStatementSchema(**cached)
+
+    document_text = "\n".join(page.extract_text() or "" for page in reader.pages[:3])
+    return _extract_company_name_and_year(document_text, fingerprint)
+
+
+def _extract_company_name_and_year(document_text: str, fingerprint: str | None):
     res = company_name_and_year_extractor.invoke({"text": document_text})
+    metadata_cache.put(fingerprint, COMPANY_YEAR, res.model_dump())
 
     return res  # type: ignore
 
@@ -181,7 +213,7 @@ class CustomOpenParse(OpenParse):
         parsed_content = self.doc_parser.parse(doc)
         nodes = list(parsed_content.nodes)
         extracted_statement_schema = extract_company_name_and_year_from_nodes(
-            parsed_content.nodes
+            parsed_content.nodes, fingerprint=document_fingerprint(reader)
         )
 
         company_name = extracted_statement_schema.company_name.lower().strip()
@@ -230,8 +262,10 @@ parser = CustomOpenParse(
     cache_strategy=DiskCache(),
 )
 embedder = embedders.OpenAIEmbedder(
-    # model="text-embedding-3-large",
-    cache_strategy=DiskCache()
+    model=config.OPENAI_EMBEDDING_MODEL,
+    # shared by all the servers of the host, a query repeated within a batch of
+    # retrievals is embedded once
+    cache_strategy=SharedEmbeddingCache(config.OPENAI_EMBEDDING_MODEL),
 )
 
 if __name__ == "__main__":
@@ -241,24 +275,11 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    knn_index = BruteForceKnnFactory(
-        reserved_space=1000,
-        embedder=embedder,
-        metric=pw.engine.BruteForceKnnMetricKind.COS,
-        dimensions=1536,
-    )
-    bm25_index = TantivyBM25Factory(
-        ram_budget=5000 * 1024 * 1024, in_memory_index=False
-    )
-    # usearch_knn_index = UsearchKnnFactory(embedder=embedder)
-
-    hybrid_index_factory = HybridIndexFactory(
-        retriever_factories=[bm25_index, knn_index],
-    )
-
-    doc_store = DocumentStore(
+    # BM25 next to the KNN index, the retrieval mode is chosen per request
+    doc_store = HybridDocumentStore(
         *sources,
-        retriever_factory=knn_index,
+        knn_factory=make_knn_factory(embedder, config.VECTOR_INDEX_TYPE),
+        bm25_factory=make_bm25_factory(),
         splitter=None,  # OpenParse parser handles the chunking
         parser=parser,
     )
@@ -270,5 +291,9 @@ if __name__ == "__main__":
 
     ##ADDING IN SERVE CALLABLE FOR OTHER END POINTS
     serve_callable(server,"/answer", InputSchema, handler, **rest_kwargs)
+    # chunk images referenced by the `image_hash` metadata
+    serve_blobs(server, BlobStore())
+    # several queries (e.g. text, table and key-value filters) in one request
+    serve_retrieve_batch(server, doc_store)
 
     server.run()